@@ -9,6 +9,7 @@
 
 from glob import glob
 import os
+import shutil
 GEOSERVER_ENABLED = False
 try:
     from geoserver.catalog import FailedRequestError as geo_cat_FailedRequestError
@@ -19,6 +20,15 @@ except ImportError:
     pass
 
 #local imports
+from imports.autoroute_inputs import cache_return_period_flows, RETURN_PERIOD_FLOWS
+from imports.autoroute_manifest import (AutoRouteManifest,
+                                        DEFAULT_FLOW_CHANGE_TOLERANCE,
+                                        get_file_sha1,
+                                        link_tile_directories)
+from imports.autoroute_results import AutoRouteResultStream
+from imports.geoserver_upload import (DEFAULT_NUM_UPLOAD_THREADS,
+                                      DEFAULT_UPLOAD_RETRIES,
+                                      GeoServerUploadPipeline)
 from imports.helper_functions import (case_insensitive_file_search, 
                                       get_valid_watershed_list,
                                       get_watershed_subbasin_from_folder)
@@ -27,6 +37,68 @@ from imports.helper_functions import (case_insensitive_file_search,
 from AutoRoutePy.run_autoroute_multicore import run_autoroute_multicore 
 from AutoRoutePy.post_process import get_shapefile_layergroup_bounds, rename_shapefiles
 
+#----------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+#----------------------------------------------------------------------------------------
+def merge_layer_group_bounds(bounds, other_bounds):
+    """
+    Bounds (minx, maxx, miny, maxy, ...) of a layer group covering both bounds
+    """
+    return [min(bounds[0], other_bounds[0]), max(bounds[1], other_bounds[1]),
+            min(bounds[2], other_bounds[2]), max(bounds[3], other_bounds[3])] + list(bounds[4:])
+
+def create_floodmap_layer_group(upload_pipeline, floodmap_upload):
+    """
+    Create the layer group of a watershed once its shapefiles are uploaded
+    and remove the local files
+
+    With a manifest, the layers of the tiles that did not run are kept
+    from the last layer group, which is created again if its layers changed.
+    """
+    geoserver_resource_list = [upload_result.get() for upload_result in floodmap_upload['upload_results']]
+    update_layer_group = floodmap_upload['update_layer_group']
+    bounds = None
+    autoroute_manifest = floodmap_upload.get('manifest')
+    if autoroute_manifest:
+        bounds = get_shapefile_layergroup_bounds(floodmap_upload['upload_shapefile_list'])
+        previous_layer_group = autoroute_manifest.get_layer_group(floodmap_upload['return_period'])
+        if not update_layer_group and previous_layer_group is not None:
+            #e.g. a tile that had no flood map before
+            new_resource_list = [geoserver_resource for geoserver_resource in geoserver_resource_list
+                                 if geoserver_resource not in previous_layer_group['layers']]
+            geoserver_resource_list = previous_layer_group['layers'] + new_resource_list
+            bounds = merge_layer_group_bounds(previous_layer_group['bounds'], bounds)
+            update_layer_group = bool(new_resource_list)
+        if update_layer_group or previous_layer_group is not None:
+            autoroute_manifest.set_layer_group(floodmap_upload['return_period'],
+                                               geoserver_resource_list,
+                                               bounds)
+    if update_layer_group:
+        print "Creating Layer Group:", floodmap_upload['layer_group_name']
+        if bounds is None:
+            bounds = get_shapefile_layergroup_bounds(floodmap_upload['upload_shapefile_list'])
+        upload_pipeline.create_layer_group(floodmap_upload['layer_group_name'],
+                                           geoserver_resource_list,
+                                           bounds)
+    else:
+        #the layers of the tiles that ran were replaced in the layer group
+        print "Updated {0} layers of Layer Group: {1}".format(len(floodmap_upload['upload_results']),
+                                                              floodmap_upload['layer_group_name'])
+    #remove local shapefile when done
+    for upload_shapefile in floodmap_upload['upload_shapefile_list']:
+        shapefile_parts = glob("%s*" % os.path.splitext(upload_shapefile)[0])
+        for shapefile_part in shapefile_parts:
+            try:
+                os.remove(shapefile_part)
+            except OSError:
+                pass
+            
+    #remove local directories when done
+    try:
+        os.rmdir(floodmap_upload['output_directory'])
+    except OSError:
+        pass
+
 #----------------------------------------------------------------------------------------
 # MAIN PROCESS
 #----------------------------------------------------------------------------------------
@@ -39,65 +111,139 @@ def run_autorapid_process(autoroute_executable_location, #location of AutoRoute
                           geoserver_url='',
                           geoserver_username='',
                           geoserver_password='',
-                          app_instance_id=''     
+                          app_instance_id='',
+                          num_geoserver_upload_threads=DEFAULT_NUM_UPLOAD_THREADS,
+                          geoserver_upload_retries=DEFAULT_UPLOAD_RETRIES,
+                          skip_unchanged_floodmaps=False,
+                          flow_change_tolerance=DEFAULT_FLOW_CHANGE_TOLERANCE
                           ):
     """
     This it the main AutoRoute-RAPID process
-    """
-    valid_return_period_list = ['max_flow', 'return_period_20', 'return_period_10', 'return_period_2']
 
+    The flood map shapefiles are uploaded to GeoServer by
+    num_geoserver_upload_threads threads as the AutoRoute jobs finish.
+    Failed GeoServer requests are retried geoserver_upload_retries times.
+    The tiles are handled in the order they finish, for all watersheds
+    and return periods.
+
+    The flows of the return periods of a watershed are read from its
+    return period file once and cached next to the watershed outputs
+    (also for the next runs). Each return period is a separate AutoRoute
+    job, which loads the DEM and stream rasters of its tiles.
+
+    If skip_unchanged_floodmaps is True, a manifest of the inputs of the
+    flood maps (hash of the tile files, of the AutoRoute executable and
+    the flows) is kept for each watershed and return period. Only the
+    tiles with changed files or with a reach whose flow changed by more
+    than flow_change_tolerance (relative) are run again. Their GeoServer
+    layers keep their names and are replaced in the layer group, which
+    is created again when all of the tiles run or when a tile has a new
+    layer (the layers of the last layer group are in the manifest).
+    """
     #validate return period list
     for return_period in return_period_list:
-        if return_period not in valid_return_period_list:
-            raise Exception("%s not a valid return period index ...")
+        if return_period not in RETURN_PERIOD_FLOWS:
+            raise Exception("%s not a valid return period index ..." % return_period)
 
     #loop through input watershed folders
     autoroute_input_folder = os.path.join(autoroute_io_files_location, "input")
     autoroute_output_folder = os.path.join(autoroute_io_files_location, "output")
     autoroute_input_directories = get_valid_watershed_list(autoroute_input_folder)
 
-    for return_period in return_period_list:
-        print "Running AutoRoute process for:", return_period
-        #run autorapid for each watershed
-        autoroute_watershed_jobs = {}
-        for autoroute_input_directory in autoroute_input_directories:
-            watershed, subbasin = get_watershed_subbasin_from_folder(autoroute_input_directory)
-            
-            #RAPID file paths
-            master_watershed_rapid_input_directory = os.path.join(rapid_io_files_location, "input", autoroute_input_directory)
-                                                                   
-            if not os.path.exists(master_watershed_rapid_input_directory):
-                print "AutoRoute watershed", autoroute_input_directory, "not in RAPID IO folder. Skipping ..."
-                continue
-            try:
-                return_period_file=case_insensitive_file_search(master_watershed_rapid_input_directory, r'return_period.*?\.nc')
-            except Exception:
-                print "AutoRoute watershed", autoroute_input_directory, "missing return period file. Skipping ..."
-                continue
-            
+    #the outputs of all watersheds and return periods as they finish
+    autoroute_results = AutoRouteResultStream()
+    #the inputs of the jobs, recorded in the manifest when they are done
+    autoroute_job_inputs = {}
+    #the flood maps are uploaded to GeoServer in layer groups
+    geoserver_upload_enabled = bool(GEOSERVER_ENABLED and geoserver_url and geoserver_username
+                                    and geoserver_password and app_instance_id and generate_floodmap_shapefile)
+    if skip_unchanged_floodmaps:
+        autoroute_executable_hash = get_file_sha1(autoroute_executable_location)
+    #run autorapid for each watershed
+    for autoroute_input_directory in autoroute_input_directories:
+        watershed, subbasin = get_watershed_subbasin_from_folder(autoroute_input_directory)
+        
+        #RAPID file paths
+        master_watershed_rapid_input_directory = os.path.join(rapid_io_files_location, "input", autoroute_input_directory)
+                                                               
+        if not os.path.exists(master_watershed_rapid_input_directory):
+            print "AutoRoute watershed", autoroute_input_directory, "not in RAPID IO folder. Skipping ..."
+            continue
+        try:
+            return_period_file=case_insensitive_file_search(master_watershed_rapid_input_directory, r'return_period.*?\.nc')
+        except Exception:
+            print "AutoRoute watershed", autoroute_input_directory, "missing return period file. Skipping ..."
+            continue
+
+        #read the flows of all return periods once
+        master_watershed_autoroute_output_directory = os.path.join(autoroute_output_folder,
+                                                                   autoroute_input_directory)
+        try:
+            os.makedirs(master_watershed_autoroute_output_directory)
+        except OSError:
+            pass
+        return_period_flow_file = os.path.join(master_watershed_autoroute_output_directory,
+                                               'return_period_flows_cache.nc')
+        watershed_return_period_list = cache_return_period_flows(return_period_file,
+                                                                 return_period_flow_file,
+                                                                 return_period_list)
+        for return_period in return_period_list:
+            if return_period not in watershed_return_period_list:
+                print "AutoRoute watershed", autoroute_input_directory, "missing", return_period, "in return period file. Skipping ..."
+
+        autoroute_watershed_directory_path = os.path.join(autoroute_input_folder, autoroute_input_directory)        
+        autoroute_manifest = None
+        if skip_unchanged_floodmaps:
+            autoroute_manifest = AutoRouteManifest(os.path.join(master_watershed_autoroute_output_directory,
+                                                                'autoroute_manifest.json'))
+        for return_period in watershed_return_period_list:
+            return_period_input_directory = autoroute_watershed_directory_path
+            if autoroute_manifest:
+                tiles_to_run, tile_hashes, run_all_tiles = autoroute_manifest.get_tiles_to_run(return_period,
+                                                                                              autoroute_watershed_directory_path,
+                                                                                              return_period_flow_file,
+                                                                                              autoroute_executable_hash,
+                                                                                              flow_change_tolerance,
+                                                                                              geoserver_upload_enabled)
+                if not tiles_to_run:
+                    print "AutoRoute inputs unchanged for", autoroute_input_directory, return_period, ". Skipping ..."
+                    continue
+                tile_subset_directory = None
+                if not run_all_tiles:
+                    print "Running {0} of {1} tiles with changed inputs ...".format(len(tiles_to_run), len(tile_hashes))
+                    tile_subset_directory = os.path.join(master_watershed_autoroute_output_directory,
+                                                         'autoroute_input_{0}'.format(return_period))
+                    return_period_input_directory = link_tile_directories(autoroute_watershed_directory_path,
+                                                                          tiles_to_run,
+                                                                          tile_subset_directory)
+                autoroute_job_inputs[(autoroute_input_directory, return_period)] = {'manifest': autoroute_manifest,
+                                                                                    'tile_hashes': tile_hashes,
+                                                                                    'run_all_tiles': run_all_tiles,
+                                                                                    'return_period_file': return_period_flow_file,
+                                                                                    'tile_subset_directory': tile_subset_directory}
+            print "Running AutoRoute process for:", autoroute_input_directory, return_period
             #setup the output location
-            master_watershed_autoroute_output_directory = os.path.join(autoroute_output_folder,
-                                                                       autoroute_input_directory, 
-                                                                       return_period)
+            master_watershed_return_period_output_directory = os.path.join(master_watershed_autoroute_output_directory,
+                                                                           return_period)
             try:
-                os.makedirs(master_watershed_autoroute_output_directory)
+                os.makedirs(master_watershed_return_period_output_directory)
             except OSError:
                 pass
             #loop through sub-directories
-            autoroute_watershed_directory_path = os.path.join(autoroute_input_folder, autoroute_input_directory)        
-            autoroute_watershed_jobs[autoroute_input_directory] = run_autoroute_multicore(autoroute_executable_location, #location of AutoRoute executable
-                                                                                          autoroute_input_directory=autoroute_watershed_directory_path, #path to AutoRoute input directory
-                                                                                          autoroute_output_directory=master_watershed_autoroute_output_directory, #path to AutoRoute output directory
-                                                                                          return_period=return_period, # return period name in return period file
-                                                                                          return_period_file=return_period_file, # return period file generated from RAPID historical run
-                                                                                          mode="multiprocess", #multiprocess or htcondor
-                                                                                          delete_flood_raster=delete_flood_raster, #delete flood raster generated
-                                                                                          generate_floodmap_shapefile=generate_floodmap_shapefile, #generate a flood map shapefile
-                                                                                          wait_for_all_processes_to_finish=False
-                                                                                          )
+            autoroute_watershed_job = run_autoroute_multicore(autoroute_executable_location, #location of AutoRoute executable
+                                                              autoroute_input_directory=return_period_input_directory, #path to AutoRoute input directory
+                                                              autoroute_output_directory=master_watershed_return_period_output_directory, #path to AutoRoute output directory
+                                                              return_period=return_period, # return period name in return period file
+                                                              return_period_file=return_period_flow_file, # return period flows cached from the RAPID historical run
+                                                              mode="multiprocess", #multiprocess or htcondor
+                                                              delete_flood_raster=delete_flood_raster, #delete flood raster generated
+                                                              generate_floodmap_shapefile=generate_floodmap_shapefile, #generate a flood map shapefile
+                                                              wait_for_all_processes_to_finish=False
+                                                              )
+            autoroute_results.add_job((autoroute_input_directory, return_period),
+                                      autoroute_watershed_job['multiprocess_worker_list'])
     geoserver_manager = None
-    if GEOSERVER_ENABLED and geoserver_url and geoserver_username \
-        and geoserver_password and app_instance_id and generate_floodmap_shapefile:
+    if geoserver_upload_enabled:
         try:
             geoserver_manager = GeoServerDatasetManager(geoserver_url, 
                                                         geoserver_username, 
@@ -111,22 +257,74 @@ def run_autorapid_process(autoroute_executable_location, #location of AutoRoute
     else:
         print "GeoServer parameters incomplete. Skipping upload ..."
         
-    #wait for jobs to finish by watershed
-    for autoroute_watershed_directory, autoroute_watershed_job in autoroute_watershed_jobs.iteritems():
+    upload_pipeline = None
+    if geoserver_manager:
+        #each upload thread keeps its own connection to GeoServer
+        upload_pipeline = GeoServerUploadPipeline(lambda: GeoServerDatasetManager(geoserver_url,
+                                                                                  geoserver_username,
+                                                                                  geoserver_password,
+                                                                                  app_instance_id),
+                                                  num_threads=num_geoserver_upload_threads,
+                                                  max_retries=geoserver_upload_retries,
+                                                  retry_exceptions=(geo_cat_FailedRequestError,),
+                                                  #the connection checked above is used for the layer groups
+                                                  manager=geoserver_manager)
+
+    #handle the tiles as they finish
+    #the shapefiles are uploaded while the other jobs run
+    floodmap_uploads = {}
+    pending_floodmap_uploads = []
+    tile_latencies = []
+    for (autoroute_watershed_directory, return_period), job_output, tile_latency in autoroute_results:
         master_watershed_autoroute_output_directory = os.path.join(autoroute_output_folder,
                                                                    autoroute_watershed_directory, 
                                                                    return_period)
         #time stamped layer name
         geoserver_layer_group_name = "%s-floodmap-%s" % (autoroute_watershed_directory, 
                                                          return_period)
-        geoserver_resource_list = []
-        upload_shapefile_list = []
-        for job_index, job_output in enumerate(autoroute_watershed_job['multiprocess_worker_list']):
+        floodmap_upload = floodmap_uploads.setdefault(geoserver_layer_group_name,
+                                                      {'layer_group_name': geoserver_layer_group_name,
+                                                       'upload_results': [],
+                                                       'upload_shapefile_list': [],
+                                                       'output_directory': master_watershed_autoroute_output_directory,
+                                                       'num_tiles': 0,
+                                                       'update_layer_group': True})
+        autoroute_job_input = autoroute_job_inputs.get((autoroute_watershed_directory, return_period))
+        if autoroute_job_input:
+            floodmap_upload['update_layer_group'] = autoroute_job_input['run_all_tiles']
+            floodmap_upload['manifest'] = autoroute_job_input['manifest']
+            floodmap_upload['return_period'] = return_period
+        if job_output is None:
+            #all of the tiles of the watershed are done
+            print "AutoRoute finished for {0} {1} ({2} tiles) ...".format(autoroute_watershed_directory,
+                                                                          return_period,
+                                                                          floodmap_upload['num_tiles'])
+            if autoroute_job_input:
+                autoroute_job_input['manifest'].set_return_period(return_period,
+                                                                  autoroute_job_input['tile_hashes'],
+                                                                  autoroute_executable_hash,
+                                                                  autoroute_job_input['return_period_file'])
+                if autoroute_job_input['tile_subset_directory']:
+                    shutil.rmtree(autoroute_job_input['tile_subset_directory'])
+            if floodmap_upload['upload_results']:
+                pending_floodmap_uploads.append(floodmap_upload)
+        else:
+            job_index = floodmap_upload['num_tiles']
+            floodmap_upload['num_tiles'] += 1
+            tile_latencies.append(tile_latency)
+            print "AutoRoute tile {0} of {1} {2} finished after {3:.2f} s ...".format(job_index,
+                                                                                      autoroute_watershed_directory,
+                                                                                      return_period,
+                                                                                      tile_latency)
             #upload to GeoServer
-            if geoserver_manager and job_output[1]:
+            if upload_pipeline and job_output[1]:
                 #time stamped layer name
                 geoserver_resource_name = "%s-%s" % (geoserver_layer_group_name,
                                                      job_index)
+                if skip_unchanged_floodmaps:
+                    #the layer of a tile keeps its name between runs, so only the tiles that ran are replaced
+                    geoserver_resource_name = "%s-%s" % (geoserver_layer_group_name,
+                                                         os.path.splitext(os.path.basename(job_output[1]))[0])
                 #upload each shapefile
                 upload_shapefile = os.path.join(master_watershed_autoroute_output_directory, 
                                                 "%s%s" % (geoserver_resource_name, ".shp"))
@@ -136,7 +334,7 @@ def run_autorapid_process(autoroute_executable_location, #location of AutoRoute
                                   os.path.splitext(os.path.basename(job_output[1]))[0])
                                   
                 if os.path.exists(upload_shapefile):
-                    upload_shapefile_list.append(upload_shapefile)
+                    floodmap_upload['upload_shapefile_list'].append(upload_shapefile)
                     print "Uploading", upload_shapefile, "to GeoServer as", geoserver_resource_name
                     shapefile_basename = os.path.splitext(upload_shapefile)[0]
                     #remove past layer if exists
@@ -144,62 +342,30 @@ def run_autorapid_process(autoroute_executable_location, #location of AutoRoute
                     
                     #upload updated layer
                     shapefile_list = glob("%s*" % shapefile_basename)
-                    #Note: Added try, except statement because the request search fails when the app
-                    #deletes the layer after request is made (happens hourly), so the process may throw
-                    #an exception even though it was successful.
-                    """
-                    ...
-                      File "/home/alan/work/scripts/spt_ecmwf_autorapid_process/spt_dataset_manager/dataset_manager.py", line 798, in upload_shapefile
-                        overwrite=True)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/tethys_dataset_services/engines/geoserver_engine.py", line 1288, in create_shapefile_resource
-                        new_resource = catalog.get_resource(name=name, workspace=workspace)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 616, in get_resource
-                        resource = self.get_resource(name, store)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 606, in get_resource
-                        candidates = [s for s in self.get_resources(store) if s.name == name]
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 645, in get_resources
-                        return store.get_resources()
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/store.py", line 58, in get_resources
-                        xml = self.catalog.get_xml(res_url)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 188, in get_xml
-                        raise FailedRequestError("Tried to make a GET request to %s but got a %d status code: \n%s" % (rest_url, response.status, content))
-                    geoserver.catalog.FailedRequestError: ...
-                    """
-                    try:
-                        geoserver_manager.upload_shapefile(geoserver_resource_name, 
-                                                           shapefile_list)
-                    except geo_cat_FailedRequestError as ex:
-                        print ex
-                        print "Most likely OK, but always wise to check ..."
-                        pass
-                                                       
-                    geoserver_resource_list.append(geoserver_manager.get_layer_name(geoserver_resource_name))
+                    floodmap_upload['upload_results'].append(upload_pipeline.upload_shapefile(geoserver_resource_name,
+                                                                                              shapefile_list))
                     #TODO: Upload to CKAN for history of predicted floodmaps?
                 else:
                     print upload_shapefile, "not found. Skipping upload to GeoServer ..."
-        
-        if geoserver_manager and geoserver_resource_list:
-            print "Creating Layer Group:", geoserver_layer_group_name
-            style_list = ['green' for i in range(len(geoserver_resource_list))]
-            bounds = get_shapefile_layergroup_bounds(upload_shapefile_list)
-            geoserver_manager.dataset_engine.create_layer_group(layer_group_id=geoserver_manager.get_layer_name(geoserver_layer_group_name), 
-                                                                layers=tuple(geoserver_resource_list), 
-                                                                styles=tuple(style_list),
-                                                                bounds=tuple(bounds))
-            #remove local shapefile when done
-            for upload_shapefile in upload_shapefile_list:
-                shapefile_parts = glob("%s*" % os.path.splitext(upload_shapefile)[0])
-                for shapefile_part in shapefile_parts:
-                    try:
-                        os.remove(shapefile_part)
-                    except OSError:
-                        pass
-                    
-            #remove local directories when done
-            try:
-                os.rmdir(master_watershed_autoroute_output_directory)
-            except OSError:
-                pass
+
+        #create the layer groups of the watersheds already uploaded
+        for floodmap_upload in [floodmap_upload for floodmap_upload in pending_floodmap_uploads
+                                if all(upload_result.ready() for upload_result in floodmap_upload['upload_results'])]:
+            create_floodmap_layer_group(upload_pipeline, floodmap_upload)
+            pending_floodmap_uploads.remove(floodmap_upload)
+
+    #wait for the uploads that are left
+    for floodmap_upload in pending_floodmap_uploads:
+        create_floodmap_layer_group(upload_pipeline, floodmap_upload)
+    if upload_pipeline:
+        upload_pipeline.close()
+
+    if tile_latencies:
+        print "AutoRoute tile latency: min {0:.2f} s, mean {1:.2f} s, max {2:.2f} s ({3} tiles) ...".format(min(tile_latencies),
+                                                                                                           sum(tile_latencies)/len(tile_latencies),
+                                                                                                           max(tile_latencies),
+                                                                                                           len(tile_latencies))
+    print "AutoRoute makespan: {0:.2f} s ...".format(autoroute_results.get_makespan())
 
 if __name__ == "__main__":
     run_autorapid_process(autoroute_executable_location='/home/alan/work/scripts/AutoRoute/source_code/autoroute',
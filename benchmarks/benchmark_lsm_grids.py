@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+##
+##  benchmark_lsm_grids.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import argparse
+from collections import OrderedDict
+import csv
+from datetime import datetime, timedelta
+import json
+import netCDF4 as NET
+import numpy as NUM
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imports.generate_return_periods import DEFAULT_MAX_MEMORY_MB, generate_return_periods
+from imports.inflow_writer import create_m3_riv_file, M3RivWriter
+from imports.lsm_file_catalog import LSMFileCatalog
+from imports.lsm_grid_detector import LSMGridDetector
+from imports.runoff_prefetcher import DEFAULT_PREFETCH_DEPTH
+from imports import runoff_weight_matrix
+
+ECMWF_INSTITUTION = "European Centre for Medium-Range Weather Forecasts"
+LATITUDE_DIMS = ('latitude', 'lat', 'g0_lat_0', 'north_south', 'south_north')
+
+#synthetic files of each supported grid, with the dimensions and
+#variables (in order) the grid detector and the inflow tools expect
+LSM_GRIDS = OrderedDict([
+    ('t255', {'dims': [('longitude', 720), ('latitude', 361), ('time', 8)],
+              'coordinates': ('latitude', 'longitude'),
+              'runoff_vars': ['ro'],
+              'attributes': {'institution': ECMWF_INSTITUTION},
+              'files_per_day': 1,
+              #accumulated from 0 and 12 UTC
+              'accumulation_steps': 4}),
+    ('t511', {'dims': [('lon', 1024), ('lat', 512), ('time', 8)],
+              'coordinates': ('lat', 'lon'),
+              'runoff_vars': ['RO'],
+              'attributes': {'institution': ECMWF_INSTITUTION},
+              'files_per_day': 1}),
+    ('t159', {'dims': [('longitude', 320), ('latitude', 161), ('time', 8)],
+              'coordinates': ('latitude', 'longitude'),
+              'runoff_vars': ['ro'],
+              'attributes': {'institution': ECMWF_INSTITUTION},
+              'files_per_day': 1}),
+    ('gldas', {'dims': [('g0_lat_0', 600), ('g0_lon_1', 1440)],
+               'coordinates': ('g0_lat_0', 'g0_lon_1'),
+               'runoff_vars': ['SSRUN_GDS0_SFC_ave1h', 'BGRUN_GDS0_SFC_ave1h'],
+               'runoff_units': 'kg/m^2/s',
+               'attributes': {},
+               'files_per_day': 8}),
+    ('nldas', {'dims': [('g0_lat_0', 224), ('g0_lon_1', 464)],
+               'coordinates': ('g0_lat_0', 'g0_lon_1'),
+               'runoff_vars': ['SSRUN_GDS0_SFC_ave1h', 'BGRUN_GDS0_SFC_ave1h'],
+               'runoff_units': 'kg/m^2',
+               'attributes': {},
+               'files_per_day': 24}),
+    ('lis', {'dims': [('time', 1), ('north_south', 600), ('east_west', 800)],
+             'coordinates': ('lat', 'lon'),
+             'runoff_vars': ['Qs_inst', 'Qsb_inst'],
+             'runoff_units': 'kg m-2 s-1',
+             'attributes': {'institution': "NASA GSFC"},
+             'files_per_day': 24}),
+    ('joules', {'dims': [('time', 1), ('north_south', 112), ('east_west', 192)],
+                'coordinates': ('lat', 'lon'),
+                'runoff_vars': ['Qs_inst', 'Qsb_inst'],
+                'runoff_units': 'kg m-2 s-1',
+                'attributes': {'institution': "Met Office, UK"},
+                'files_per_day': 24}),
+    ('wrf_hydro', {'dims': [('Time', 1), ('south_north', 300), ('west_east', 400)],
+                   'coordinates': ('XLAT', 'XLONG'),
+                   'runoff_vars': ['SFROFF', 'UDROFF'],
+                   'attributes': {'TITLE': "OUTPUT FROM WRF V3.7 MODEL"},
+                   'files_per_day': 24,
+                   #accumulated through the whole run
+                   'accumulation_steps': -1}),
+])
+
+def get_grid_dims(lsm_grid):
+    """
+    Names of the time (None without time dimension), latitude and
+    longitude dimensions of a grid
+    """
+    dim_names = [dim_name for dim_name, dim_size in lsm_grid['dims']]
+    time_dim = None
+    for dim_name in dim_names:
+        if dim_name.lower() == 'time':
+            time_dim = dim_name
+    lat_dim = [dim_name for dim_name in dim_names if dim_name in LATITUDE_DIMS][0]
+    lon_dim = [dim_name for dim_name in dim_names if dim_name not in (time_dim, lat_dim)][0]
+    return time_dim, lat_dim, lon_dim
+
+def write_lsm_file(lsm_file, lsm_grid, file_datetime, runoff_data):
+    """
+    Write a synthetic runoff file of a grid. runoff_data has the
+    shape (time, lat, lon) with one time step for the grids
+    without a time dimension.
+    """
+    time_dim, lat_dim, lon_dim = get_grid_dims(lsm_grid)
+    dim_sizes = dict(lsm_grid['dims'])
+    data_out_nc = NET.Dataset(lsm_file, "w", format="NETCDF3_CLASSIC")
+    try:
+        for dim_name, dim_size in lsm_grid['dims']:
+            data_out_nc.createDimension(dim_name, dim_size)
+
+        lat_var_name, lon_var_name = lsm_grid['coordinates']
+        if lat_var_name == lat_dim:
+            #1D coordinates
+            lon_var = data_out_nc.createVariable(lon_var_name, 'f8', (lon_dim,))
+            lon_var[:] = NUM.linspace(0, 360, dim_sizes[lon_dim], endpoint=False)
+            lat_var = data_out_nc.createVariable(lat_var_name, 'f8', (lat_dim,))
+            lat_var[:] = NUM.linspace(90, -90, dim_sizes[lat_dim])
+        else:
+            #2D coordinates
+            lat_var = data_out_nc.createVariable(lat_var_name, 'f4', (lat_dim, lon_dim))
+            lat_var[:] = NUM.linspace(50, 20, dim_sizes[lat_dim])[:, NUM.newaxis].repeat(dim_sizes[lon_dim], axis=1)
+            lon_var = data_out_nc.createVariable(lon_var_name, 'f4', (lat_dim, lon_dim))
+            lon_var[:] = NUM.linspace(-125, -65, dim_sizes[lon_dim])[NUM.newaxis, :].repeat(dim_sizes[lat_dim], axis=0)
+
+        if time_dim == 'time' and lsm_grid['attributes'].get('institution') == ECMWF_INSTITUTION:
+            #hours since 1900, 3 hours apart
+            time_var = data_out_nc.createVariable('time', 'i4', ('time',))
+            time_var.units = "hours since 1900-01-01 00:00:0.0"
+            first_hour = int((file_datetime - datetime(1900, 1, 1)).total_seconds()/3600)
+            time_var[:] = first_hour + 3*NUM.arange(1, dim_sizes['time']+1)
+
+        for runoff_var_name in lsm_grid['runoff_vars']:
+            runoff_dims = (lat_dim, lon_dim) if time_dim is None else (time_dim, lat_dim, lon_dim)
+            runoff_var = data_out_nc.createVariable(runoff_var_name, 'f4', runoff_dims)
+            if 'runoff_units' in lsm_grid:
+                runoff_var.units = lsm_grid['runoff_units']
+            runoff_var[:] = runoff_data[0] if time_dim is None else runoff_data
+
+        data_out_nc.setncatts(lsm_grid['attributes'])
+    finally:
+        data_out_nc.close()
+
+def generate_lsm_files(lsm_data_location, grid_name, lsm_grid, num_days, random_state):
+    """
+    Write the synthetic runoff files of num_days days
+    """
+    time_dim, lat_dim, lon_dim = get_grid_dims(lsm_grid)
+    dim_sizes = dict(lsm_grid['dims'])
+    file_size_time = dim_sizes.get(time_dim, 1)
+    accumulation_steps = lsm_grid.get('accumulation_steps', 0)
+    start_datetime = datetime(2010, 1, 1)
+    file_timedelta = timedelta(days=1)/lsm_grid['files_per_day']
+    accumulated_runoff = NUM.zeros((dim_sizes[lat_dim], dim_sizes[lon_dim]), dtype=NUM.float32)
+    lsm_file_list = []
+    for file_index in xrange(num_days*lsm_grid['files_per_day']):
+        file_datetime = start_datetime + file_index*file_timedelta
+        runoff_data = random_state.gamma(0.5, 0.002, (file_size_time,
+                                                      dim_sizes[lat_dim],
+                                                      dim_sizes[lon_dim])).astype(NUM.float32)
+        if accumulation_steps > 0:
+            runoff_data = runoff_data.reshape((-1, accumulation_steps) + runoff_data.shape[1:]) \
+                                     .cumsum(axis=1).reshape(runoff_data.shape)
+        elif accumulation_steps < 0:
+            runoff_data = accumulated_runoff + runoff_data.cumsum(axis=0)
+            accumulated_runoff = runoff_data[-1]
+
+        lsm_file = os.path.join(lsm_data_location,
+                                "{0}_{1}.nc".format(grid_name, file_datetime.strftime("%Y%m%d%H%M")))
+        write_lsm_file(lsm_file, lsm_grid, file_datetime, runoff_data)
+        lsm_file_list.append(lsm_file)
+    return lsm_file_list
+
+def generate_weight_table(weight_table_file, header_wt, lat_dim_size, lon_dim_size,
+                          num_reaches, watershed_fraction, random_state):
+    """
+    Write a weight table of num_reaches reaches with one to four cells
+    each, in a watershed covering watershed_fraction of the grid
+    """
+    watershed_lat_size = max(1, int(lat_dim_size*watershed_fraction))
+    watershed_lon_size = max(1, int(lon_dim_size*watershed_fraction))
+    watershed_lat_start = random_state.randint(0, lat_dim_size - watershed_lat_size + 1)
+    watershed_lon_start = random_state.randint(0, lon_dim_size - watershed_lon_size + 1)
+    with open(weight_table_file, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(header_wt)
+        for stream_id in xrange(1, num_reaches+1):
+            npoints = random_state.randint(1, 5)
+            reach_lat_index = watershed_lat_start + random_state.randint(0, watershed_lat_size)
+            reach_lon_index = watershed_lon_start + random_state.randint(0, watershed_lon_size)
+            for point_index in xrange(npoints):
+                #neighbouring cells of the reach
+                lat_index = min(lat_dim_size-1, reach_lat_index + point_index // 2)
+                lon_index = min(lon_dim_size-1, reach_lon_index + point_index % 2)
+                writer.writerow([stream_id,
+                                 random_state.uniform(1e4, 1e6),
+                                 lon_index,
+                                 lat_index,
+                                 npoints])
+
+def write_qout_file(qout_file, num_reaches, num_years, time_step, random_state):
+    """
+    Write a synthetic RAPID Qout file with num_years of flows
+    """
+    #one more day, so the years are complete
+    size_time = int((num_years*365.25 + 1)*24*3600/time_step) + 1
+    data_out_nc = NET.Dataset(qout_file, "w", format="NETCDF3_CLASSIC")
+    try:
+        data_out_nc.createDimension('time', size_time)
+        data_out_nc.createDimension('rivid', num_reaches)
+        time_var = data_out_nc.createVariable('time', 'i4', ('time',))
+        time_var.units = "seconds since 1970-01-01 00:00:00"
+        time_var[:] = int((datetime(1980, 1, 1) - datetime(1970, 1, 1)).total_seconds()) \
+                      + time_step*NUM.arange(size_time)
+        rivid_var = data_out_nc.createVariable('rivid', 'i4', ('rivid',))
+        rivid_var[:] = NUM.arange(1, num_reaches+1)
+        data_out_nc.createVariable('lat', 'f8', ('rivid',))[:] = random_state.uniform(-60, 60, num_reaches)
+        data_out_nc.createVariable('lon', 'f8', ('rivid',))[:] = random_state.uniform(-180, 180, num_reaches)
+        qout_var = data_out_nc.createVariable('Qout', 'f4', ('time', 'rivid'))
+        #write a month at a time to bound the memory
+        month_size_time = int(30*24*3600/time_step)
+        for time_index in xrange(0, size_time, month_size_time):
+            time_end = min(time_index + month_size_time, size_time)
+            qout_var[time_index:time_end, :] = random_state.gamma(1.5, 20.0, (time_end-time_index, num_reaches))
+    finally:
+        data_out_nc.close()
+
+def benchmark_lsm_grid(grid_name, work_directory, num_reaches=5000, num_days=1,
+                       watershed_fraction=0.25, return_period_years=2,
+                       prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+                       return_period_max_memory_mb=DEFAULT_MAX_MEMORY_MB, seed=0):
+    """
+    Time the stages of the process on synthetic files of a grid:
+    discovery, detection, weight load, conversion, write and return periods
+    """
+    lsm_grid = LSM_GRIDS[grid_name]
+    random_state = NUM.random.RandomState(seed)
+    grid_directory = os.path.join(work_directory, grid_name)
+    lsm_data_location = os.path.join(grid_directory, 'lsm_data')
+    os.makedirs(lsm_data_location)
+
+    stage_seconds = OrderedDict()
+    time_start = time()
+    lsm_file_list = generate_lsm_files(lsm_data_location, grid_name, lsm_grid, num_days, random_state)
+    generate_seconds = time() - time_start
+
+    #discovery (first run, then a rerun with the catalog up to date)
+    catalog_file = os.path.join(grid_directory, 'lsm_file_catalog.sqlite')
+    time_start = time()
+    lsm_file_catalog = LSMFileCatalog(catalog_file)
+    lsm_file_catalog.refresh(lsm_data_location)
+    cataloged_file_list = lsm_file_catalog.get_files(lsm_data_location)
+    stage_seconds['discovery'] = time() - time_start
+    time_start = time()
+    lsm_file_catalog.refresh(lsm_data_location)
+    lsm_file_catalog.get_files(lsm_data_location)
+    stage_seconds['discovery_cached'] = time() - time_start
+    if len(cataloged_file_list) != len(lsm_file_list):
+        raise Exception("ERROR: {0} of {1} files cataloged ...".format(len(cataloged_file_list),
+                                                                       len(lsm_file_list)))
+
+    #detection (probed, then read from the catalog by a new detector)
+    time_start = time()
+    grid = LSMGridDetector(lsm_file_catalog).detect(lsm_file_catalog.get_header(cataloged_file_list[0]))
+    stage_seconds['detection'] = time() - time_start
+    time_start = time()
+    LSMGridDetector(lsm_file_catalog).detect(lsm_file_catalog.get_header(cataloged_file_list[0]))
+    stage_seconds['detection_cached'] = time() - time_start
+    lsm_file_catalog.close()
+    if grid.grid_type != grid_name:
+        raise Exception("ERROR: {0} files detected as {1} ...".format(grid_name, grid.grid_type))
+
+    #weight load (CSV, then the compiled cache)
+    RAPID_Inflow_Tool = grid.get_inflow_tool()
+    weight_table_file = os.path.join(grid_directory, 'weight_{0}.csv'.format(grid_name))
+    generate_weight_table(weight_table_file, RAPID_Inflow_Tool.header_wt,
+                          grid.lat_dim_size, grid.lon_dim_size,
+                          num_reaches, watershed_fraction, random_state)
+    runoff_weight_matrix._WEIGHT_MATRIX_MEMORY_CACHE.clear()
+    time_start = time()
+    RAPID_Inflow_Tool.readInWeightTable(weight_table_file)
+    stage_seconds['weight_load'] = time() - time_start
+    runoff_weight_matrix._WEIGHT_MATRIX_MEMORY_CACHE.clear()
+    time_start = time()
+    RAPID_Inflow_Tool.readInWeightTable(weight_table_file)
+    stage_seconds['weight_load_cached'] = time() - time_start
+
+    #conversion
+    if grid.num_files_combined > 1:
+        lsm_file_list = [lsm_file_list[file_index:file_index+grid.num_files_combined]
+                         for file_index in range(0, len(lsm_file_list), grid.num_files_combined)
+                         if len(lsm_file_list[file_index:file_index+grid.num_files_combined]) == grid.num_files_combined]
+    time_start = time()
+    m3_riv_blocks = [(time_index, m3_riv_block.astype('f4')) for time_index, m3_riv_block in
+                     RAPID_Inflow_Tool.generateInflowBlocks(nc_file_list=lsm_file_list,
+                                                            index_list=range(len(lsm_file_list)),
+                                                            in_weight_table=weight_table_file,
+                                                            grid_type=grid.grid_type,
+                                                            prefetch_depth=prefetch_depth)]
+    stage_seconds['conversion'] = time() - time_start
+
+    #write
+    rapid_runoff_file = os.path.join(grid_directory, 'm3_riv_{0}.nc'.format(grid_name))
+    total_num_time_steps = sum(len(m3_riv_block) for time_index, m3_riv_block in m3_riv_blocks)
+    time_start = time()
+    create_m3_riv_file(rapid_runoff_file, RAPID_Inflow_Tool.size_streamID, total_num_time_steps)
+    with M3RivWriter(rapid_runoff_file) as inflow_writer:
+        for time_index, m3_riv_block in m3_riv_blocks:
+            inflow_writer.write(time_index, m3_riv_block)
+    stage_seconds['write'] = time() - time_start
+
+    #return periods of a synthetic Qout file of the watershed
+    qout_file = os.path.join(grid_directory, 'Qout_{0}.nc'.format(grid_name))
+    write_qout_file(qout_file, RAPID_Inflow_Tool.size_streamID, return_period_years,
+                    grid.time_step, random_state)
+    time_start = time()
+    generate_return_periods(qout_file,
+                            os.path.join(grid_directory, 'return_periods_{0}.nc'.format(grid_name)),
+                            max_memory_mb=return_period_max_memory_mb)
+    stage_seconds['return_periods'] = time() - time_start
+
+    num_files = num_days*lsm_grid['files_per_day']
+    return {'grid': grid_name,
+            'lat_dim_size': grid.lat_dim_size,
+            'lon_dim_size': grid.lon_dim_size,
+            'file_size_time': grid.file_size_time,
+            'num_files': num_files,
+            'num_reaches': RAPID_Inflow_Tool.size_streamID,
+            'num_cells': RAPID_Inflow_Tool.weight_matrix.size_cells,
+            'num_time_steps': total_num_time_steps,
+            'return_period_years': return_period_years,
+            'generate_seconds': generate_seconds,
+            'stage_seconds': stage_seconds,
+            'files_per_second': num_files/stage_seconds['conversion'] if stage_seconds['conversion'] > 0 else None,
+            'm3_riv_size_bytes': os.path.getsize(rapid_runoff_file)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the stages of the process on synthetic "
+                                                 "runoff files and weight tables of the supported grids")
+    parser.add_argument('--grids', nargs='+', default=list(LSM_GRIDS),
+                        choices=list(LSM_GRIDS))
+    parser.add_argument('--num-reaches', type=int, default=5000,
+                        help="number of river reaches in the weight tables")
+    parser.add_argument('--num-days', type=int, default=1,
+                        help="days of runoff files of each grid")
+    parser.add_argument('--watershed-fraction', type=float, default=0.25,
+                        help="fraction of the grid lat/lon extent covered by the watershed")
+    parser.add_argument('--return-period-years', type=int, default=2,
+                        help="years of flows in the synthetic Qout file")
+    parser.add_argument('--prefetch-depth', type=int, default=DEFAULT_PREFETCH_DEPTH,
+                        help="runoff files read ahead during the conversion")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-directory', default=None,
+                        help="directory for the synthetic files (default: temporary)")
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix='lsm_grid_benchmark_')
+    results = []
+    try:
+        for grid_name in args.grids:
+            result = benchmark_lsm_grid(grid_name,
+                                        work_directory,
+                                        num_reaches=args.num_reaches,
+                                        num_days=args.num_days,
+                                        watershed_fraction=args.watershed_fraction,
+                                        return_period_years=args.return_period_years,
+                                        prefetch_depth=args.prefetch_depth,
+                                        seed=args.seed)
+            print "{grid:10} {lat_dim_size:5}x{lon_dim_size:<5} {num_files:4} files ".format(**result) + \
+                  " ".join("{0} {1:7.3f}s".format(stage, seconds)
+                           for stage, seconds in result['stage_seconds'].iteritems())
+            results.append(result)
+    finally:
+        if args.work_directory is None:
+            shutil.rmtree(work_directory)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
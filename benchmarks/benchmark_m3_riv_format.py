@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+##
+##  benchmark_m3_riv_format.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import argparse
+import json
+import netCDF4 as NET
+import numpy as NUM
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imports.inflow_writer import (create_m3_riv_file, M3RivWriter,
+                                   M3RIV_FORMATS, DEFAULT_MEMORY_BUDGET_MB)
+
+def generate_inflow_block(random_state, size_time, size_rivid, nonzero_fraction):
+    """
+    Synthetic inflow where most of the reaches have no inflow
+    """
+    m3_riv_block = random_state.gamma(2.0, 50.0, (size_time, size_rivid)).astype('f4')
+    m3_riv_block[random_state.random_sample((size_time, size_rivid)) >= nonzero_fraction] = 0
+    return m3_riv_block
+
+def benchmark_m3_riv_format(output_format, work_directory, size_time, size_rivid,
+                            file_size_time=8, nonzero_fraction=0.1, num_read_steps=None,
+                            memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, seed=0):
+    """
+    Time writing the inflow like the single writer (one block per
+    runoff file) and reading it like RAPID (one time step at a time)
+    """
+    out_nc = os.path.join(work_directory, 'm3_riv_{0}.nc'.format(output_format.lower()))
+    random_state = NUM.random.RandomState(seed)
+
+    time_start = time()
+    create_m3_riv_file(out_nc, size_rivid, size_time, output_format=output_format)
+    with M3RivWriter(out_nc, memory_budget_mb=memory_budget_mb) as inflow_writer:
+        for time_index in xrange(0, size_time, file_size_time):
+            inflow_writer.write(time_index,
+                                generate_inflow_block(random_state,
+                                                      min(file_size_time, size_time-time_index),
+                                                      size_rivid,
+                                                      nonzero_fraction))
+    write_seconds = time() - time_start
+
+    if num_read_steps is None:
+        num_read_steps = size_time
+    num_read_steps = min(num_read_steps, size_time)
+    time_start = time()
+    data_in_nc = NET.Dataset(out_nc)
+    m3_riv_var = data_in_nc.variables['m3_riv']
+    for time_index in xrange(num_read_steps):
+        m3_riv_var[time_index, :]
+    data_in_nc.close()
+    read_seconds = time() - time_start
+
+    return {'format': output_format,
+            'size_time': size_time,
+            'size_rivid': size_rivid,
+            'nonzero_fraction': nonzero_fraction,
+            'write_seconds': write_seconds,
+            'read_seconds': read_seconds,
+            'read_time_steps': num_read_steps,
+            'file_size_bytes': os.path.getsize(out_nc)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the write time, read time "
+                                                 "and size of the m3_riv inflow formats")
+    parser.add_argument('--size-time', type=int, default=2920,
+                        help="number of time steps (default: one year 3-hourly)")
+    parser.add_argument('--size-rivid', type=int, default=100000,
+                        help="number of river reaches")
+    parser.add_argument('--file-size-time', type=int, default=8,
+                        help="time steps written per runoff file")
+    parser.add_argument('--nonzero-fraction', type=float, default=0.1,
+                        help="fraction of the inflow values that are not zero")
+    parser.add_argument('--read-steps', type=int, default=None,
+                        help="number of time steps read like RAPID (default: all)")
+    parser.add_argument('--formats', nargs='+', default=list(M3RIV_FORMATS),
+                        choices=M3RIV_FORMATS)
+    parser.add_argument('--work-directory', default=None,
+                        help="directory for the inflow files (default: temporary)")
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix='m3_riv_benchmark_')
+    results = []
+    try:
+        for output_format in args.formats:
+            result = benchmark_m3_riv_format(output_format,
+                                             work_directory,
+                                             args.size_time,
+                                             args.size_rivid,
+                                             file_size_time=args.file_size_time,
+                                             nonzero_fraction=args.nonzero_fraction,
+                                             num_read_steps=args.read_steps)
+            print "{format:16} write {write_seconds:8.2f}s  read {read_seconds:8.2f}s  " \
+                  "size {0:10.1f} MB".format(result['file_size_bytes']/(1024.0*1024.0), **result)
+            results.append(result)
+    finally:
+        if args.work_directory is None:
+            shutil.rmtree(work_directory)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,16 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License: BSD-3 Clause
 
-import csv
 import netCDF4 as NET
 import numpy as NUM
 import os
 
+from inflow_writer import create_m3_riv_file, M3RivWriter
+from runoff_deaccumulation import deaccumulate_runoff
+from runoff_prefetcher import DEFAULT_PREFETCH_DEPTH, NETCDF_READ_LOCK, RunoffFilePrefetcher
+from run_metrics import METRICS
+from runoff_weight_matrix import RunoffWeightMatrix
+
 class CreateInflowFileFromERAInterimRunoff(object):
     def __init__(self):
         """Define the tool (tool name is the name of the class)."""
@@ -23,6 +28,8 @@ class CreateInflowFileFromERAInterimRunoff(object):
         self.dims_oi = [['lon', 'lat', 'time'], ['longitude', 'latitude', 'time']]
         self.vars_oi = [["lon", "lat", "time", "RO"], ['longitude', 'latitude', 'time', 'ro']]
         self.length_time = {"Daily": 1, "3-Hourly": 8}
+        #T255 runoff accumulates from time 0 and 12 (every 4 steps of 3 hours)
+        self.t255_reset_interval = 4
         self.errorMessages = ["Missing Variable 'time'",
                               "Incorrect dimensions in the input ERA Interim runoff file.",
                               "Incorrect variables in the input ERA Interim runoff file.",
@@ -75,74 +82,82 @@ class CreateInflowFileFromERAInterimRunoff(object):
         """
         
         print "Reading the weight table..."
-        self.dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
-                          self.header_wt[3]:[], self.header_wt[4]:[]}
-                     
-        with open(in_weight_table, "rb") as csvfile:
-            reader = csv.reader(csvfile)
-            self.count = 0
-            for row in reader:
-                if self.count == 0:
-                    #check number of columns in the weight table
-                    if len(row) < len(self.header_wt):
-                        raise Exception(self.errorMessages[4])
-                    #check header
-                    if row[1:len(self.header_wt)] != self.header_wt[1:]:
-                        raise Exception(self.errorMessages[5])
-                    self.count += 1
-                else:
-                    for i in xrange(len(self.header_wt)):
-                       self.dict_list[self.header_wt[i]].append(row[i])
-                    self.count += 1
-
-        self.size_streamID = len(set(self.dict_list[self.header_wt[0]]))
-
-    def generateOutputInflowFile(self, out_nc, in_weight_table, tot_size_time):
+        self.weight_matrix = RunoffWeightMatrix.from_weight_table(in_weight_table,
+                                                                  self.header_wt)
+        self.size_streamID = self.weight_matrix.size_streamID
+
+    def generateOutputInflowFile(self, out_nc, in_weight_table, tot_size_time,
+                                 unlimited_time=False, output_format="NETCDF3_CLASSIC"):
         """
-        Generate inflow file for RAPID
+        Generate inflow file for RAPID.
+        With unlimited_time, the Time dimension is unlimited so that
+        the inflow of later runs can be appended to the file.
+        output_format is NETCDF3_CLASSIC or NETCDF4 (chunked and compressed).
         """
 
         self.readInWeightTable(in_weight_table)
         # Create output inflow netcdf data
         print "Generating inflow file"
-        # data_out_nc = NET.Dataset(out_nc, "w") # by default format = "NETCDF4"
-        data_out_nc = NET.Dataset(out_nc, "w", format = "NETCDF3_CLASSIC")
-        dim_Time = data_out_nc.createDimension('Time', tot_size_time)
-        dim_RiverID = data_out_nc.createDimension('rivid', self.size_streamID)
-        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', 
-                                                ('Time', 'rivid'),
-                                                fill_value=0)
-        data_out_nc.close()
-        #empty list to be read in later
-        self.dict_list = {}
+        create_m3_riv_file(out_nc,
+                           self.size_streamID,
+                           tot_size_time,
+                           output_format=output_format,
+                           unlimited_time=unlimited_time)
+        #empty matrix to be read in later
+        self.weight_matrix = None
+
+    def readRunoffSubset(self, nc_file, vars_oi_index, id_data):
+        """
+        Read the weighted cells of a runoff file (run in the prefetch threads)
+        """
+        with NETCDF_READ_LOCK:
+            ''' Read the netcdf dataset'''
+            data_in_nc = NET.Dataset(nc_file)
+            time = data_in_nc.variables[self.vars_oi[vars_oi_index][2]][:]
 
-    def execute(self, nc_file_list, index_list, in_weight_table, 
-                out_nc, grid_type):
-                
-        """The source code of the tool."""
-        if not os.path.exists(out_nc):
-            print "ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ..."
-            raise Exception("ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ...")
-            
+            # Check the size of time variable in the netcdf data
+            size_time = len(time)
+            if size_time != self.length_time[id_data]:
+                data_in_nc.close()
+                raise Exception(self.errorMessages[3])
+
+            # obtain a subset of data with the weighted cells (only the planned tiles are read)
+            data_subset_new = self.weight_matrix.read_subset(data_in_nc.variables[self.vars_oi[vars_oi_index][3]])
+            data_in_nc.close()
+            gathered_bytes = self.weight_matrix.pop_gathered_bytes()
+            METRICS.add(bytes_read=gathered_bytes)
+            print "Gathered {0:.2f} MB from {1} ...".format(gathered_bytes/(1024.0*1024.0),
+                                                          os.path.basename(nc_file))
+        return size_time, data_subset_new
+
+    def calculateRunoffCells(self, data_subset_new, grid_type):
+        """
+        Runoff of the weighted cells in each time step with shape
+        (..., time, cells)
+        """
+        if grid_type == 't255':
+            #A) ERA Interim Low Res (T255) - data is cumulative
+            #from time 3/6/9/12 (time zero not included, so assumed to be zero)
+            #and from time 15/18/21/24 (time restarts at time 12, assumed to be zero)
+            return deaccumulate_runoff(data_subset_new.astype(NUM.float32),
+                                       reset_interval=self.t255_reset_interval)
+        #A) ERA Interim High Res (T511) - data is incremental
+        #from time 3/6/9/12/15/18/21/24
+        return data_subset_new
+
+    def generateInflowBlocks(self, nc_file_list, index_list, in_weight_table, grid_type,
+                             prefetch_depth=DEFAULT_PREFETCH_DEPTH):
+        """
+        Calculate the inflow for each runoff file.
+        Yields the first time index and the inflow block (time x rivid).
+        The next prefetch_depth files are read while one is converted.
+        """
         if len(nc_file_list) != len(index_list):
             print "ERROR: Number of runoff files not equal to number of indices ..."
             raise Exception("ERROR: Number of runoff files not equal to number of indices ...")
         
         self.readInWeightTable(in_weight_table)
-        
-        lon_ind_all = [long(i) for i in self.dict_list[self.header_wt[2]]]
-        lat_ind_all = [long(j) for j in self.dict_list[self.header_wt[3]]]
-
-        # Obtain a subset of  runoff data based on the indices in the weight table
-        min_lon_ind_all = min(lon_ind_all)
-        max_lon_ind_all = max(lon_ind_all)
-        min_lat_ind_all = min(lat_ind_all)
-        max_lat_ind_all = max(lat_ind_all)
-        
-        index_new = []
 
-        data_out_nc = NET.Dataset(out_nc, "a", format = "NETCDF3_CLASSIC")
-        
         # Validate the netcdf dataset
         vars_oi_index = self.dataValidation(nc_file_list[0])
 
@@ -151,70 +166,69 @@ class CreateInflowFileFromERAInterimRunoff(object):
             raise Exception(self.errorMessages[3])
 
         #combine inflow data
-        for nc_file_array_index, nc_file in enumerate(nc_file_list):
+        runoff_files = RunoffFilePrefetcher(lambda nc_file: self.readRunoffSubset(nc_file, vars_oi_index, id_data),
+                                            nc_file_list,
+                                            prefetch_depth=prefetch_depth)
+        for nc_file_array_index, (nc_file, (size_time, data_subset_new)) in enumerate(runoff_files):
             index = index_list[nc_file_array_index]
             
             '''Calculate water inflows'''
             print "Calculating water inflows for", os.path.basename(nc_file) , grid_type, "..."
+            ro_cells = self.calculateRunoffCells(data_subset_new, grid_type)
 
-            ''' Read the netcdf dataset'''
-            data_in_nc = NET.Dataset(nc_file)
-            time = data_in_nc.variables[self.vars_oi[vars_oi_index][2]][:]
+            yield index*size_time, self.weight_matrix.apply(ro_cells)
 
-            # Check the size of time variable in the netcdf data
-            size_time = len(time)
-            if size_time != self.length_time[id_data]:
-                raise Exception(self.errorMessages[3])
+    def generateEnsembleInflowBlocks(self, nc_file_list, index_list, in_weight_table, grid_type,
+                                     prefetch_depth=DEFAULT_PREFETCH_DEPTH):
+        """
+        Calculate the inflow of several ensemble members on the same grid.
+        Each item of nc_file_list is the list of the member files of a time.
+        Yields the first time index and the inflow block (ensemble x time x rivid),
+        calculated for all members in one pass.
+        """
+        if len(nc_file_list) != len(index_list):
+            print "ERROR: Number of runoff files not equal to number of indices ..."
+            raise Exception("ERROR: Number of runoff files not equal to number of indices ...")
+        
+        self.readInWeightTable(in_weight_table)
 
-            data_subset_all = data_in_nc.variables[self.vars_oi[vars_oi_index][3]][:, min_lat_ind_all:max_lat_ind_all+1, min_lon_ind_all:max_lon_ind_all+1]
-            data_in_nc.close()
-            
-            len_time_subset_all = data_subset_all.shape[0]
-            len_lat_subset_all = data_subset_all.shape[1]
-            len_lon_subset_all = data_subset_all.shape[2]
-            data_subset_all = data_subset_all.reshape(len_time_subset_all, (len_lat_subset_all * len_lon_subset_all))
-
-
-            # compute new indices based on the data_subset_all
-            if not index_new:
-                for r in range(0,self.count-1):
-                    ind_lat_orig = lat_ind_all[r]
-                    ind_lon_orig = lon_ind_all[r]
-                    index_new.append((ind_lat_orig - min_lat_ind_all)*len_lon_subset_all + (ind_lon_orig - min_lon_ind_all))
-
-            # obtain a new subset of data
-            data_subset_new = data_subset_all[:,index_new]
-
-            # start compute inflow
-            pointer = 0
-            for stream_index in xrange(self.size_streamID):
-                npoints = int(self.dict_list[self.header_wt[4]][pointer])
-                # Check if all npoints points correspond to the same streamID
-                if len(set(self.dict_list[self.header_wt[0]][pointer : (pointer + npoints)])) != 1:
-                    print "ROW INDEX", pointer
-                    print "COMID", self.dict_list[self.header_wt[0]][pointer]
-                    raise Exception(self.errorMessages[2])
-
-                area_sqm_npoints = [float(k) for k in self.dict_list[self.header_wt[1]][pointer : (pointer + npoints)]]
-                area_sqm_npoints = NUM.array(area_sqm_npoints)
-                area_sqm_npoints = area_sqm_npoints.reshape(1, npoints)
-                data_goal = data_subset_new[:, pointer:(pointer + npoints)]
-
-                if grid_type == 't255':
-                    #A) ERA Interim Low Res (T255) - data is cumulative
-                    data_goal = data_goal.astype(NUM.float32)
-                    #from time 3/6/9/12 (time zero not included, so assumed to be zero)
-                    ro_first_half = NUM.concatenate([data_goal[0:1,], NUM.subtract(data_goal[1:4,], data_goal[0:3,])])
-                    #from time 15/18/21/24 (time restarts at time 12, assumed to be zero)
-                    ro_second_half = NUM.concatenate([data_goal[4:5,], NUM.subtract(data_goal[5:,], data_goal[4:7,])])
-                    ro_stream = NUM.concatenate([ro_first_half, ro_second_half]) * area_sqm_npoints
-                else:
-                    #A) ERA Interim High Res (T511) - data is incremental
-                    #from time 3/6/9/12/15/18/21/24
-                    ro_stream = data_goal * area_sqm_npoints
-
-                data_out_nc.variables['m3_riv'][index*size_time:(index+1)*size_time,stream_index] = ro_stream.sum(axis = 1)
-            
-                pointer += npoints
-        # close the input and output netcdf datasets
-        data_out_nc.close()
\ No newline at end of file
+        # Validate the netcdf dataset
+        vars_oi_index = self.dataValidation(nc_file_list[0][0])
+
+        id_data = self.dataIdentify(nc_file_list[0][0], vars_oi_index)
+        if id_data is None:
+            raise Exception(self.errorMessages[3])
+
+        def read_member_files(member_file_list):
+            """
+            Read the weighted cells of the member files (ensemble x time x cells)
+            """
+            member_data = [self.readRunoffSubset(nc_file, vars_oi_index, id_data)[1]
+                           for nc_file in member_file_list]
+            return self.length_time[id_data], NUM.ma.concatenate([data_subset_new[NUM.newaxis]
+                                                                  for data_subset_new in member_data])
+
+        runoff_files = RunoffFilePrefetcher(read_member_files, nc_file_list,
+                                            prefetch_depth=prefetch_depth)
+        for nc_file_array_index, (member_file_list, (size_time, data_subset_new)) in enumerate(runoff_files):
+            index = index_list[nc_file_array_index]
+
+            '''Calculate water inflows'''
+            print "Calculating water inflows for", os.path.basename(member_file_list[0]), \
+                  "and {0} other members".format(len(member_file_list)-1), grid_type, "..."
+            ro_cells = self.calculateRunoffCells(data_subset_new, grid_type)
+
+            yield index*size_time, self.weight_matrix.apply(ro_cells)
+
+    def execute(self, nc_file_list, index_list, in_weight_table, 
+                out_nc, grid_type):
+                
+        """The source code of the tool."""
+        if not os.path.exists(out_nc):
+            print "ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ..."
+            raise Exception("ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ...")
+
+        with M3RivWriter(out_nc) as inflow_writer:
+            for time_index, m3_riv_block in self.generateInflowBlocks(nc_file_list, index_list,
+                                                                      in_weight_table, grid_type):
+                inflow_writer.write(time_index, m3_riv_block)
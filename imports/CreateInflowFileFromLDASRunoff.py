@@ -7,11 +7,15 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License: BSD-3 Clause
 
-import csv
 import netCDF4 as NET
 import numpy as NUM
 import os
 
+from inflow_writer import create_m3_riv_file, M3RivWriter
+from runoff_prefetcher import DEFAULT_PREFETCH_DEPTH, NETCDF_READ_LOCK, RunoffFilePrefetcher
+from run_metrics import METRICS
+from runoff_weight_matrix import RunoffWeightMatrix
+
 class CreateInflowFileFromLDASRunoff(object):
     def __init__(self, lat_dim="g0_lat_0", 
                        lon_dim="g0_lon_1", 
@@ -59,152 +63,121 @@ class CreateInflowFileFromLDASRunoff(object):
         """
         
         print "Reading the weight table..."
-        self.dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
-                          self.header_wt[3]:[], self.header_wt[4]:[]}
-                     
-        with open(in_weight_table, "rb") as csvfile:
-            reader = csv.reader(csvfile)
-            self.count = 0
-            for row in reader:
-                if self.count == 0:
-                    #check number of columns in the weight table
-                    if len(row) < len(self.dict_list):
-                        raise Exception(self.errorMessages[4])
-                    #check header
-                    if row[1:len(self.header_wt)] != self.header_wt[1:]:
-                        raise Exception(self.errorMessages[5])
-                    self.count += 1
-                else:
-                    for i in xrange(len(self.header_wt)):
-                       self.dict_list[self.header_wt[i]].append(row[i])
-                    self.count += 1
+        self.weight_matrix = RunoffWeightMatrix.from_weight_table(in_weight_table,
+                                                                  self.header_wt)
+        self.size_streamID = self.weight_matrix.size_streamID
 
-        self.size_streamID = len(set(self.dict_list[self.header_wt[0]]))
-
-    def generateOutputInflowFile(self, out_nc, in_weight_table, tot_size_time):
+    def generateOutputInflowFile(self, out_nc, in_weight_table, tot_size_time,
+                                 unlimited_time=False, output_format="NETCDF3_CLASSIC"):
         """
-        Generate inflow file for RAPID
+        Generate inflow file for RAPID.
+        With unlimited_time, the Time dimension is unlimited so that
+        the inflow of later runs can be appended to the file.
+        output_format is NETCDF3_CLASSIC or NETCDF4 (chunked and compressed).
         """
 
         self.readInWeightTable(in_weight_table)
         # Create output inflow netcdf data
         print "Generating inflow file"
-        # data_out_nc = NET.Dataset(out_nc, "w") # by default format = "NETCDF4"
-        data_out_nc = NET.Dataset(out_nc, "w", format = "NETCDF3_CLASSIC")
-        dim_Time = data_out_nc.createDimension('Time', tot_size_time)
-        dim_RiverID = data_out_nc.createDimension('rivid', self.size_streamID)
-        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', 
-                                                ('Time', 'rivid'),
-                                                fill_value=0)
-        data_out_nc.close()
-        #empty list to be read in later
-        self.dict_list = {}
-
-    def execute(self, nc_file_list, index_list, in_weight_table, 
-                out_nc, grid_type):
-                
-        """The source code of the tool."""
-        if not os.path.exists(out_nc):
-            print "ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ..."
-            raise Exception("ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ...")
-            
+        create_m3_riv_file(out_nc,
+                           self.size_streamID,
+                           tot_size_time,
+                           output_format=output_format,
+                           unlimited_time=unlimited_time)
+        #empty matrix to be read in later
+        self.weight_matrix = None
+
+    def generateInflowBlocks(self, nc_file_list, index_list, in_weight_table, grid_type,
+                             prefetch_depth=DEFAULT_PREFETCH_DEPTH):
+        """
+        Calculate the inflow for each runoff file.
+        Yields the first time index and the inflow block (time x rivid).
+        The next prefetch_depth files are read while one is converted.
+        """
         if len(nc_file_list) != len(index_list):
             print "ERROR: Number of runoff files not equal to number of indices ..."
             raise Exception("ERROR: Number of runoff files not equal to number of indices ...")
         
         self.readInWeightTable(in_weight_table)
 
-        #get indices of subset of data
-        lon_ind_all = [long(i) for i in self.dict_list[self.header_wt[2]]]
-        lat_ind_all = [long(j) for j in self.dict_list[self.header_wt[3]]]
+        def read_runoff_files(nc_file_array):
+            """
+            Read the weighted cells of the runoff files combined in one
+            time step (run in the prefetch threads)
+            """
+            if not isinstance(nc_file_array, list): 
+                nc_file_array = [nc_file_array]
 
-        # Obtain a subset of  runoff data based on the indices in the weight table
-        min_lon_ind_all = min(lon_ind_all)
-        max_lon_ind_all = max(lon_ind_all)
-        min_lat_ind_all = min(lat_ind_all)
-        max_lat_ind_all = max(lat_ind_all)
+            runoff_data_list = []
+            for nc_file in nc_file_array:
+                with NETCDF_READ_LOCK:
+                    # Validate the netcdf dataset
+                    vars_oi_index = self.dataValidation(nc_file)
+
+                    #self.dataIdentify(nc_file, vars_oi_index)
+
+                    ''' Read the netcdf dataset'''
+                    data_in_nc = NET.Dataset(nc_file)
+
+                    #check surface and subsurface runoff dims
+                    surface_runoff_shape = data_in_nc.variables[self.vars_oi[2]].shape
+                    subsurface_runoff_shape = data_in_nc.variables[self.vars_oi[3]].shape
+                    #make sure they are the same
+                    if surface_runoff_shape[-2] != subsurface_runoff_shape[-2]:
+                        data_in_nc.close()
+                        raise Exception("Surface and subsurface lat lengths do not agree ...")
+                    if surface_runoff_shape[-1] != subsurface_runoff_shape[-1]:
+                        data_in_nc.close()
+                        raise Exception("Surface and subsurface lon lengths do not agree ...")
+
+                    #obtain a new subset of data with the weighted cells (only the planned tiles are read)
+                    data_subset_surface_new = self.weight_matrix.read_subset(data_in_nc.variables[self.vars_oi[2]])
+                    data_subset_subsurface_new = self.weight_matrix.read_subset(data_in_nc.variables[self.vars_oi[3]])
+                    gathered_bytes = self.weight_matrix.pop_gathered_bytes()
+                    METRICS.add(bytes_read=gathered_bytes)
+                    print "Gathered {0:.2f} MB from {1} ...".format(gathered_bytes/(1024.0*1024.0),
+                                                                  os.path.basename(nc_file))
+                    surface_runoff_units = data_in_nc.variables[self.vars_oi[2]].getncattr("units")
+                    data_in_nc.close()
+                
+                #FILTER DATA
+                #set negative values to zero
+                data_subset_surface_new[data_subset_surface_new<0] = 0
+                data_subset_subsurface_new[data_subset_subsurface_new<0] = 0
+                #set masked values to zero
+                data_subset_surface_new = data_subset_surface_new.filled(fill_value=0)
+                data_subset_subsurface_new = data_subset_subsurface_new.filled(fill_value=0)
+                runoff_data_list.append((nc_file,
+                                         surface_runoff_units,
+                                         data_subset_surface_new,
+                                         data_subset_subsurface_new))
+            return runoff_data_list
 
-        index_new = []
         conversion_factor = None
-        fill_value = None
         
-        # start compute inflow
-        data_out_nc = NET.Dataset(out_nc, "a", format = "NETCDF3_CLASSIC")
-
         #combine inflow data
-        for nc_file_array_index, nc_file_array in enumerate(nc_file_list):
+        runoff_files = RunoffFilePrefetcher(read_runoff_files, nc_file_list,
+                                            prefetch_depth=prefetch_depth)
+        for nc_file_array_index, (nc_file_array, runoff_data_list) in enumerate(runoff_files):
 
             index = index_list[nc_file_array_index]
-            
-            if not isinstance(nc_file_array, list): 
-                nc_file_array = [nc_file_array]
-            else:
-                nc_file_array = nc_file_array
                 
             data_subset_surface_all = None
             data_subset_subsurface_all = None
 
-            for nc_file in nc_file_array:
-                # Validate the netcdf dataset
-                vars_oi_index = self.dataValidation(nc_file)
-
-                #self.dataIdentify(nc_file, vars_oi_index)
-
-                ''' Read the netcdf dataset'''
-                data_in_nc = NET.Dataset(nc_file)
-
+            for nc_file, surface_runoff_units, data_subset_surface_new, data_subset_subsurface_new in runoff_data_list:
                 '''Calculate water inflows'''
                 print "Calculating water inflows for", os.path.basename(nc_file) , grid_type, "..."
-                data_subset_surface_runoff = data_in_nc.variables[self.vars_oi[2]][min_lat_ind_all:max_lat_ind_all+1, min_lon_ind_all:max_lon_ind_all+1]
-                data_subset_subsurface_runoff = data_in_nc.variables[self.vars_oi[3]][min_lat_ind_all:max_lat_ind_all+1, min_lon_ind_all:max_lon_ind_all+1]
-                #check surface runoff dims
-                len_lat_subset_surface = data_subset_surface_runoff.shape[0]
-                len_lon_subset_surface = data_subset_surface_runoff.shape[1]
-                #check subsurface runoff dims
-                len_lat_subset_subsurface = data_subset_surface_runoff.shape[0]
-                len_lon_subset_subsurface = data_subset_surface_runoff.shape[1]
-                #make sure they are the same
-                if len_lat_subset_surface != len_lat_subset_subsurface:
-                    data_in_nc.close()
-                    raise Exception("Surface and subsurface lat lengths do not agree ...")
-                if len_lon_subset_surface != len_lon_subset_subsurface:
-                    data_in_nc.close()
-                    raise Exception("Surface and subsurface lon lengths do not agree ...")
 
                 if conversion_factor == None: 
                     #get conversion_factor
                     conversion_factor = 0.001 #convert from kg/m^2 (i.e. mm) to m
-                    if "s" in data_in_nc.variables[self.vars_oi[2]].getncattr("units"):
+                    if "s" in surface_runoff_units:
                         #that means kg/m^2/s in GLDAS v1 that is 3-hr avg, so multiply
                         #by 3 hr (ex. 3*3600). Assumed same for others (ex. 1*3600).
                         #ftp://hydro1.sci.gsfc.nasa.gov/data/s4pa/GLDAS_V1/README.GLDAS.pdf
                         #If combining files, need to take average of these, so divide by number of files
-                        conversion_factor *= self.time_step_seconds/len(nc_file_array)
-
-                data_in_nc.close()
-
-                #reshape the runoff
-                data_subset_surface_runoff = data_subset_surface_runoff.reshape(len_lat_subset_surface * len_lon_subset_surface)
-                data_subset_subsurface_runoff = data_subset_subsurface_runoff.reshape(len_lat_subset_subsurface * len_lon_subset_subsurface)
-                 
-                if not index_new:
-                    # compute new indices based on the data_subset_surface
-                    for r in range(0,self.count-1):
-                        ind_lat_orig = lat_ind_all[r]
-                        ind_lon_orig = lon_ind_all[r]
-                        index_new.append((ind_lat_orig - min_lat_ind_all)*len_lon_subset_surface + (ind_lon_orig - min_lon_ind_all))
-
-                #obtain a new subset of data
-                data_subset_surface_new = data_subset_surface_runoff[index_new]
-                data_subset_subsurface_new = data_subset_subsurface_runoff[index_new]
-                
-                #FILTER DATA
-                #set negative values to zero
-                data_subset_surface_new[data_subset_surface_new<0] = 0
-                data_subset_subsurface_new[data_subset_subsurface_new<0] = 0
-                #set masked values to zero
-                data_subset_surface_new = data_subset_surface_new.filled(fill_value=0)
-                data_subset_subsurface_new = data_subset_subsurface_new.filled(fill_value=0)
+                        conversion_factor *= self.time_step_seconds/len(runoff_data_list)
 
                 #combine data
                 if data_subset_surface_all is None:
@@ -217,28 +190,19 @@ class CreateInflowFileFromLDASRunoff(object):
                 else:
                     data_subset_subsurface_all = NUM.add(data_subset_subsurface_all, data_subset_subsurface_new)
 
-            pointer = 0
-            for stream_index in xrange(self.size_streamID):
-                npoints = int(self.dict_list[self.header_wt[4]][pointer])
-                # Check if all npoints points correspond to the same streamID
-                if len(set(self.dict_list[self.header_wt[0]][pointer : (pointer + npoints)])) != 1:
-                    print "ROW INDEX", pointer
-                    print "COMID", self.dict_list[self.header_wt[0]][pointer]
-                    raise Exception(self.errorMessages[2])
-
-                area_sqm_npoints = NUM.array([float(k) for k in self.dict_list[self.header_wt[1]][pointer : (pointer + npoints)]])
-                data_goal_surface = data_subset_surface_all[pointer:(pointer + npoints)]
-                data_goal_subsurface = data_subset_subsurface_all[pointer:(pointer + npoints)]
-                ro_stream = NUM.add(data_goal_surface, data_goal_subsurface) * area_sqm_npoints * conversion_factor
-                #filter nan
-                ro_stream = ro_stream[~NUM.isnan(ro_stream)]
-
-                if ro_stream.any():
-                    data_out_nc.variables['m3_riv'][index,stream_index] = ro_stream.sum()
-                else:
-                    data_out_nc.variables['m3_riv'][index,stream_index] = 0
+            #nan and masked values are ignored in the weighting
+            ro_cells = NUM.add(data_subset_surface_all, data_subset_subsurface_all) * conversion_factor
+            yield index, self.weight_matrix.apply(ro_cells, ignore_nan=True)
+
+    def execute(self, nc_file_list, index_list, in_weight_table, 
+                out_nc, grid_type):
                 
-                pointer += npoints
+        """The source code of the tool."""
+        if not os.path.exists(out_nc):
+            print "ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ..."
+            raise Exception("ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ...")
 
-        # close the output netcdf dataset
-        data_out_nc.close()
+        with M3RivWriter(out_nc) as inflow_writer:
+            for time_index, m3_riv_block in self.generateInflowBlocks(nc_file_list, index_list,
+                                                                      in_weight_table, grid_type):
+                inflow_writer.write(time_index, m3_riv_block)
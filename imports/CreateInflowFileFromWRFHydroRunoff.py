@@ -11,10 +11,19 @@
 import os
 import netCDF4 as NET
 import numpy as NUM
-import csv
+
+from inflow_writer import create_m3_riv_file, M3RivWriter
+from runoff_deaccumulation import deaccumulate_runoff
+from runoff_prefetcher import DEFAULT_PREFETCH_DEPTH, NETCDF_READ_LOCK, RunoffFilePrefetcher
+from run_metrics import METRICS
+from runoff_weight_matrix import RunoffWeightMatrix
 
 
 class CreateInflowFileFromWRFHydroRunoff(object):
+    #the runoff accumulates from one file to the next, so the jobs
+    #need the file before their first file
+    runoff_accumulated_across_files = True
+
     def __init__(self, lat_dim="south_north",
                  lon_dim="west_east",
                  lat_var="XLAT",
@@ -57,55 +66,63 @@ class CreateInflowFileFromWRFHydroRunoff(object):
         """
         
         print "Reading the weight table..."
-        self.dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
-                          self.header_wt[3]:[], self.header_wt[4]:[]}
-                     
-        with open(in_weight_table, "rb") as csvfile:
-            reader = csv.reader(csvfile)
-            self.count = 0
-            for row in reader:
-                if self.count == 0:
-                    #check number of columns in the weight table
-                    if len(row) < len(self.header_wt):
-                        raise Exception(self.errorMessages[4])
-                    #check header
-                    if row[1:len(self.header_wt)] != self.header_wt[1:]:
-                        raise Exception(self.errorMessages[5])
-                    self.count += 1
-                else:
-                    for i in xrange(len(self.header_wt)):
-                       self.dict_list[self.header_wt[i]].append(row[i])
-                    self.count += 1
+        self.weight_matrix = RunoffWeightMatrix.from_weight_table(in_weight_table,
+                                                                  self.header_wt)
+        self.size_streamID = self.weight_matrix.size_streamID
 
-        self.size_streamID = len(set(self.dict_list[self.header_wt[0]]))
-
-    def generateOutputInflowFile(self, out_nc, in_weight_table, tot_size_time):
+    def generateOutputInflowFile(self, out_nc, in_weight_table, tot_size_time,
+                                 unlimited_time=False, output_format="NETCDF3_CLASSIC"):
         """
-        Generate inflow file for RAPID
+        Generate inflow file for RAPID.
+        With unlimited_time, the Time dimension is unlimited so that
+        the inflow of later runs can be appended to the file.
+        output_format is NETCDF3_CLASSIC or NETCDF4 (chunked and compressed).
         """
 
         self.readInWeightTable(in_weight_table)
         # Create output inflow netcdf data
         print "Generating inflow file"
-        data_out_nc = NET.Dataset(out_nc, "w", format = "NETCDF3_CLASSIC")
-        dim_Time = data_out_nc.createDimension('Time', tot_size_time)
-        dim_RiverID = data_out_nc.createDimension('rivid', self.size_streamID)
-        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', 
-                                                ('Time', 'rivid'),
-                                                fill_value=0)
-        data_out_nc.close()
-        #empty list to be read in later
-        self.dict_list = {}
+        create_m3_riv_file(out_nc,
+                           self.size_streamID,
+                           tot_size_time,
+                           output_format=output_format,
+                           unlimited_time=unlimited_time)
+        #empty matrix to be read in later
+        self.weight_matrix = None
         
-    def execute(self, nc_file_list, index_list, in_weight_table, 
-                out_nc, grid_type):
-        """The source code of the tool."""
+    def readLastRunoffStep(self, nc_file_array):
+        """
+        Read the cumulative runoff of the weighted cells in the last
+        time step of the runoff files
+        """
+        if not isinstance(nc_file_array, list): 
+            nc_file_array = [nc_file_array]
 
-        """The source code of the tool."""
-        if not os.path.exists(out_nc):
-            print "ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ..."
-            raise Exception("ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ...")
-            
+        last_runoff = None
+        for nc_file in nc_file_array:
+            with NETCDF_READ_LOCK:
+                data_in_nc = NET.Dataset(nc_file)
+                last_time_index = (slice(len(data_in_nc.dimensions['Time'])-1, None),)
+                data_last_step = self.weight_matrix.read_subset(data_in_nc.variables[self.vars_oi[2]], last_time_index)/1000 \
+                                 + self.weight_matrix.read_subset(data_in_nc.variables[self.vars_oi[3]], last_time_index)/1000
+                data_in_nc.close()
+                METRICS.add(bytes_read=self.weight_matrix.pop_gathered_bytes())
+            if last_runoff is None:
+                last_runoff = data_last_step[-1]
+            else:
+                last_runoff = NUM.add(last_runoff, data_last_step[-1])
+        return last_runoff
+
+    def generateInflowBlocks(self, nc_file_list, index_list, in_weight_table, grid_type,
+                             prefetch_depth=DEFAULT_PREFETCH_DEPTH, previous_nc_file=None):
+        """
+        Calculate the inflow for each runoff file.
+        Yields the first time index and the inflow block (time x rivid).
+        The next prefetch_depth files are read while one is converted.
+        previous_nc_file is the runoff file before the first one, whose
+        last time step is subtracted from the first one (None if the
+        runoff accumulates from the first file).
+        """
         if len(nc_file_list) != len(index_list):
             print "ERROR: Number of runoff files not equal to number of indices ..."
             raise Exception("ERROR: Number of runoff files not equal to number of indices ...")
@@ -113,106 +130,87 @@ class CreateInflowFileFromWRFHydroRunoff(object):
         self.readInWeightTable(in_weight_table)
         
         #get time size
-        data_in_nc = NET.Dataset(nc_file_list[0])
+        first_nc_file = nc_file_list[0][0] if isinstance(nc_file_list[0], list) else nc_file_list[0]
+        data_in_nc = NET.Dataset(first_nc_file)
         size_time = len(data_in_nc.dimensions['Time'])
         data_in_nc.close()
 
-        #get indices of subset of data
-        we_ind_all = [long(i) for i in self.dict_list[self.header_wt[2]]]
-        sn_ind_all = [long(j) for j in self.dict_list[self.header_wt[3]]]
-
-        # Obtain a subset of  runoff data based on the indices in the weight table
-        min_we_ind_all = min(we_ind_all)
-        max_we_ind_all = max(we_ind_all)
-        min_sn_ind_all = min(sn_ind_all)
-        max_sn_ind_all = max(sn_ind_all)
-        
-        index_new = []
-        conversion_factor = None
-        
-        # start compute inflow
-        data_out_nc = NET.Dataset(out_nc, "a", format = "NETCDF3_CLASSIC")
-        
-        #combine inflow data
-        for nc_file_array_index, nc_file_array in enumerate(nc_file_list):
-
-            index = index_list[nc_file_array_index]
-            
+        def read_runoff_files(nc_file_array):
+            """
+            Read and combine the weighted cells of the runoff files
+            (run in the prefetch threads)
+            """
             if not isinstance(nc_file_array, list): 
                 nc_file_array = [nc_file_array]
-            else:
-                nc_file_array = nc_file_array
                 
             full_data_subset = None
 
             for nc_file in nc_file_array:
-                # Validate the netcdf dataset
-                vars_oi_index = self.dataValidation(nc_file)
-
-                #self.dataIdentify(nc_file, vars_oi_index)
-
-                ''' Read the netcdf dataset'''
-                data_in_nc = NET.Dataset(nc_file)
-
-                '''Calculate water inflows'''
-                print "Calculating water inflows for", os.path.basename(nc_file) , grid_type, "..."
-
-                data_subset_all = data_in_nc.variables[self.vars_oi[2]][:,min_sn_ind_all:max_sn_ind_all+1, min_we_ind_all:max_we_ind_all+1]/1000 \
-                                + data_in_nc.variables[self.vars_oi[3]][:,min_sn_ind_all:max_sn_ind_all+1, min_we_ind_all:max_we_ind_all+1]/1000
-                len_time_subset_all = data_subset_all.shape[0]
-                len_sn_subset_all = data_subset_all.shape[1]
-                len_we_subset_all = data_subset_all.shape[2]
-                data_subset_all = data_subset_all.reshape(len_time_subset_all, (len_sn_subset_all * len_we_subset_all))
-
-
-                # compute new indices based on the data_subset_all
-                index_new = []
-                for r in range(0,self.count-1):
-                    ind_sn_orig = sn_ind_all[r]
-                    ind_we_orig = we_ind_all[r]
-                    index_new.append((ind_sn_orig - min_sn_ind_all)*len_we_subset_all + (ind_we_orig - min_we_ind_all))
-
-                # obtain a new subset of data
-                data_subset_new = data_subset_all[:,index_new]
+                with NETCDF_READ_LOCK:
+                    # Validate the netcdf dataset
+                    vars_oi_index = self.dataValidation(nc_file)
+
+                    #self.dataIdentify(nc_file, vars_oi_index)
+
+                    ''' Read the netcdf dataset'''
+                    data_in_nc = NET.Dataset(nc_file)
+
+                    # obtain a subset of data with the weighted cells (only the planned tiles are read)
+                    data_subset_new = self.weight_matrix.read_subset(data_in_nc.variables[self.vars_oi[2]])/1000 \
+                                      + self.weight_matrix.read_subset(data_in_nc.variables[self.vars_oi[3]])/1000
+                    data_in_nc.close()
+                    gathered_bytes = self.weight_matrix.pop_gathered_bytes()
+                    METRICS.add(bytes_read=gathered_bytes)
+                    print "Gathered {0:.2f} MB from {1} ...".format(gathered_bytes/(1024.0*1024.0),
+                                                                  os.path.basename(nc_file))
                 
                 #combine data
                 if full_data_subset is None:
                     full_data_subset = data_subset_new
                 else:
                     full_data_subset = NUM.add(full_data_subset, data_subset_new)
+            return full_data_subset
 
+        #cumulative runoff before the current file
+        previous_runoff = None
+        previous_index = None
+        if previous_nc_file is not None:
+            previous_runoff = self.readLastRunoffStep(previous_nc_file)
+            previous_index = index_list[0] - 1
+
+        #combine inflow data
+        runoff_files = RunoffFilePrefetcher(read_runoff_files, nc_file_list,
+                                            prefetch_depth=prefetch_depth)
+        for nc_file_array_index, (nc_file_array, full_data_subset) in enumerate(runoff_files):
+
+            index = index_list[nc_file_array_index]
+            if previous_index != index - 1:
+                previous_runoff = None
+
+            '''Calculate water inflows'''
+            nc_file = nc_file_array[0] if isinstance(nc_file_array, list) else nc_file_array
+            print "Calculating water inflows for", os.path.basename(nc_file) , grid_type, "..."
+
+            ''''IMPORTANT NOTE: runoff variables in WRF-Hydro dataset is cumulative through time'''
+            #the last time step is carried over to the next file
+            last_runoff = NUM.ma.array(full_data_subset[-1], copy=True)
+            ro_cells = deaccumulate_runoff(full_data_subset,
+                                           previous_runoff=previous_runoff)
+            previous_runoff = last_runoff
+            previous_index = index
+            #masked values are ignored in the weighting
+            yield index*size_time, self.weight_matrix.apply(ro_cells)
+
+    def execute(self, nc_file_list, index_list, in_weight_table, 
+                out_nc, grid_type, previous_nc_file=None):
+                
+        """The source code of the tool."""
+        if not os.path.exists(out_nc):
+            print "ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ..."
+            raise Exception("ERROR: Outfile has not been created. You need to run: generateOutputInflowFile function ...")
 
-            # start compute inflow
-            len_wt = len(self.dict_list[self.header_wt[0]])
-            pointer = 0
-            for stream_index in xrange(self.size_streamID):
-                npoints = int(self.dict_list[self.header_wt[4]][pointer])
-                # Check if all npoints points correspond to the same streamID
-                if len(set(self.dict_list[self.header_wt[0]][pointer : (pointer + npoints)])) != 1:
-                    print "ROW INDEX", pointer
-                    print "COMID", self.dict_list[self.header_wt[0]][pointer]
-                    raise Exception(self.errorMessages[2])
-
-                area_sqm_npoints = [float(k) for k in self.dict_list[self.header_wt[1]][pointer : (pointer + npoints)]]
-                area_sqm_npoints = NUM.array(area_sqm_npoints)
-                area_sqm_npoints = area_sqm_npoints.reshape(1, npoints)
-                data_goal = full_data_subset[:, pointer:(pointer + npoints)]
-
-                ''''IMPORTANT NOTE: runoff variables in WRF-Hydro dataset is cumulative through time'''
-                ro_stream = NUM.concatenate([data_goal[0:1,],
-                            NUM.subtract(data_goal[1:,],data_goal[:-1,])]) * area_sqm_npoints
-                try:
-                    #ignore masked values
-                    if ro_stream.sum() is NUM.ma.masked:
-                        data_out_nc.variables['m3_riv'][index*size_time:(index+1)*size_time,stream_index] = 0
-                    else:
-                        data_out_nc.variables['m3_riv'][index*size_time:(index+1)*size_time,stream_index] = ro_stream.sum(axis=1)
-                except ValueError:
-                    print "M3", len(data_out_nc.variables['m3_riv'][index*size_time:(index+1)*size_time,stream_index]), data_out_nc.variables['m3_riv'][index*size_time:(index+1)*size_time,stream_index]
-                    print "RO", len(ro_stream.sum(axis=1)), ro_stream.sum(axis=1)
-                    raise
-
-                pointer += npoints
-
-
-        data_out_nc.close()
+        with M3RivWriter(out_nc) as inflow_writer:
+            for time_index, m3_riv_block in self.generateInflowBlocks(nc_file_list, index_list,
+                                                                      in_weight_table, grid_type,
+                                                                      previous_nc_file=previous_nc_file):
+                inflow_writer.write(time_index, m3_riv_block)
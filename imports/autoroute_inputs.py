@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+##
+##  autoroute_inputs.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import netCDF4 as NET
+import os
+
+#flow variables of the return period file
+RETURN_PERIOD_FLOWS = ['max_flow', 'return_period_20', 'return_period_10', 'return_period_2']
+
+def cache_return_period_flows(return_period_file, cache_file, return_period_list):
+    """
+    Copy the reaches and the flows of the return periods in
+    return_period_list to cache_file, reading the return period file
+    once for all of them. The cache is kept for the next runs until the
+    return period file changes.
+
+    Returns the return periods found in the file.
+    """
+    if os.path.exists(cache_file) \
+            and os.path.getmtime(cache_file) >= os.path.getmtime(return_period_file):
+        with NET.Dataset(cache_file) as cache_nc:
+            #the return periods looked for, so a missing one is not looked for again
+            cached_return_periods = getattr(cache_nc, 'cached_flows', '').split()
+            if all(return_period in cached_return_periods for return_period in return_period_list):
+                print "Using cached return period flows {0} ...".format(cache_file)
+                return [return_period for return_period in return_period_list
+                        if return_period in cache_nc.variables]
+
+    print "Caching return period flows of {0} ...".format(return_period_file)
+    with NET.Dataset(return_period_file) as return_period_nc:
+        available_return_periods = [return_period for return_period in return_period_list
+                                    if return_period in return_period_nc.variables]
+        with NET.Dataset(cache_file + "_tmp", 'w', format=return_period_nc.data_model) as cache_nc:
+            cache_nc.setncatts(dict((attr, return_period_nc.getncattr(attr))
+                                    for attr in return_period_nc.ncattrs()))
+            cache_nc.cached_flows = " ".join(return_period_list)
+            for dim_name, dim in return_period_nc.dimensions.iteritems():
+                cache_nc.createDimension(dim_name, None if dim.isunlimited() else len(dim))
+            for var_name, var in return_period_nc.variables.iteritems():
+                #the other return periods are not needed
+                if var_name in RETURN_PERIOD_FLOWS and var_name not in available_return_periods:
+                    continue
+                fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+                cache_var = cache_nc.createVariable(var_name, var.dtype, var.dimensions,
+                                                    fill_value=fill_value)
+                cache_var.setncatts(dict((attr, var.getncattr(attr)) for attr in var.ncattrs()
+                                         if attr != '_FillValue'))
+                cache_var[:] = var[:]
+
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    os.rename(cache_file + "_tmp", cache_file)
+    return available_return_periods
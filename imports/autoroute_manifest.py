@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+##
+##  autoroute_manifest.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import hashlib
+import json
+import netCDF4 as NET
+import numpy as NUM
+import os
+import re
+import shutil
+GDAL_ENABLED = False
+try:
+    from osgeo import gdal
+    GDAL_ENABLED = True
+except ImportError:
+    pass
+
+#relative change of the flow of a reach for its tiles to be run again
+DEFAULT_FLOW_CHANGE_TOLERANCE = 0.01
+
+def get_file_sha1(file_path, block_size=16*1024*1024):
+    """
+    SHA-1 of the content of a file
+    """
+    file_sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(block_size), b''):
+            file_sha1.update(block)
+    return file_sha1.hexdigest()
+
+def get_tile_directories(autoroute_input_directory):
+    """
+    Sorted list of the tile directories of an AutoRoute watershed
+    """
+    return sorted(tile_name for tile_name in os.listdir(autoroute_input_directory)
+                  if os.path.isdir(os.path.join(autoroute_input_directory, tile_name)))
+
+def read_tile_rivids(tile_directory):
+    """
+    River IDs in the stream raster of a tile
+    (None if they cannot be read, so the tile runs on any flow change)
+    """
+    if not GDAL_ENABLED:
+        return None
+    stream_rasters = [file_name for file_name in os.listdir(tile_directory)
+                      if re.search(r'stream.*?\.(tif|img|asc)$', file_name, re.IGNORECASE)]
+    if len(stream_rasters) != 1:
+        return None
+    stream_raster = gdal.Open(os.path.join(tile_directory, stream_rasters[0]))
+    if stream_raster is None:
+        return None
+    stream_band = stream_raster.GetRasterBand(1)
+    no_data_value = stream_band.GetNoDataValue()
+    tile_rivids = set()
+    #read the raster in blocks of rows
+    num_rows_block = max(1, 16*1024*1024/(8*stream_raster.RasterXSize))
+    for row_start in xrange(0, stream_raster.RasterYSize, num_rows_block):
+        num_rows = min(num_rows_block, stream_raster.RasterYSize-row_start)
+        stream_ids = NUM.unique(stream_band.ReadAsArray(0, row_start, stream_raster.RasterXSize, num_rows))
+        tile_rivids.update(int(stream_id) for stream_id in stream_ids
+                           if stream_id > 0 and stream_id != no_data_value)
+    return sorted(tile_rivids)
+
+class AutoRouteManifest(object):
+    """
+    Inputs of the last flood maps of a watershed: the hash of the files
+    of each tile, of the AutoRoute executable and the flows of each
+    return period, so the tiles with the same inputs are skipped.
+
+    A tile runs again if its files or the executable changed or if the
+    flow of one of its reaches changed by more than flow_change_tolerance
+    (relative) since its last run. The layers of the last layer group of
+    each return period are kept, so the layers of the tiles that did not
+    run stay in the group.
+    """
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.manifest = {'files': {}, 'tiles': {}, 'return_periods': {}, 'layer_groups': {}}
+        #reaches with changed flows of the return periods that run
+        self.changed_rivids = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as manifest_json:
+                self.manifest.update(json.load(manifest_json))
+
+    def get_file_hash(self, file_path):
+        """
+        Hash of a file, computed again only if its size or time changed
+        """
+        file_stat = os.stat(file_path)
+        file_record = self.manifest['files'].get(file_path)
+        if file_record is None or file_record[:2] != [file_stat.st_size, file_stat.st_mtime]:
+            file_record = [file_stat.st_size, file_stat.st_mtime, get_file_sha1(file_path)]
+            self.manifest['files'][file_path] = file_record
+        return file_record[2]
+
+    def get_tile_hash(self, tile_directory):
+        """
+        Hash of the names and content of the input files of a tile
+        """
+        tile_sha1 = hashlib.sha1()
+        for root, dirs, files in os.walk(tile_directory):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                tile_sha1.update(os.path.relpath(file_path, tile_directory))
+                tile_sha1.update(self.get_file_hash(file_path))
+        return tile_sha1.hexdigest()
+
+    def get_tile_rivids(self, tile_directory, tile_hash):
+        """
+        River IDs of a tile, read again only if the tile changed
+        """
+        tile_record = self.manifest['tiles'].get(tile_directory)
+        if tile_record is None or tile_record['hash'] != tile_hash:
+            tile_record = {'hash': tile_hash,
+                           'rivids': read_tile_rivids(tile_directory)}
+            self.manifest['tiles'][tile_directory] = tile_record
+        return tile_record['rivids']
+
+    def _get_flow_file(self, return_period):
+        return os.path.join(os.path.dirname(self.manifest_file),
+                            'autoroute_flows_{0}.npz'.format(return_period))
+
+    def get_changed_rivids(self, return_period, rivids, flows, flow_change_tolerance):
+        """
+        River IDs with a flow that changed since the last run
+        (None if all changed)
+        """
+        flow_file = self._get_flow_file(return_period)
+        if return_period not in self.manifest['return_periods'] \
+                or not os.path.exists(flow_file):
+            return None
+        previous_flows = NUM.load(flow_file)
+        previous_rivids = previous_flows['rivid']
+        if len(previous_rivids) == 0:
+            return None
+        previous_index = NUM.searchsorted(previous_rivids, rivids)
+        previous_index[previous_index >= len(previous_rivids)] = 0
+        new_rivids = previous_rivids[previous_index] != rivids
+        previous_flow = previous_flows['flow'][previous_index]
+        changed_flows = NUM.abs(flows - previous_flow) > flow_change_tolerance*NUM.abs(previous_flow)
+        return set(rivids[new_rivids | changed_flows].tolist())
+
+    def get_tiles_to_run(self, return_period, autoroute_input_directory, return_period_file,
+                         executable_hash, flow_change_tolerance=DEFAULT_FLOW_CHANGE_TOLERANCE,
+                         layer_group_required=False):
+        """
+        Tiles of a return period with changed inputs.
+        With layer_group_required, all of the tiles run if the layers of
+        the layer group of the return period are not known.
+        Returns (tile names, tile hashes, True if all of the tiles run).
+        """
+        tile_names = get_tile_directories(autoroute_input_directory)
+        tile_hashes = dict((tile_name, self.get_tile_hash(os.path.join(autoroute_input_directory, tile_name)))
+                           for tile_name in tile_names)
+        return_period_record = self.manifest['return_periods'].get(return_period)
+        #new tiles or another AutoRoute executable change all flood maps
+        if return_period_record is None \
+                or return_period_record['executable_hash'] != executable_hash \
+                or sorted(return_period_record['tile_hashes']) != tile_names \
+                or (layer_group_required and return_period not in self.manifest['layer_groups']):
+            return tile_names, tile_hashes, True
+
+        with NET.Dataset(return_period_file) as return_period_nc:
+            rivids = NUM.array(return_period_nc.variables['rivid'][:])
+            flows = NUM.array(return_period_nc.variables[return_period][:])
+        sort_index = NUM.argsort(rivids)
+        changed_rivids = self.get_changed_rivids(return_period,
+                                                 rivids[sort_index],
+                                                 flows[sort_index],
+                                                 flow_change_tolerance)
+        self.changed_rivids[return_period] = changed_rivids
+
+        tiles_to_run = []
+        for tile_name in tile_names:
+            if return_period_record['tile_hashes'][tile_name] != tile_hashes[tile_name] \
+                    or changed_rivids is None:
+                tiles_to_run.append(tile_name)
+                continue
+            tile_rivids = self.get_tile_rivids(os.path.join(autoroute_input_directory, tile_name),
+                                               tile_hashes[tile_name])
+            if tile_rivids is None:
+                if changed_rivids:
+                    tiles_to_run.append(tile_name)
+            elif changed_rivids.intersection(tile_rivids):
+                tiles_to_run.append(tile_name)
+        return tiles_to_run, tile_hashes, len(tiles_to_run) == len(tile_names)
+
+    def set_return_period(self, return_period, tile_hashes, executable_hash, return_period_file):
+        """
+        Record the inputs of the flood maps of a return period once they are done
+        """
+        with NET.Dataset(return_period_file) as return_period_nc:
+            rivids = NUM.array(return_period_nc.variables['rivid'][:])
+            flows = NUM.array(return_period_nc.variables[return_period][:])
+        sort_index = NUM.argsort(rivids)
+        rivids = rivids[sort_index]
+        flows = flows[sort_index]
+        flow_file = self._get_flow_file(return_period)
+        changed_rivids = self.changed_rivids.pop(return_period, None)
+        if changed_rivids is not None:
+            #the reaches within the tolerance keep the flow of their last run,
+            #so small changes do not add up between runs
+            previous_flows = NUM.load(flow_file)
+            previous_index = NUM.searchsorted(previous_flows['rivid'], rivids)
+            previous_index[previous_index >= len(previous_flows['rivid'])] = 0
+            unchanged_flows = (previous_flows['rivid'][previous_index] == rivids) \
+                              & ~NUM.in1d(rivids, list(changed_rivids))
+            flows[unchanged_flows] = previous_flows['flow'][previous_index[unchanged_flows]]
+        with open(flow_file + "_tmp", 'wb') as flow_npz:
+            NUM.savez(flow_npz, rivid=rivids, flow=flows)
+        shutil.move(flow_file + "_tmp", flow_file)
+        self.manifest['return_periods'][return_period] = {'executable_hash': executable_hash,
+                                                          'tile_hashes': tile_hashes}
+        self.save()
+
+    def get_layer_group(self, return_period):
+        """
+        Layers and bounds of the last layer group of a return period
+        (None if unknown)
+        """
+        return self.manifest['layer_groups'].get(return_period)
+
+    def set_layer_group(self, return_period, layer_list, bounds):
+        """
+        Record the layers and bounds of the layer group of a return period
+        """
+        self.manifest['layer_groups'][return_period] = {'layers': list(layer_list),
+                                                        'bounds': list(bounds)}
+        self.save()
+
+    def save(self):
+        """
+        Write the manifest file (replaced at once)
+        """
+        with open(self.manifest_file + "_tmp", 'w') as manifest_json:
+            json.dump(self.manifest, manifest_json, indent=1, sort_keys=True)
+        shutil.move(self.manifest_file + "_tmp", self.manifest_file)
+
+def link_tile_directories(autoroute_input_directory, tile_names, subset_directory):
+    """
+    Directory with links to some of the tiles of a watershed, so that
+    AutoRoute runs only these
+    """
+    if os.path.exists(subset_directory):
+        shutil.rmtree(subset_directory)
+    os.makedirs(subset_directory)
+    for tile_name in tile_names:
+        os.symlink(os.path.abspath(os.path.join(autoroute_input_directory, tile_name)),
+                   os.path.join(subset_directory, tile_name))
+    return subset_directory
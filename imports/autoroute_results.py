@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+##
+##  autoroute_results.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import Queue
+import threading
+from time import time
+
+class AutoRouteResultStream(object):
+    """
+    Yields the outputs of the AutoRoute jobs of all watersheds in the
+    order they finish, so a fast watershed does not wait for a slow one.
+
+    A thread collects the outputs of each watershed (the
+    multiprocess_worker_list of run_autoroute_multicore) into one queue.
+    The latency of each tile is the time from the start of its
+    watershed to the end of the tile.
+    """
+    def __init__(self):
+        self.result_queue = Queue.Queue()
+        self.job_start_times = {}
+        self.num_running_jobs = 0
+        self.time_start = None
+
+    def _collect_outputs(self, job_key, worker_list):
+        """
+        Send the outputs of a watershed to the queue (run in a thread)
+        """
+        try:
+            for job_output in worker_list:
+                self.result_queue.put((job_key, job_output, time(), None))
+        except Exception as ex:
+            self.result_queue.put((job_key, None, time(), ex))
+        self.result_queue.put((job_key, None, time(), None))
+
+    def add_job(self, job_key, worker_list, time_start=None):
+        """
+        Add the worker list of the AutoRoute jobs of a watershed
+        started at time_start (default: now)
+        """
+        if time_start is None:
+            time_start = time()
+        if self.time_start is None:
+            self.time_start = time_start
+        self.job_start_times[job_key] = time_start
+        self.num_running_jobs += 1
+        collect_thread = threading.Thread(target=self._collect_outputs,
+                                          args=(job_key, worker_list))
+        collect_thread.daemon = True
+        collect_thread.start()
+
+    def get_makespan(self):
+        """
+        Time since the first watershed started
+        """
+        if self.time_start is None:
+            return 0
+        return time() - self.time_start
+
+    def __iter__(self):
+        """
+        Yields (job_key, job_output, tile latency) as the tiles finish and
+        (job_key, None, None) once all of the tiles of a watershed are done
+        """
+        while self.num_running_jobs > 0:
+            #with a timeout, so the wait can be interrupted
+            try:
+                job_key, job_output, time_finished, job_error = self.result_queue.get(True, 1)
+            except Queue.Empty:
+                continue
+            if job_error is not None:
+                raise job_error
+            if job_output is None:
+                self.num_running_jobs -= 1
+                yield job_key, None, None
+            else:
+                yield job_key, job_output, time_finished - self.job_start_times[job_key]
@@ -8,17 +8,92 @@
 ##  License: BSD-3 Clause
 
 from datetime import datetime
+import multiprocessing
 import netCDF4 as nc
 import numpy as np
+import os
 from RAPIDpy.dataset import RAPIDDataset
 
-def generate_return_periods(qout_file, return_period_file, storm_duration_days=7):
+from run_metrics import METRICS
+
+#memory used by all of the blocks of reaches read from the Qout file at once
+DEFAULT_MAX_MEMORY_MB = 512
+#the block is copied once when the missing values are filled
+MEMORY_COPIES_PER_BLOCK = 2
+
+def get_storm_maxima(qout_block, steps_per_group):
+    """
+    Maximum flow of each group of time steps (time x reaches).
+    The last group can have fewer time steps, as in
+    RAPIDDataset.get_daily_qout_index with mode="max".
+    """
+    qout_block = np.ma.filled(qout_block, np.nan)
+    num_full_groups = qout_block.shape[0] // steps_per_group
+    storm_maxima = qout_block[:num_full_groups*steps_per_group] \
+                       .reshape(num_full_groups, steps_per_group, qout_block.shape[1]) \
+                       .max(axis=1)
+    if num_full_groups*steps_per_group < qout_block.shape[0]:
+        storm_maxima = np.concatenate([storm_maxima,
+                                       qout_block[num_full_groups*steps_per_group:].max(axis=0, keepdims=True)])
+    return storm_maxima
+
+def get_return_period_flows(storm_maxima, num_years, rp_index_list):
+    """
+    Get the maximum flow and the flows ranked at rp_index_list
+    (0 is the largest) for each reach of the storm maxima (storms x reaches).
+    Same as indexing np.sort(storm_maxima)[:num_years:-1] for each reach.
+    """
+    num_storms = storm_maxima.shape[0]
+    if max(rp_index_list) >= num_storms - num_years - 1:
+        raise Exception("ERROR: Not enough storms ({0}) for {1} years ...".format(num_storms, num_years))
+    #only the ranks needed are placed, instead of sorting all of the storms
+    sort_index_list = [num_storms - 1 - rp_index for rp_index in rp_index_list]
+    partitioned_maxima = np.partition(storm_maxima, sorted(set(sort_index_list + [num_storms - 1])), axis=0)
+    return partitioned_maxima[num_storms - 1], \
+           [partitioned_maxima[sort_index] for sort_index in sort_index_list]
+
+def generate_return_periods_block(args):
+    """
+    Generate the return periods of a block of reaches
+    (also the job of the multiprocessing workers)
+    """
+    qout_file = args[0]
+    block_start = args[1]
+    block_end = args[2]
+    steps_per_group = args[3]
+    num_years = args[4]
+    rp_index_list = args[5]
+
+    qout_nc = nc.Dataset(qout_file)
+    try:
+        qout_var = qout_nc.variables['Qout']
+        if qout_var.dimensions[0].lower() == 'time':
+            qout_block = qout_var[:, block_start:block_end]
+        else:
+            qout_block = qout_var[block_start:block_end, :].T
+    finally:
+        qout_nc.close()
+
+    storm_maxima = get_storm_maxima(qout_block, steps_per_group)
+    max_flow, rp_flows = get_return_period_flows(storm_maxima,
+                                                 num_years,
+                                                 rp_index_list)
+    return block_start, block_end, max_flow, rp_flows
+
+def generate_return_periods(qout_file, return_period_file, storm_duration_days=7,
+                            num_processes=1, max_memory_mb=DEFAULT_MAX_MEMORY_MB):
     """
     Generate return period from RAPID Qout file
+
+    The reaches are split in blocks processed by num_processes workers.
+    Each worker reads its own block from the Qout file and the blocks
+    are sized so that all of the workers together stay within
+    max_memory_mb. The result is the same for any number of processes.
     """
 
     #get ERA Interim Data Analyzed
-    with RAPIDDataset(qout_file) as qout_nc_file:
+    with RAPIDDataset(qout_file) as qout_nc_file, \
+         METRICS.stage('return_periods', qout_file=os.path.basename(qout_file)) as stage_metrics:
         print "Setting up Return Periods File ..."
         return_period_nc = nc.Dataset(return_period_file, 'w')
         
@@ -59,20 +134,46 @@ def generate_return_periods(qout_file, return_period_file, storm_duration_days=7
         time_steps_per_day = (24*3600)/float((datetime.utcfromtimestamp(time_array[1])-datetime.utcfromtimestamp(time_array[0])).seconds)
         step = max(1,int(time_steps_per_day * storm_duration_days))
 
-        for comid_index, comid in enumerate(river_id_list):
+        rp_index_20 = int((num_years + 1)/20.0)
+        rp_index_10 = int((num_years + 1)/10.0)
+        rp_index_2 = int((num_years + 1)/2.0)
+
+        qout_var = qout_nc_file.qout_nc.variables['Qout']
+        size_time = len(time_array)
+        stage_metrics.add(bytes_read=size_time*len(river_id_list)*qout_var.dtype.itemsize,
+                          reach_time_steps=size_time*len(river_id_list))
+        num_processes = max(1, num_processes)
+        #read the reaches in blocks so that all of the workers fit in memory
+        reach_block_size = max(1, int(max_memory_mb*1024*1024 //
+                                      (num_processes*MEMORY_COPIES_PER_BLOCK*size_time*qout_var.dtype.itemsize)))
+        #use all of the workers when the river network is small
+        reach_block_size = min(reach_block_size,
+                               max(1, -(-len(river_id_list) // num_processes)))
+        block_job_list = [(qout_file,
+                           block_start,
+                           min(block_start + reach_block_size, len(river_id_list)),
+                           step,
+                           num_years,
+                           [rp_index_20, rp_index_10, rp_index_2])
+                          for block_start in xrange(0, len(river_id_list), reach_block_size)]
 
-            filtered_flow_data = qout_nc_file.get_daily_qout_index(comid_index, 
-                                                                   steps_per_group=step,
-				                                   mode="max")
-            sorted_flow_data = np.sort(filtered_flow_data)[:num_years:-1]
+        if num_processes > 1 and len(block_job_list) > 1:
+            pool = multiprocessing.Pool(num_processes)
+            block_results = pool.imap_unordered(generate_return_periods_block, block_job_list)
+        else:
+            pool = None
+            block_results = (generate_return_periods_block(block_job) for block_job in block_job_list)
 
-            rp_index_20 = int((num_years + 1)/20.0)
-            rp_index_10 = int((num_years + 1)/10.0)
-            rp_index_2 = int((num_years + 1)/2.0)
-            
-            max_flow_var[comid_index] = sorted_flow_data[0]
-            return_period_20_var[comid_index] = sorted_flow_data[rp_index_20]
-            return_period_10_var[comid_index] = sorted_flow_data[rp_index_10]
-            return_period_2_var[comid_index] = sorted_flow_data[rp_index_2]
+        try:
+            for block_start, block_end, max_flow, rp_flows in block_results:
+                max_flow_var[block_start:block_end] = max_flow
+                return_period_20_var[block_start:block_end] = rp_flows[0]
+                return_period_10_var[block_start:block_end] = rp_flows[1]
+                return_period_2_var[block_start:block_end] = rp_flows[2]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         return_period_nc.close()
+        stage_metrics.add(bytes_written=os.path.getsize(return_period_file))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+##
+##  geoserver_upload.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from multiprocessing.pool import ThreadPool
+import threading
+from time import sleep, time
+
+DEFAULT_NUM_UPLOAD_THREADS = 4
+DEFAULT_UPLOAD_RETRIES = 3
+
+class GeoServerUploadPipeline(object):
+    """
+    Uploads the flood map shapefiles to GeoServer in a pool of threads,
+    so the uploads overlap with the AutoRoute jobs that are still running.
+
+    Each thread creates its GeoServer manager once with manager_factory
+    and reuses it (and its HTTP connection) for all of its uploads, so
+    manager_factory can also return a stub for a local test server.
+    Requests failing with one of retry_exceptions are tried again up to
+    max_retries times, waiting retry_delay seconds and twice as long
+    after each attempt. A manager already connected can be given for the
+    calling thread (e.g. for the layer groups).
+    """
+    def __init__(self, manager_factory, num_threads=DEFAULT_NUM_UPLOAD_THREADS,
+                 max_retries=DEFAULT_UPLOAD_RETRIES, retry_delay=2.0,
+                 retry_exceptions=(Exception,), manager=None):
+        self.manager_factory = manager_factory
+        self.num_threads = max(1, num_threads)
+        self.max_retries = max(0, max_retries)
+        self.retry_delay = retry_delay
+        self.retry_exceptions = retry_exceptions
+        self.thread_data = threading.local()
+        self.thread_data.manager = manager
+        self.pool = ThreadPool(self.num_threads)
+
+    def get_manager(self):
+        """
+        GeoServer manager of the current thread
+        """
+        manager = getattr(self.thread_data, 'manager', None)
+        if manager is None:
+            manager = self.manager_factory()
+            self.thread_data.manager = manager
+        return manager
+
+    def _call_with_retry(self, request_name, request_function, *args, **kwargs):
+        """
+        Call request_function, retrying with backoff on retry_exceptions
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return request_function(*args, **kwargs)
+            except self.retry_exceptions as ex:
+                if attempt >= self.max_retries:
+                    raise
+                retry_delay = self.retry_delay * 2**attempt
+                print "{0} failed: {1}".format(request_name, ex)
+                print "Retrying {0} in {1:.1f} s ...".format(request_name, retry_delay)
+                sleep(retry_delay)
+
+    def _upload_shapefile(self, resource_name, shapefile_list):
+        """
+        Upload a shapefile in a pool thread and return the layer name
+        """
+        manager = self.get_manager()
+        time_start = time()
+        #FailedRequestError is retried, then only printed: the lookup after a good upload fails when the app deletes layers (hourly)
+        try:
+            #the upload overwrites the layer, so it can be repeated
+            self._call_with_retry("Upload of {0}".format(resource_name),
+                                  manager.upload_shapefile,
+                                  resource_name,
+                                  shapefile_list)
+        except self.retry_exceptions as ex:
+            print ex
+            print "Most likely OK, but always wise to check ..."
+            pass
+        print "Uploaded {0} in {1:.2f} s ...".format(resource_name, time() - time_start)
+        return manager.get_layer_name(resource_name)
+
+    def upload_shapefile(self, resource_name, shapefile_list):
+        """
+        Queue the upload of a shapefile. The result gives the layer name.
+        """
+        return self.pool.apply_async(self._upload_shapefile,
+                                     (resource_name, shapefile_list))
+
+    def create_layer_group(self, layer_group_name, layer_list, bounds, style='green'):
+        """
+        Create the layer group of the uploaded layers (in the calling thread)
+        """
+        manager = self.get_manager()
+        self._call_with_retry("Layer group {0}".format(layer_group_name),
+                              manager.dataset_engine.create_layer_group,
+                              layer_group_id=manager.get_layer_name(layer_group_name),
+                              layers=tuple(layer_list),
+                              styles=tuple(style for layer in layer_list),
+                              bounds=tuple(bounds))
+
+    def close(self):
+        """
+        Wait for the uploads that are left
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+##
+##  incremental_update.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import netCDF4 as NET
+import os
+import re
+
+#memory used to copy the time steps from one file to the other
+APPEND_MEMORY_BUDGET_MB = 256
+
+def find_previous_output(output_directory, out_file_ending):
+    """
+    Find the Qout and inflow files of the last run with the same
+    start date and the same or an earlier end date.
+    Returns (qout_file, rapid_inflow_file) or (None, None).
+    """
+    match = re.match(r'^(.*_\d{8}to)(\d{8})(.*)$', out_file_ending)
+    if match is None:
+        return None, None
+    out_file_prefix, end_date, out_file_suffix = match.groups()
+    previous_output_pattern = re.compile(r'^Qout_{0}(\d{{8}}){1}$'.format(re.escape(out_file_prefix),
+                                                                        re.escape(out_file_suffix)))
+    previous_end_date = None
+    for output_file in os.listdir(output_directory):
+        match = previous_output_pattern.match(output_file)
+        if match is None or match.group(1) > end_date:
+            continue
+        #the inflow is needed to append to it
+        if not os.path.exists(os.path.join(output_directory,
+                                           'm3_riv_bas_{0}{1}{2}'.format(out_file_prefix,
+                                                                         match.group(1),
+                                                                         out_file_suffix))):
+            continue
+        if previous_end_date is None or match.group(1) > previous_end_date:
+            previous_end_date = match.group(1)
+
+    if previous_end_date is None:
+        return None, None
+    previous_file_ending = "{0}{1}{2}".format(out_file_prefix, previous_end_date, out_file_suffix)
+    return (os.path.join(output_directory, 'Qout_{0}'.format(previous_file_ending)),
+            os.path.join(output_directory, 'm3_riv_bas_{0}'.format(previous_file_ending)))
+
+def get_time_dimension(nc_dataset):
+    """
+    Get the name of the time dimension (RAPID uses Time, CF uses time)
+    """
+    for time_dim in ('time', 'Time'):
+        if time_dim in nc_dataset.dimensions:
+            return time_dim
+    raise Exception("ERROR: No time dimension found ...")
+
+def _copy_time_steps(in_var, out_var, out_start_index):
+    """
+    Copy the variable along the time axis in slabs
+    """
+    size_time = in_var.shape[0]
+    bytes_per_time_step = max(1, in_var.dtype.itemsize)
+    for dim_size in in_var.shape[1:]:
+        bytes_per_time_step *= dim_size
+    slab_size_time = max(1, APPEND_MEMORY_BUDGET_MB*1024*1024 // bytes_per_time_step)
+    for time_index in xrange(0, size_time, slab_size_time):
+        time_end = min(time_index + slab_size_time, size_time)
+        out_var[out_start_index+time_index:out_start_index+time_end] = in_var[time_index:time_end]
+
+def append_along_time(existing_nc_file, new_nc_file, out_nc_file):
+    """
+    Append the time steps of new_nc_file to existing_nc_file and
+    save the result as out_nc_file. The variables on the time
+    dimension are extended, the others are taken from existing_nc_file.
+
+    If the time dimension is unlimited, the time steps are appended in
+    place and the file is renamed. Otherwise, a new file is written.
+    """
+    new_nc = NET.Dataset(new_nc_file)
+    existing_nc = NET.Dataset(existing_nc_file)
+    time_dim = get_time_dimension(existing_nc)
+    append_in_place = existing_nc.dimensions[time_dim].isunlimited()
+    existing_size_time = len(existing_nc.dimensions[time_dim])
+    print "Appending {0} time steps from {1} to {2} ...".format(len(new_nc.dimensions[get_time_dimension(new_nc)]),
+                                                              new_nc_file,
+                                                              existing_nc_file)
+    try:
+        if append_in_place:
+            existing_nc.close()
+            existing_nc = NET.Dataset(existing_nc_file, "a")
+            out_nc = existing_nc
+        else:
+            out_nc = NET.Dataset(out_nc_file + "_tmp", "w", format=existing_nc.file_format)
+            out_nc.setncatts({attr: existing_nc.getncattr(attr) for attr in existing_nc.ncattrs()})
+            for dim_name, dim in existing_nc.dimensions.iteritems():
+                if dim_name == time_dim:
+                    out_nc.createDimension(dim_name, None)
+                else:
+                    out_nc.createDimension(dim_name, len(dim))
+            for var_name, var in existing_nc.variables.iteritems():
+                var_attrs = {attr: var.getncattr(attr) for attr in var.ncattrs()}
+                out_var = out_nc.createVariable(var_name, var.dtype, var.dimensions,
+                                                fill_value=var_attrs.pop('_FillValue', None))
+                out_var.setncatts(var_attrs)
+                if not var.dimensions:
+                    out_var.assignValue(var.getValue())
+                elif var.dimensions[0] == time_dim:
+                    _copy_time_steps(var, out_var, 0)
+                else:
+                    out_var[:] = var[:]
+
+        for var_name, var in new_nc.variables.iteritems():
+            if var.dimensions and var.dimensions[0] == get_time_dimension(new_nc) \
+                    and var_name in out_nc.variables:
+                _copy_time_steps(var, out_nc.variables[var_name], existing_size_time)
+        out_nc.close()
+    finally:
+        new_nc.close()
+        if not append_in_place:
+            existing_nc.close()
+
+    if append_in_place:
+        if existing_nc_file != out_nc_file:
+            os.rename(existing_nc_file, out_nc_file)
+    else:
+        if os.path.exists(out_nc_file):
+            os.remove(out_nc_file)
+        os.rename(out_nc_file + "_tmp", out_nc_file)
+        if existing_nc_file != out_nc_file:
+            os.remove(existing_nc_file)
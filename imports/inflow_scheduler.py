@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+##
+##  inflow_scheduler.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import deque
+import math
+
+#time one inflow job should take once the cost of a file is known
+DEFAULT_TARGET_JOB_SECONDS = 20.0
+#rough cost to read and convert one runoff value, used before the first job is timed
+ESTIMATED_SECONDS_PER_VALUE = 2e-8
+
+class InflowJobScheduler(object):
+    """
+    Dynamic scheduler for the inflow jobs of the worker pool.
+
+    Instead of splitting the runoff files into one static chunk per
+    worker, the files are handed out in small batches as the workers
+    become free. All workers pull from the same pool task queue, so a
+    slow file only delays its own batch while the others keep taking
+    new work. The batch size starts from the size of the runoff grid
+    and is then tuned with the measured time per file. It shrinks near
+    the end of the run, so the last jobs finish at about the same time.
+    """
+    def __init__(self, pool, job_function, num_workers,
+                 target_job_seconds=DEFAULT_TARGET_JOB_SECONDS):
+        self.pool = pool
+        self.job_function = job_function
+        self.pool_size = max(1, num_workers)
+        self.target_job_seconds = target_job_seconds
+        self.set_num_workers(self.pool_size)
+        self.job_sources = deque()
+        self.jobs_in_flight = []
+        #measured seconds per file for each kind of job
+        self.file_costs = {}
+
+    def set_num_workers(self, num_workers):
+        """
+        Change the number of workers that can run inflow jobs,
+        e.g. when some of the cores are used by RAPID
+        """
+        self.num_workers = max(0, min(num_workers, self.pool_size))
+        if self.num_workers >= self.pool_size:
+            #two jobs per worker so a worker never waits for the scheduler
+            self.max_jobs_in_flight = 2*self.num_workers
+        else:
+            #the other pool workers have to stay idle
+            self.max_jobs_in_flight = self.num_workers
+
+    def add_job_source(self, file_list, job_args_before, job_args_after,
+                       cost_key=None, values_per_file=None,
+                       pass_previous_file=False, previous_file=None):
+        """
+        Add the files of one inflow job group. The args of each job are
+        job_args_before + (file_batch, index_batch) + job_args_after.
+        cost_key groups the sources with the same cost per file
+        (e.g. same grid) and values_per_file is the number of runoff
+        values in a file, used to estimate the cost until it is measured.
+        With pass_previous_file, the file before the batch is added to
+        the args (previous_file for the first batch), for the runoff
+        that accumulates from one file to the next.
+        """
+        if not file_list:
+            return
+        if cost_key not in self.file_costs and values_per_file:
+            self.file_costs[cost_key] = values_per_file*ESTIMATED_SECONDS_PER_VALUE
+        self.job_sources.append({'file_list': file_list,
+                                 'next_index': 0,
+                                 'job_args_before': tuple(job_args_before),
+                                 'job_args_after': tuple(job_args_after),
+                                 'cost_key': cost_key,
+                                 'pass_previous_file': pass_previous_file,
+                                 'previous_file': previous_file})
+
+    def _num_files_remaining(self):
+        """
+        Number of files not yet handed out to the workers
+        """
+        return sum(len(job_source['file_list']) - job_source['next_index']
+                   for job_source in self.job_sources)
+
+    def _get_batch_size(self, job_source):
+        """
+        Number of files for the next job of the source
+        """
+        file_cost = self.file_costs.get(job_source['cost_key'])
+        if file_cost:
+            batch_size = int(self.target_job_seconds/file_cost)
+        else:
+            batch_size = 1
+        #guided self-scheduling: keep enough small jobs left for all workers
+        batch_size = min(batch_size,
+                         int(math.ceil(self._num_files_remaining()/float(2*max(1, self.num_workers)))))
+        return max(1, min(batch_size,
+                          len(job_source['file_list']) - job_source['next_index']))
+
+    def _submit_jobs(self):
+        """
+        Submit new jobs until enough are in flight
+        """
+        while self.job_sources and len(self.jobs_in_flight) < self.max_jobs_in_flight:
+            job_source = self.job_sources[0]
+            batch_start = job_source['next_index']
+            batch_end = batch_start + self._get_batch_size(job_source)
+            job_args = job_source['job_args_before'] \
+                       + (job_source['file_list'][batch_start:batch_end],
+                          range(batch_start, batch_end)) \
+                       + job_source['job_args_after']
+            if job_source['pass_previous_file']:
+                job_args += (job_source['file_list'][batch_start-1] if batch_start > 0 \
+                             else job_source['previous_file'],)
+            self.jobs_in_flight.append((self.pool.apply_async(self.job_function, (job_args,)),
+                                        job_source['cost_key']))
+            job_source['next_index'] = batch_end
+            if batch_end >= len(job_source['file_list']):
+                self.job_sources.popleft()
+
+    def update(self):
+        """
+        Collect the finished jobs and submit new ones.
+        Raises the exception of a job that failed.
+        """
+        jobs_in_flight = []
+        for job_result, cost_key in self.jobs_in_flight:
+            if job_result.ready():
+                #jobs return the number of files and the time it took
+                num_files, job_seconds = job_result.get()
+                if num_files > 0:
+                    file_cost = job_seconds/float(num_files)
+                    previous_file_cost = self.file_costs.get(cost_key)
+                    if previous_file_cost:
+                        file_cost = 0.5*(previous_file_cost + file_cost)
+                    self.file_costs[cost_key] = file_cost
+            else:
+                jobs_in_flight.append((job_result, cost_key))
+        self.jobs_in_flight = jobs_in_flight
+        self._submit_jobs()
+
+    def is_finished(self):
+        """
+        True when all of the jobs are done
+        """
+        return not self.job_sources and not self.jobs_in_flight
+
+    def wait(self):
+        """
+        Wait for all of the jobs to finish
+        """
+        while not self.is_finished():
+            for job_result, cost_key in self.jobs_in_flight:
+                job_result.wait()
+            self.update()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+##
+##  inflow_writer.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import OrderedDict
+import netCDF4 as NET
+import numpy as NUM
+
+#default memory used to buffer the inflow before writing
+DEFAULT_MEMORY_BUDGET_MB = 512
+#formats of the inflow file
+M3RIV_FORMATS = ("NETCDF3_CLASSIC", "NETCDF4")
+#RAPID reads one time step of all reaches at a time, so the chunks
+#hold whole time steps and are small enough for the default chunk cache
+M3RIV_CHUNK_SIZE_BYTES = 1024*1024
+
+def get_m3_riv_chunksizes(size_time, size_rivid, itemsize=4):
+    """
+    Chunk sizes (time, rivid) of the m3_riv variable in NETCDF4
+    """
+    chunk_size_time = max(1, M3RIV_CHUNK_SIZE_BYTES // max(1, size_rivid*itemsize))
+    return (int(max(1, min(chunk_size_time, size_time))), int(max(1, size_rivid)))
+
+def create_m3_riv_file(out_nc, size_rivid, tot_size_time,
+                       output_format="NETCDF3_CLASSIC",
+                       unlimited_time=False,
+                       complevel=4):
+    """
+    Create the RAPID inflow file with an empty m3_riv variable.
+
+    NETCDF4 files are compressed with zlib and shuffle, which mostly
+    removes the zero inflow, and chunked by whole time steps for the
+    time slabs of the writer and the time step reads of RAPID.
+    With unlimited_time, the Time dimension is unlimited so that
+    the inflow of later runs can be appended to the file.
+    """
+    if output_format not in M3RIV_FORMATS:
+        raise Exception("ERROR: Inflow file format {0} not in {1} ...".format(output_format,
+                                                                              M3RIV_FORMATS))
+    data_out_nc = NET.Dataset(out_nc, "w", format=output_format)
+    if unlimited_time:
+        data_out_nc.createDimension('Time', None)
+    else:
+        data_out_nc.createDimension('Time', tot_size_time)
+    data_out_nc.createDimension('rivid', size_rivid)
+    if output_format == "NETCDF4":
+        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4',
+                                                ('Time', 'rivid'),
+                                                fill_value=0,
+                                                zlib=True,
+                                                complevel=complevel,
+                                                shuffle=True,
+                                                chunksizes=get_m3_riv_chunksizes(tot_size_time, size_rivid))
+    else:
+        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4',
+                                                ('Time', 'rivid'),
+                                                fill_value=0)
+    if unlimited_time and tot_size_time > 0:
+        #writing the last time step sets the size of the unlimited dimension
+        var_m3_riv[tot_size_time-1, :] = 0
+    data_out_nc.close()
+
+class M3RivWriter(object):
+    """
+    Single writer of the m3_riv variable in a RAPID inflow file.
+
+    The file is opened once and the inflow blocks (time x rivid) are
+    buffered in time slabs that fit in the memory budget. Each slab is
+    written as one contiguous hyperslab, so only one process ever has
+    the file open for writing and the number of write calls is
+    independent of the number of reaches and files. In NETCDF4 files,
+    the slabs hold whole chunks so no chunk is compressed twice, unless
+    one chunk is larger than the memory budget.
+    """
+    def __init__(self, out_nc, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, num_streams=1):
+        """
+        num_streams is the number of producers writing different
+        parts of the time axis at the same time (e.g. the workers).
+        Each gets its own slab buffer within the memory budget, or they
+        share fewer slabs if a slab per stream is smaller than a chunk.
+        """
+        self.out_nc = out_nc
+        self.data_out_nc = NET.Dataset(out_nc, "a")
+        self.m3_riv_var = self.data_out_nc.variables['m3_riv']
+        self.size_time, self.size_rivid = self.m3_riv_var.shape
+        self.max_slabs = max(1, int(num_streams))
+        bytes_per_time_step = max(1, self.size_rivid * self.m3_riv_var.dtype.itemsize)
+        self.slab_size_time = int(max(1, min(self.size_time,
+                                             memory_budget_mb*1024*1024 // (bytes_per_time_step*self.max_slabs))))
+        chunking = self.m3_riv_var.chunking() if self.data_out_nc.data_model.startswith("NETCDF4") else "contiguous"
+        if chunking != "contiguous" and self.slab_size_time < self.size_time:
+            if self.slab_size_time >= chunking[0]:
+                self.slab_size_time -= self.slab_size_time % chunking[0]
+            else:
+                #fewer slabs of one chunk, so they stay within the memory budget
+                bytes_per_chunk = bytes_per_time_step*chunking[0]
+                self.max_slabs = int(min(self.max_slabs, memory_budget_mb*1024*1024 // bytes_per_chunk))
+                if self.max_slabs >= 1:
+                    self.slab_size_time = chunking[0]
+                else:
+                    #one chunk is larger than the memory budget,
+                    #so the chunks are written in parts
+                    self.max_slabs = 1
+                    self.slab_size_time = int(max(1, min(self.size_time,
+                                                         memory_budget_mb*1024*1024 // bytes_per_time_step)))
+        self.slabs = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_slab(self, slab_index):
+        """
+        Get the buffer of the time slab, flushing the oldest slab
+        if the memory budget is used up
+        """
+        if slab_index not in self.slabs:
+            if len(self.slabs) >= self.max_slabs:
+                self._flush_slab(next(iter(self.slabs)))
+            slab_start = slab_index * self.slab_size_time
+            slab_end = min(slab_start + self.slab_size_time, self.size_time)
+            self.slabs[slab_index] = {'start': slab_start,
+                                      'data': NUM.zeros((slab_end-slab_start, self.size_rivid),
+                                                        dtype=self.m3_riv_var.dtype),
+                                      'filled': NUM.zeros(slab_end-slab_start, dtype=bool)}
+        return self.slabs[slab_index]
+
+    def _flush_slab(self, slab_index):
+        """
+        Write the filled time steps of the slab to the file
+        """
+        slab = self.slabs.pop(slab_index)
+        filled = slab['filled']
+        #write each contiguous run of filled time steps
+        run_edges = NUM.flatnonzero(NUM.diff(NUM.concatenate([[False], filled, [False]])))
+        for run_start, run_end in zip(run_edges[::2], run_edges[1::2]):
+            self.m3_riv_var[slab['start']+run_start:slab['start']+run_end, :] = slab['data'][run_start:run_end]
+
+    def write(self, time_index, m3_riv_block):
+        """
+        Write the inflow block starting at time_index
+        """
+        m3_riv_block = NUM.asarray(m3_riv_block)
+        if m3_riv_block.ndim == 1:
+            m3_riv_block = m3_riv_block.reshape(1, -1)
+        if m3_riv_block.shape[1] != self.size_rivid:
+            raise Exception("Inflow block has {0} reaches, but {1} has {2} ...".format(m3_riv_block.shape[1],
+                                                                                      self.out_nc,
+                                                                                      self.size_rivid))
+        time_end = time_index + m3_riv_block.shape[0]
+        if time_index < 0 or time_end > self.size_time:
+            raise Exception("Inflow block from {0} to {1} outside of time dimension in {2} ...".format(time_index,
+                                                                                                      time_end,
+                                                                                                      self.out_nc))
+        while time_index < time_end:
+            slab_index = time_index // self.slab_size_time
+            slab = self._get_slab(slab_index)
+            slab_time_end = min(time_end, slab['start'] + len(slab['filled']))
+            slab['data'][time_index-slab['start']:slab_time_end-slab['start']] = \
+                m3_riv_block[:slab_time_end-time_index]
+            slab['filled'][time_index-slab['start']:slab_time_end-slab['start']] = True
+            if slab['filled'].all():
+                self._flush_slab(slab_index)
+            m3_riv_block = m3_riv_block[slab_time_end-time_index:]
+            time_index = slab_time_end
+
+    def flush(self):
+        """
+        Write all of the buffered inflow to the file
+        """
+        for slab_index in list(self.slabs):
+            self._flush_slab(slab_index)
+
+    def close(self):
+        """
+        Close the inflow file
+        """
+        if self.data_out_nc is not None:
+            self.flush()
+            self.data_out_nc.close()
+            self.data_out_nc = None
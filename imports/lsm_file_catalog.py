@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+##
+##  lsm_file_catalog.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import OrderedDict
+from datetime import timedelta
+import json
+import netCDF4 as NET
+import os
+import re
+import sqlite3
+
+#change when the catalog tables change to rebuild the catalog
+LSM_FILE_CATALOG_VERSION = 2
+
+class LSMDimension(object):
+    """
+    Size of a dimension of a cataloged LSM file
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+class LSMFileHeader(object):
+    """
+    Header of a cataloged LSM file. It has the dimensions, variables
+    and global attributes of the netCDF4 Dataset, without opening it.
+    """
+    def __init__(self, path, dimensions, variables, attributes):
+        self.path = path
+        self.dimensions = OrderedDict((dim_name, LSMDimension(dim_size))
+                                      for dim_name, dim_size in dimensions)
+        self.variables = OrderedDict((var_name, tuple(var_dims))
+                                     for var_name, var_dims in variables)
+        self.attributes = attributes
+
+    def ncattrs(self):
+        return self.attributes.keys()
+
+    def getncattr(self, name):
+        try:
+            return self.attributes[name]
+        except KeyError:
+            raise AttributeError("{0} not found in {1}".format(name, self.path))
+
+    def close(self):
+        pass
+
+def read_lsm_file_header(lsm_file):
+    """
+    Read the dimensions, variables and text attributes of an LSM file
+    """
+    lsm_nc = NET.Dataset(lsm_file)
+    try:
+        dimensions = [(dim_name, len(dim)) for dim_name, dim in lsm_nc.dimensions.iteritems()]
+        variables = [(var_name, list(var.dimensions)) for var_name, var in lsm_nc.variables.iteritems()]
+        attributes = {}
+        for attr_name in lsm_nc.ncattrs():
+            attr_value = lsm_nc.getncattr(attr_name)
+            if isinstance(attr_value, basestring):
+                attributes[attr_name] = attr_value
+    finally:
+        lsm_nc.close()
+    return dimensions, variables, attributes
+
+def get_lsm_file_date(lsm_file):
+    """
+    Get the date (YYYYMMDD) in the path of an LSM file
+    """
+    match = re.search(r'\d{8}', lsm_file)
+    if match is None:
+        return None
+    return match.group(0)
+
+def get_lsm_file_ensemble(lsm_file):
+    """
+    Get the ensemble of an LSM file (name ending with _<ensemble>.nc)
+    """
+    file_name_split = os.path.basename(lsm_file)[:-3].rsplit("_", 1)
+    if len(file_name_split) < 2:
+        return None
+    return file_name_split[1]
+
+class LSMFileCatalog(object):
+    """
+    Persistent SQLite index of the LSM files in the data directories.
+
+    The catalog has the path, date, ensemble, grid type, dimensions and
+    time length of each runoff file and the grids detected by file
+    signature (see LSMGridDetector). On refresh, only the directories
+    with a new modification time are listed again, the cataloged files
+    of the other directories are checked with os.stat and only the files
+    with a new modification time or size are opened.
+    """
+    def __init__(self, catalog_file):
+        self.catalog_file = catalog_file
+        self.connection = sqlite3.connect(catalog_file)
+        catalog_version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if catalog_version != LSM_FILE_CATALOG_VERSION:
+            with self.connection:
+                self.connection.execute("DROP TABLE IF EXISTS lsm_directories")
+                self.connection.execute("DROP TABLE IF EXISTS lsm_files")
+                self.connection.execute("DROP TABLE IF EXISTS lsm_grids")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS lsm_directories "
+                                    "(path TEXT PRIMARY KEY, parent TEXT, root TEXT, mtime REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS lsm_files "
+                                    "(path TEXT PRIMARY KEY, directory TEXT, root TEXT, "
+                                    "mtime REAL, size INTEGER, file_date TEXT, ensemble TEXT, "
+                                    "grid_type TEXT, time_size INTEGER, "
+                                    "dimensions TEXT, variables TEXT, attributes TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS lsm_files_query "
+                                    "ON lsm_files (root, ensemble, file_date)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS lsm_files_directory "
+                                    "ON lsm_files (directory)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS lsm_grids "
+                                    "(signature TEXT PRIMARY KEY, grid TEXT)")
+            self.connection.execute("PRAGMA user_version = {0}".format(LSM_FILE_CATALOG_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the catalog database
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _refresh_directory(self, directory, root):
+        """
+        Update the files of a directory that changed
+        Returns the list of subdirectories
+        """
+        subdirectories = []
+        cataloged_files = dict((path, (mtime, size)) for path, mtime, size in
+                               self.connection.execute("SELECT path, mtime, size FROM lsm_files "
+                                                       "WHERE directory=?", (directory,)))
+        for file_name in os.listdir(directory):
+            path = os.path.join(directory, file_name)
+            if os.path.isdir(path):
+                subdirectories.append(path)
+                continue
+            if not file_name.endswith(".nc"):
+                continue
+            file_stat = os.stat(path)
+            if cataloged_files.pop(path, None) == (file_stat.st_mtime, file_stat.st_size):
+                continue
+            self._refresh_file(path, directory, root, file_stat)
+        #files that were removed
+        self.connection.executemany("DELETE FROM lsm_files WHERE path=?",
+                                    [(path,) for path in cataloged_files])
+        return subdirectories
+
+    def _check_directory_files(self, directory, root):
+        """
+        Update the cataloged files of a directory that was not listed
+        again, if they were overwritten in place or removed
+        Returns the number of files checked
+        """
+        cataloged_files = self.connection.execute("SELECT path, mtime, size FROM lsm_files "
+                                                  "WHERE directory=?", (directory,)).fetchall()
+        for path, mtime, size in cataloged_files:
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                self.connection.execute("DELETE FROM lsm_files WHERE path=?", (path,))
+                continue
+            if (file_stat.st_mtime, file_stat.st_size) != (mtime, size):
+                self._refresh_file(path, directory, root, file_stat)
+        return len(cataloged_files)
+
+    def _refresh_file(self, path, directory, root, file_stat):
+        """
+        Read the header of an LSM file into the catalog
+        """
+        try:
+            dimensions, variables, attributes = read_lsm_file_header(path)
+        except Exception as ex:
+            print "WARNING: Unable to read {0} ({1}). Skipping ...".format(path, ex)
+            return
+        dimension_sizes = dict(dimensions)
+        time_size = dimension_sizes.get('Time', dimension_sizes.get('time', 1))
+        self.connection.execute("INSERT OR REPLACE INTO lsm_files VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                                (path, directory, root, file_stat.st_mtime, file_stat.st_size,
+                                 get_lsm_file_date(path), get_lsm_file_ensemble(path), None,
+                                 time_size, json.dumps(dimensions), json.dumps(variables),
+                                 json.dumps(attributes)))
+
+    def refresh(self, lsm_data_location, check_all_files=False):
+        """
+        Update the catalog with the files in lsm_data_location.
+        Directories with the same modification time are not listed again
+        unless check_all_files is True, but their cataloged files are
+        still checked for a new modification time or size (e.g. files
+        overwritten in place).
+        """
+        root = os.path.abspath(lsm_data_location)
+        cataloged_directories = dict((path, mtime) for path, mtime in
+                                     self.connection.execute("SELECT path, mtime FROM lsm_directories "
+                                                             "WHERE root=?", (root,)))
+        num_unchanged_directories = 0
+        num_checked_files = 0
+        with self.connection:
+            directory_stack = [root]
+            while directory_stack:
+                directory = directory_stack.pop()
+                directory_mtime = os.stat(directory).st_mtime
+                if not check_all_files and cataloged_directories.pop(directory, None) == directory_mtime:
+                    num_unchanged_directories += 1
+                    num_checked_files += self._check_directory_files(directory, root)
+                    directory_stack += [path for path, in
+                                        self.connection.execute("SELECT path FROM lsm_directories "
+                                                                "WHERE parent=?", (directory,))]
+                    continue
+                cataloged_directories.pop(directory, None)
+                directory_stack += self._refresh_directory(directory, root)
+                self.connection.execute("INSERT OR REPLACE INTO lsm_directories VALUES (?,?,?,?)",
+                                        (directory, os.path.dirname(directory), root, directory_mtime))
+            #directories that were removed
+            for directory in cataloged_directories:
+                self.connection.execute("DELETE FROM lsm_directories WHERE path=?", (directory,))
+                self.connection.execute("DELETE FROM lsm_files WHERE directory=?", (directory,))
+        if num_unchanged_directories:
+            print "LSM file catalog: {0} directories unchanged, checked {1} files with os.stat ...".format(num_unchanged_directories,
+                                                                                                       num_checked_files)
+
+    def get_files(self, lsm_data_location, ensemble=None,
+                  start_datetime=None, end_datetime=None, grid_type=None):
+        """
+        Get the sorted LSM files within the dates (inclusive).
+        Without an ensemble, all of the files are returned.
+        """
+        query = "SELECT path FROM lsm_files WHERE root=?"
+        query_args = [os.path.abspath(lsm_data_location)]
+        if ensemble is not None:
+            query += " AND ensemble=?"
+            query_args.append(str(ensemble))
+        if start_datetime is not None:
+            #the file date is at midnight
+            start_date = start_datetime.date()
+            if start_datetime.time() != start_datetime.time().min:
+                start_date += timedelta(days=1)
+            query += " AND file_date>=?"
+            query_args.append(start_date.strftime("%Y%m%d"))
+        if end_datetime is not None:
+            query += " AND file_date<=?"
+            query_args.append(end_datetime.strftime("%Y%m%d"))
+        if grid_type is not None:
+            query += " AND grid_type=?"
+            query_args.append(grid_type)
+        query += " ORDER BY path"
+        return [path for path, in self.connection.execute(query, query_args)]
+
+    def get_header(self, lsm_file):
+        """
+        Get the header of a cataloged LSM file
+        """
+        row = self.connection.execute("SELECT dimensions, variables, attributes FROM lsm_files "
+                                      "WHERE path=?", (lsm_file,)).fetchone()
+        if row is None:
+            raise Exception("ERROR: {0} not found in LSM file catalog ...".format(lsm_file))
+        return LSMFileHeader(lsm_file, *[json.loads(column) for column in row])
+
+    def set_grid_type(self, lsm_file_list, grid_type):
+        """
+        Record the grid type detected for the LSM files
+        (only the files with another grid type are updated)
+        """
+        with self.connection:
+            self.connection.executemany("UPDATE lsm_files SET grid_type=? "
+                                        "WHERE path=? AND grid_type IS NOT ?",
+                                        [(grid_type, lsm_file, grid_type) for lsm_file in lsm_file_list])
+
+    def get_grid_descriptor(self, signature):
+        """
+        Get the grid detected for an LSM file signature (None if unknown)
+        """
+        row = self.connection.execute("SELECT grid FROM lsm_grids WHERE signature=?",
+                                      (signature,)).fetchone()
+        if row is None:
+            return None
+        return dict((str(field), value) for field, value in json.loads(row[0]).iteritems())
+
+    def set_grid_descriptor(self, signature, grid_dict):
+        """
+        Record the grid detected for an LSM file signature
+        """
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO lsm_grids VALUES (?,?)",
+                                    (signature, json.dumps(grid_dict)))
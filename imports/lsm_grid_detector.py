@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+##
+##  lsm_grid_detector.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from hashlib import sha1
+import json
+
+from CreateInflowFileFromERAInterimRunoff import CreateInflowFileFromERAInterimRunoff
+from CreateInflowFileFromLDASRunoff import CreateInflowFileFromLDASRunoff
+from CreateInflowFileFromWRFHydroRunoff import CreateInflowFileFromWRFHydroRunoff
+
+#change when the detection changes to probe the files again
+LSM_GRID_DETECTOR_VERSION = 1
+
+class LSMGridDescriptor(object):
+    """
+    Description of the grid of an LSM: the dimensions and variables to
+    read, the grid type, the time step, the weight table file pattern
+    and the inflow tool that converts the runoff.
+    """
+    FIELDS = ('model_name', 'grid_type', 'description', 'weight_file_name',
+              'time_step', 'file_size_time', 'num_files_combined', 'inflow_tool',
+              'latitude_dim', 'longitude_dim', 'lat_dim_size', 'lon_dim_size',
+              'latitude_var', 'longitude_var', 'surface_runoff_var', 'subsurface_runoff_var')
+
+    def __init__(self, **kwargs):
+        for field in self.FIELDS:
+            setattr(self, field, kwargs[field])
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def get_inflow_tool(self):
+        """
+        Create the inflow tool for the grid
+        """
+        return INFLOW_TOOLS[self.inflow_tool](self)
+
+    def get_total_num_time_steps(self, num_files):
+        """
+        Number of RAPID time steps of num_files runoff files
+        """
+        num_extra_files = self.file_size_time*num_files % self.num_files_combined
+        if num_extra_files != 0:
+            print "WARNING: Number of files needs to be divisible by {0}. Remainder is" \
+                  .format(self.num_files_combined), num_extra_files
+            print "This means your simulation will be truncated"
+        return int(self.file_size_time*num_files/self.num_files_combined)
+
+#------------------------------------------------------------------------------
+#INFLOW TOOLS
+#------------------------------------------------------------------------------
+INFLOW_TOOLS = {}
+
+def register_inflow_tool(name, create_function):
+    """
+    Register a function creating an inflow tool from an LSMGridDescriptor
+    """
+    INFLOW_TOOLS[name] = create_function
+
+register_inflow_tool('era_interim',
+                     lambda grid: CreateInflowFileFromERAInterimRunoff())
+register_inflow_tool('ldas',
+                     lambda grid: CreateInflowFileFromLDASRunoff(grid.latitude_dim,
+                                                                 grid.longitude_dim,
+                                                                 grid.latitude_var,
+                                                                 grid.longitude_var,
+                                                                 grid.surface_runoff_var,
+                                                                 grid.subsurface_runoff_var,
+                                                                 grid.time_step))
+register_inflow_tool('wrf_hydro',
+                     lambda grid: CreateInflowFileFromWRFHydroRunoff(grid.latitude_dim,
+                                                                     grid.longitude_dim,
+                                                                     grid.latitude_var,
+                                                                     grid.longitude_var,
+                                                                     grid.surface_runoff_var,
+                                                                     grid.subsurface_runoff_var,
+                                                                     grid.time_step))
+
+#------------------------------------------------------------------------------
+#LSM GRIDS
+#------------------------------------------------------------------------------
+#the detectors are tried in order, the first one returning a grid is used
+LSM_GRID_DETECTORS = []
+
+def register_lsm_grid(detector):
+    """
+    Register an LSM grid detector (can be used as a decorator).
+
+    The detector gets the file info (dimension and variable names,
+    grid size, file_size_time, institution and title) and returns None
+    if the file is not of its LSM. Otherwise it returns the model_name,
+    grid_type, description, weight_file_name, time_step and inflow_tool
+    (and num_files_combined if the files are combined in one time step).
+    """
+    LSM_GRID_DETECTORS.append(detector)
+    return detector
+
+@register_lsm_grid
+def detect_ecmwf_grid(file_info):
+    """
+    ERA Interim (T255/T511) and ERA 20CM (T159)
+    """
+    if file_info['institution'] != "European Centre for Medium-Range Weather Forecasts" \
+        and file_info['surface_runoff_var'].lower() != "ro":
+        return None
+
+    grid_size = (file_info['lat_dim_size'], file_info['lon_dim_size'])
+    if grid_size == (361, 720):
+        print "Runoff file identified as ERA Interim Low Res (T255) GRID"
+        #A) ERA Interim Low Res (T255)
+        #Downloaded as 0.5 degree grid
+        # dimensions:
+        #	 longitude = 720 ;
+        #	 latitude = 361 ;
+        grid = {'description': "ERA Interim (T255 Grid)",
+                'model_name': "erai",
+                'weight_file_name': r'weight_era_t255\.csv',
+                'grid_type': 't255'}
+    elif grid_size == (512, 1024):
+        print "Runoff file identified as ERA Interim High Res (T511) GRID"
+        #B) ERA Interim High Res (T511)
+        # dimensions:
+        #  lon = 1024 ;
+        #  lat = 512 ;
+        grid = {'description': "ERA Interim (T511 Grid)",
+                'model_name': "erai",
+                'weight_file_name': r'weight_era_t511\.csv',
+                'grid_type': 't511'}
+    elif grid_size == (161, 320):
+        print "Runoff file identified as ERA 20CM (T159) GRID"
+        #C) ERA 20CM (T159) - 3hr - 10 ensembles
+        #Downloaded as 1.125 degree grid
+        # dimensions:
+        #  longitude = 320 ;
+        #  latitude = 161 ;
+        grid = {'description': "ERA 20CM (T159 Grid)",
+                'model_name': "era_20cm",
+                'weight_file_name': r'weight_era_t159\.csv',
+                'grid_type': 't159'}
+    else:
+        raise Exception("Unsupported grid size.")
+
+    #time units are in hours
+    if file_info['file_size_time'] == 1:
+        grid['time_step'] = 24*3600 #daily
+        grid['description'] += " Daily Runoff"
+    elif file_info['file_size_time'] == 8:
+        grid['time_step'] = 3*3600 #3 hourly
+        grid['description'] += " 3 Hourly Runoff"
+    else:
+        raise Exception("Unsupported ECMWF time step.")
+
+    grid['inflow_tool'] = 'era_interim'
+    return grid
+
+@register_lsm_grid
+def detect_lis_grid(file_info):
+    """
+    NASA GSFC LIS
+    """
+    if file_info['institution'] != "NASA GSFC":
+        return None
+
+    print "Runoff file identified as LIS GRID"
+    #time units are in minutes
+    if file_info['file_size_time'] != 1:
+        raise Exception("Unsupported LIS time step.")
+    return {'description': "NASA GFC LIS Hourly Runoff",
+            'model_name': "nasa",
+            'weight_file_name': r'weight_lis\.csv',
+            'grid_type': 'lis',
+            #hourly files combined in 3-hourly time steps
+            'time_step': 3*3600,
+            'num_files_combined': 3,
+            'inflow_tool': 'ldas'}
+
+@register_lsm_grid
+def detect_joules_grid(file_info):
+    """
+    Met Office Joules
+    """
+    if file_info['institution'] != "Met Office, UK":
+        return None
+
+    print "Runoff file identified as Joules GRID"
+    #time units are in minutes
+    if file_info['file_size_time'] != 1:
+        raise Exception("Unsupported LIS time step.")
+    return {'description': "Met Office Joules Hourly Runoff",
+            'model_name': "met_office",
+            'weight_file_name': r'weight_joules\.csv',
+            'grid_type': 'joules',
+            #hourly files combined in 3-hourly time steps
+            'time_step': 3*3600,
+            'num_files_combined': 3,
+            'inflow_tool': 'ldas'}
+
+@register_lsm_grid
+def detect_ldas_grid(file_info):
+    """
+    GLDAS and NLDAS
+    """
+    if not file_info['surface_runoff_var'].startswith("SSRUN") \
+        or not file_info['subsurface_runoff_var'].startswith("BGRUN"):
+        return None
+
+    if file_info['lat_dim_size'] == 600 and file_info['lon_dim_size'] == 1440:
+        print "Runoff file identified as GLDAS GRID"
+        #GLDAS NC FILE
+        #dimensions:
+        #    g0_lat_0 = 600 ;
+        #    g0_lon_1 = 1440 ;
+        #variables
+        #SSRUN_GDS0_SFC_ave1h (surface), BGRUN_GDS0_SFC_ave1h (subsurface)
+        # or
+        #SSRUNsfc_GDS0_SFC_ave1h (surface), BGRUNsfc_GDS0_SFC_ave1h (subsurface)
+        if file_info['file_size_time'] != 1:
+            raise Exception("Unsupported GLDAS time step.")
+        return {'description': "GLDAS 3 Hourly Runoff",
+                'model_name': "nasa",
+                'weight_file_name': r'weight_gldas\.csv',
+                'grid_type': 'gldas',
+                'time_step': 3*3600, #3 hourly
+                'inflow_tool': 'ldas'}
+
+    if file_info['lat_dim_size'] <= 224 and file_info['lon_dim_size'] <= 464:
+        print "Runoff file identified as NLDAS GRID"
+        #NLDAS MOSAIC FILE
+        #dimensions:
+        #    g0_lat_0 = 224 ;
+        #    g0_lon_1 = 464 ;
+        #NLDAS NOAH/VIC FILE
+        #dimensions:
+        #    lat_110 = 224 ;
+        #    lon_110 = 464 ;
+        if file_info['file_size_time'] != 1:
+            raise Exception("Unsupported NLDAS time step.")
+        return {'description': "NLDAS Hourly Runoff",
+                'model_name': "nasa",
+                'weight_file_name': r'weight_nldas\.csv',
+                'grid_type': 'nldas',
+                #hourly files combined in 3-hourly time steps
+                'time_step': 3*3600,
+                'num_files_combined': 3,
+                'inflow_tool': 'ldas'}
+
+    raise Exception("Unsupported runoff grid.")
+
+@register_lsm_grid
+def detect_wrf_hydro_grid(file_info):
+    """
+    WRF-Hydro
+    """
+    if "WRF" not in file_info['title']:
+        return None
+
+    print "Runoff file identified as WRF-Hydro GRID"
+    return {'description': "WRF-Hydro Hourly Runoff",
+            'model_name': "",
+            'weight_file_name': r'weight_wrf\.csv',
+            'grid_type': 'wrf_hydro',
+            'time_step': 1*3600, #1 hourly
+            'inflow_tool': 'wrf_hydro'}
+
+#------------------------------------------------------------------------------
+#DETECTION
+#------------------------------------------------------------------------------
+def _find_name(name_list, candidates, default):
+    """
+    First of the candidate names in the list
+    """
+    for candidate in candidates:
+        if candidate in name_list:
+            return candidate
+    return default
+
+def get_lsm_file_info(lsm_file):
+    """
+    Identify the dimensions and variables of an LSM file
+    (netCDF4 Dataset or LSMFileHeader)
+    """
+    #INDENTIFY LAT/LON DIMENSIONS
+    dim_list = lsm_file.dimensions.keys()
+    #GLDAS/NLDAS MOSAIC, NLDAS NOAH/VIC, LIS/Joules, WRF Hydro
+    latitude_dim = _find_name(dim_list, ('latitude', 'g0_lat_0', 'lat_110', 'north_south', 'south_north'), "lat")
+    longitude_dim = _find_name(dim_list, ('longitude', 'g0_lon_1', 'lon_110', 'east_west', 'west_east'), "lon")
+
+    #IDENTIFY VARIABLES
+    var_list = lsm_file.variables.keys()
+    latitude_var = _find_name(var_list, ('latitude', 'g0_lat_0', 'lat_110', 'north_south', 'XLAT'), "lat")
+    longitude_var = _find_name(var_list, ('longitude', 'g0_lon_1', 'lon_110', 'east_west', 'XLONG'), "lon")
+
+    surface_runoff_var=""
+    subsurface_runoff_var=""
+    for var in var_list:
+        if var.startswith("SSRUN"):
+            #NLDAS/GLDAS
+            surface_runoff_var = var
+        elif var.startswith("BGRUN"):
+            #NLDAS/GLDAS
+            subsurface_runoff_var = var
+        elif var == "Qs_inst":
+            #LIS
+            surface_runoff_var = var
+        elif var == "Qsb_inst":
+            #LIS
+            subsurface_runoff_var = var
+        elif var == "SFROFF":
+            #WRF Hydro
+            surface_runoff_var = var
+        elif var == "UDROFF":
+            #WRF Hydro
+            subsurface_runoff_var = var
+        elif var.lower() == "ro":
+            #ERA Interim
+            surface_runoff_var = var
+
+    time_dim = "Time" if "Time" in lsm_file.dimensions else "time"
+    try:
+        file_size_time = len(lsm_file.dimensions[time_dim])
+    except KeyError as ex:
+        print "ERROR:", ex
+        print "Assuming time dimension is 1"
+        file_size_time = 1
+
+    attributes = {}
+    for attr_name in ('institution', 'TITLE'):
+        try:
+            attributes[attr_name] = lsm_file.getncattr(attr_name)
+        except AttributeError:
+            attributes[attr_name] = ""
+
+    return {'latitude_dim': latitude_dim,
+            'longitude_dim': longitude_dim,
+            'lat_dim_size': len(lsm_file.dimensions[latitude_dim]),
+            'lon_dim_size': len(lsm_file.dimensions[longitude_dim]),
+            'latitude_var': latitude_var,
+            'longitude_var': longitude_var,
+            'surface_runoff_var': surface_runoff_var,
+            'subsurface_runoff_var': subsurface_runoff_var,
+            'file_size_time': file_size_time,
+            'institution': attributes['institution'],
+            'title': attributes['TITLE']}
+
+def get_lsm_file_signature(lsm_file):
+    """
+    Hash of the dimensions, variables and text global attributes of an
+    LSM file and of the registered detectors. Files with the same
+    signature have the same grid.
+    """
+    attributes = {}
+    for attr_name in lsm_file.ncattrs():
+        attr_value = lsm_file.getncattr(attr_name)
+        if isinstance(attr_value, basestring):
+            attributes[attr_name] = attr_value
+    signature = [LSM_GRID_DETECTOR_VERSION,
+                 [detector.__name__ for detector in LSM_GRID_DETECTORS],
+                 sorted((dim_name, len(dim)) for dim_name, dim in lsm_file.dimensions.iteritems()),
+                 sorted((var_name, list(getattr(var, 'dimensions', var)))
+                        for var_name, var in lsm_file.variables.iteritems()),
+                 sorted(attributes.iteritems())]
+    return sha1(json.dumps(signature)).hexdigest()
+
+class LSMGridDetector(object):
+    """
+    Detects the grid of the LSM files with the registered detectors.
+    The grids are memoized by file signature and, with a catalog
+    (LSMFileCatalog), stored so the files are not probed again in
+    the next runs.
+    """
+    def __init__(self, lsm_file_catalog=None):
+        self.lsm_file_catalog = lsm_file_catalog
+        self.grids = {}
+
+    def detect(self, lsm_file):
+        """
+        Get the LSMGridDescriptor of an LSM file
+        (netCDF4 Dataset or LSMFileHeader)
+        """
+        signature = get_lsm_file_signature(lsm_file)
+        if signature in self.grids:
+            return self.grids[signature]
+
+        grid_dict = None
+        if self.lsm_file_catalog is not None:
+            grid_dict = self.lsm_file_catalog.get_grid_descriptor(signature)
+        if grid_dict is not None:
+            grid = LSMGridDescriptor(**grid_dict)
+            print "Runoff file identified as {0} (cached)".format(grid.description)
+        else:
+            grid = self.probe(lsm_file)
+            if self.lsm_file_catalog is not None:
+                self.lsm_file_catalog.set_grid_descriptor(signature, grid.to_dict())
+        self.grids[signature] = grid
+        return grid
+
+    def probe(self, lsm_file):
+        """
+        Run the registered detectors on an LSM file
+        """
+        file_info = get_lsm_file_info(lsm_file)
+        for detector in LSM_GRID_DETECTORS:
+            grid_dict = detector(file_info)
+            if grid_dict is not None:
+                grid_dict.setdefault('num_files_combined', 1)
+                grid_dict['file_size_time'] = file_info['file_size_time']
+                for field in ('latitude_dim', 'longitude_dim', 'lat_dim_size', 'lon_dim_size',
+                              'latitude_var', 'longitude_var',
+                              'surface_runoff_var', 'subsurface_runoff_var'):
+                    grid_dict[field] = file_info[field]
+                return LSMGridDescriptor(**grid_dict)
+        raise Exception("Unsupported runoff grid.")
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+##
+##  rapid_run_scheduler.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import deque
+from contextlib import contextmanager
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
+import shutil
+
+@contextmanager
+def rapid_work_directory(output_directory, out_file_ending):
+    """
+    Run in a work directory of the RAPID job within output_directory.
+    RAPIDpy writes the namelist and the link to the executable in the
+    working directory, so the jobs of a watershed running at the same
+    time (e.g. the ensemble members) each need their own.
+    The directory is removed after the job.
+    """
+    work_directory = os.path.join(output_directory,
+                                  'rapid_work_{0}'.format(out_file_ending[:-3]))
+    if os.path.exists(work_directory):
+        shutil.rmtree(work_directory)
+    os.makedirs(work_directory)
+    previous_directory = os.getcwd()
+    os.chdir(work_directory)
+    try:
+        yield work_directory
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+class NonDaemonicProcess(multiprocessing.Process):
+    """
+    Pool process that is allowed to start its own pool
+    (e.g. for the return periods)
+    """
+    def _get_daemon(self):
+        return False
+    def _set_daemon(self, value):
+        pass
+    daemon = property(_get_daemon, _set_daemon)
+
+class NonDaemonicPool(multiprocessing.pool.Pool):
+    """
+    Pool of NonDaemonicProcess workers
+    """
+    Process = NonDaemonicProcess
+
+class RapidRunScheduler(object):
+    """
+    Runs the RAPID simulations of the watersheds as soon as their
+    inflow is written, while the inflow of the other watersheds
+    is still being generated.
+
+    All of the cores are shared between the RAPID runs and the inflow
+    workers. A RAPID run starts when enough cores are free for its
+    processors and the inflow scheduler gets the cores that are left.
+    The job keeps its cores for the return periods, which use them as
+    workers. Once these are done, the other downstream stages
+    (seasonal initialization, qinit) only hold one core.
+    """
+    def __init__(self, pool, job_function, stage_queue, num_cores,
+                 inflow_scheduler=None):
+        """
+        pool runs job_function for each watershed job. The job sends
+        ('release_processors', job_id) to stage_queue after the stages
+        that use all of its processors.
+        """
+        self.pool = pool
+        self.job_function = job_function
+        self.stage_queue = stage_queue
+        self.num_cores = max(1, num_cores)
+        self.inflow_scheduler = inflow_scheduler
+        self.pending_jobs = deque()
+        self.running_jobs = {}
+
+    def add_job(self, job_id, job_args, num_processors):
+        """
+        Add the RAPID job of a watershed once its inflow is ready
+        """
+        self.pending_jobs.append((job_id, job_args, min(max(1, num_processors),
+                                                         self.num_cores)))
+
+    def _num_rapid_cores(self):
+        """
+        Number of cores held by the RAPID jobs
+        """
+        return sum(running_job['num_cores'] for running_job in self.running_jobs.values())
+
+    def _num_inflow_cores(self):
+        """
+        Number of cores used by the inflow jobs already submitted
+        """
+        if self.inflow_scheduler is None:
+            return 0
+        return min(len(self.inflow_scheduler.jobs_in_flight),
+                   self.inflow_scheduler.pool_size)
+
+    def _update_stages(self):
+        """
+        Release the cores of the jobs that only use one now
+        """
+        while True:
+            try:
+                stage, job_id = self.stage_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if stage == 'release_processors' and job_id in self.running_jobs:
+                self.running_jobs[job_id]['num_cores'] = 1
+
+    def update(self):
+        """
+        Collect the finished jobs, start the pending ones and give
+        the remaining cores to the inflow workers.
+        Raises the exception of a job that failed.
+        """
+        self._update_stages()
+        for job_id, running_job in self.running_jobs.items():
+            if running_job['result'].ready():
+                del self.running_jobs[job_id]
+                running_job['result'].get()
+
+        while self.pending_jobs:
+            job_id, job_args, num_processors = self.pending_jobs[0]
+            #inflow jobs already submitted cannot be stopped, so the job
+            #waits for them to finish instead of going over the budget
+            if self._num_rapid_cores() + self._num_inflow_cores() + num_processors > self.num_cores:
+                break
+            self.pending_jobs.popleft()
+            print "Starting RAPID for {0} with {1} processors ...".format(job_id, num_processors)
+            self.running_jobs[job_id] = {'result': self.pool.apply_async(self.job_function, (job_args,)),
+                                         'num_cores': num_processors}
+
+        if self.inflow_scheduler is not None:
+            num_inflow_cores = self.num_cores - self._num_rapid_cores()
+            if self.pending_jobs and self.pending_jobs[0][2] <= num_inflow_cores:
+                #stop submitting inflow jobs so the next run can start
+                #as soon as the submitted ones are done
+                num_inflow_cores = 0
+            self.inflow_scheduler.set_num_workers(num_inflow_cores)
+
+    def is_finished(self):
+        """
+        True when all of the jobs are done
+        """
+        return not self.pending_jobs and not self.running_jobs
+
+    def wait(self):
+        """
+        Wait for all of the jobs to finish
+        """
+        while not self.is_finished():
+            self.update()
+            if self.running_jobs:
+                next(iter(self.running_jobs.values()))['result'].wait(1)
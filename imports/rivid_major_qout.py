@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+##
+##  rivid_major_qout.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import netCDF4 as NET
+import os
+
+#memory used to read the blocks of the Qout
+DEFAULT_TRANSPOSE_MEMORY_MB = 256
+#size of the compressed chunks of the rivid-major Qout
+CHUNK_SIZE_BYTES = 4*1024*1024
+
+def is_rivid_major_qout_current(qout_file, rivid_major_qout_file):
+    """
+    True if the rivid-major Qout was written after the Qout file
+    """
+    return os.path.exists(rivid_major_qout_file) and \
+           os.path.getmtime(rivid_major_qout_file) >= os.path.getmtime(qout_file)
+
+def write_rivid_major_qout(qout_file, rivid_major_qout_file,
+                           max_memory_mb=DEFAULT_TRANSPOSE_MEMORY_MB,
+                           complevel=4):
+    """
+    Write a copy of the RAPID Qout file with Qout stored as (rivid, time)
+    in compressed chunks, so the time series of a reach is contiguous.
+
+    The chunks are narrow in rivid and long in time, so the time series
+    of a reach is read with few chunks. The time-major Qout is read in
+    blocks of whole chunks of reaches (and of time steps if a block
+    does not fit in max_memory_mb), so every chunk is written once.
+    The other variables and attributes are copied as they are.
+    """
+    if is_rivid_major_qout_current(qout_file, rivid_major_qout_file):
+        print "Using rivid-major Qout {0} ...".format(rivid_major_qout_file)
+        return
+
+    print "Writing rivid-major Qout {0} ...".format(rivid_major_qout_file)
+    qout_nc = NET.Dataset(qout_file)
+    rivid_major_nc = NET.Dataset(rivid_major_qout_file + "_tmp", "w", format="NETCDF4")
+    try:
+        qout_var = qout_nc.variables['Qout']
+        time_dim, rivid_dim = qout_var.dimensions
+        if time_dim.lower() != 'time':
+            raise Exception("ERROR: Qout in {0} is not time-major ...".format(qout_file))
+        size_time, size_rivid = qout_var.shape
+
+        rivid_major_nc.setncatts({attr: qout_nc.getncattr(attr) for attr in qout_nc.ncattrs()})
+        for dim_name, dim in qout_nc.dimensions.iteritems():
+            rivid_major_nc.createDimension(dim_name, len(dim))
+
+        for var_name, var in qout_nc.variables.iteritems():
+            if var_name == 'Qout':
+                continue
+            var_attrs = {attr: var.getncattr(attr) for attr in var.ncattrs()}
+            out_var = rivid_major_nc.createVariable(var_name, var.dtype, var.dimensions,
+                                                    fill_value=var_attrs.pop('_FillValue', None))
+            out_var.setncatts(var_attrs)
+            if var.dimensions:
+                out_var[:] = var[:]
+            else:
+                out_var.assignValue(var.getValue())
+
+        #the time series of whole reaches, up to CHUNK_SIZE_BYTES each chunk
+        itemsize = qout_var.dtype.itemsize
+        chunk_size_rivid = int(max(1, min(size_rivid, CHUNK_SIZE_BYTES // (size_time*itemsize))))
+        chunk_size_time = int(max(1, min(size_time, CHUNK_SIZE_BYTES // (chunk_size_rivid*itemsize))))
+        #each block is read at once (and copied by the transpose) and fills whole chunks
+        max_memory_bytes = max_memory_mb*1024*1024 // 2
+        block_size_time = int(min(size_time,
+                                  chunk_size_time*max(1, max_memory_bytes //
+                                                      (chunk_size_rivid*chunk_size_time*itemsize))))
+        block_size_rivid = int(min(size_rivid,
+                                   chunk_size_rivid*max(1, max_memory_bytes //
+                                                        (chunk_size_rivid*block_size_time*itemsize))))
+        qout_attrs = {attr: qout_var.getncattr(attr) for attr in qout_var.ncattrs()}
+        rivid_major_var = rivid_major_nc.createVariable('Qout', qout_var.dtype, (rivid_dim, time_dim),
+                                                        fill_value=qout_attrs.pop('_FillValue', None),
+                                                        zlib=True,
+                                                        complevel=complevel,
+                                                        shuffle=True,
+                                                        chunksizes=(chunk_size_rivid, chunk_size_time))
+        rivid_major_var.setncatts(qout_attrs)
+
+        for rivid_index in xrange(0, size_rivid, block_size_rivid):
+            rivid_end = min(rivid_index + block_size_rivid, size_rivid)
+            for time_index in xrange(0, size_time, block_size_time):
+                time_end = min(time_index + block_size_time, size_time)
+                rivid_major_var[rivid_index:rivid_end, time_index:time_end] = \
+                    qout_var[time_index:time_end, rivid_index:rivid_end].T
+    finally:
+        qout_nc.close()
+        rivid_major_nc.close()
+    if os.path.exists(rivid_major_qout_file):
+        os.remove(rivid_major_qout_file)
+    os.rename(rivid_major_qout_file + "_tmp", rivid_major_qout_file)
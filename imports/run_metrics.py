@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+##
+##  run_metrics.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import OrderedDict
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import threading
+from time import time
+
+METRICS_FORMATS = ("jsonl", "prometheus")
+#counters of a stage, summed over the records
+METRICS_COUNTERS = ('num_files', 'bytes_read', 'bytes_written', 'reach_time_steps',
+                    'prefetch_wait_seconds')
+#labels of the records kept in the Prometheus metrics
+#(the per file labels, e.g. qout_file and inflow_file, are summed over)
+METRICS_LABELS = ('stage', 'watershed', 'subbasin', 'ensemble', 'worker')
+
+def get_cpu_seconds():
+    """
+    User and system CPU time of this process
+    """
+    process_times = os.times()
+    return process_times[0] + process_times[1]
+
+class StageMetrics(object):
+    """
+    Wall time, CPU time and counters of a running stage.
+    Used as a context manager, the stage is recorded when it ends.
+    """
+    def __init__(self, recorder, stage, labels):
+        self.recorder = recorder
+        self.stage = stage
+        self.labels = labels
+        self.counts = dict((counter, 0) for counter in METRICS_COUNTERS)
+
+    def add(self, **counts):
+        """
+        Add to the counters of the stage (e.g. bytes_read=...)
+        """
+        with self.recorder.lock:
+            for counter, count in counts.iteritems():
+                self.counts[counter] += count
+
+    def __enter__(self):
+        self.wall_start = time()
+        self.cpu_start = get_cpu_seconds()
+        with self.recorder.lock:
+            #the labels of the enclosing stages (e.g. watershed) are kept
+            labels = {}
+            for stage_metrics in self.recorder.active_stages:
+                labels.update(stage_metrics.labels)
+            labels.update(self.labels)
+            self.labels = labels
+            self.recorder.active_stages.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.recorder.lock:
+            self.recorder.active_stages.remove(self)
+        self.recorder.record_stage(self.stage,
+                                   time() - self.wall_start,
+                                   get_cpu_seconds() - self.cpu_start,
+                                   self.counts,
+                                   **self.labels)
+
+class MetricsRecorder(object):
+    """
+    Records the time and throughput of the stages of a run.
+
+    Each stage is one JSON line appended to records_file, so the records
+    of all the worker processes end up in the same file. Without a
+    records_file, nothing is recorded.
+    """
+    def __init__(self, records_file=None, run_id=None):
+        self.records_file = records_file
+        self.run_id = run_id
+        self.lock = threading.RLock()
+        self.active_stages = []
+
+    def stage(self, stage, **labels):
+        """
+        Context manager timing a stage with labels (e.g. watershed)
+        """
+        return StageMetrics(self, stage, labels)
+
+    def add(self, **counts):
+        """
+        Add to the counters of the running stages of this process,
+        e.g. the bytes read by the converters
+        """
+        with self.lock:
+            for stage_metrics in self.active_stages:
+                stage_metrics.add(**counts)
+
+    def record_stage(self, stage, wall_seconds, cpu_seconds, counts=None, **labels):
+        """
+        Record a stage that was timed separately
+        """
+        if self.records_file is None:
+            return
+        record = OrderedDict([('time', datetime.utcnow().isoformat()),
+                              ('run', self.run_id),
+                              ('stage', stage),
+                              ('worker', multiprocessing.current_process().name)])
+        record.update(sorted(labels.iteritems()))
+        record['wall_seconds'] = wall_seconds
+        record['cpu_seconds'] = cpu_seconds
+        for counter in METRICS_COUNTERS:
+            record[counter] = (counts or {}).get(counter, 0)
+        if wall_seconds > 0:
+            record['files_per_second'] = record['num_files']/wall_seconds
+            record['reach_time_steps_per_second'] = record['reach_time_steps']/wall_seconds
+        #one write in append mode, so the lines of the processes do not mix
+        records_fd = os.open(self.records_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(records_fd, json.dumps(record) + "\n")
+        finally:
+            os.close(records_fd)
+
+#recorder of this process (set up in the main process and in the workers)
+METRICS = MetricsRecorder()
+
+def configure_metrics(records_file, run_id=None):
+    """
+    Set the records file of the recorder of this process
+    """
+    METRICS.records_file = records_file
+    METRICS.run_id = run_id
+
+def get_metrics_records_file(metrics_file, metrics_format):
+    """
+    The records are written as JSON lines. For the Prometheus
+    textfile, they are kept next to it and summarized at the end.
+    """
+    if metrics_format not in METRICS_FORMATS:
+        raise Exception("ERROR: Invalid metrics format {0}. Options: {1} ...".format(metrics_format,
+                                                                                   METRICS_FORMATS))
+    if metrics_format == "jsonl":
+        return metrics_file
+    return "{0}.jsonl".format(os.path.splitext(metrics_file)[0])
+
+def read_metrics_records(records_file, run_id=None):
+    """
+    Read the records of a run (all runs without run_id)
+    """
+    records = []
+    with open(records_file) as records_jsonl:
+        for line in records_jsonl:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if run_id is None or record.get('run') == run_id:
+                records.append(record)
+    return records
+
+def _escape_label_value(value):
+    return unicode(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def write_prometheus_textfile(records, prometheus_file, metric_prefix="lsm_rapid_stage"):
+    """
+    Write the records summed by stage, watershed, subbasin, ensemble and
+    worker in the Prometheus text format (for the node exporter textfile
+    collector). The other labels of the records (e.g. qout_file and
+    inflow_file) are summed over. The counters end with _total.
+    The file is replaced at once.
+    """
+    summaries = OrderedDict()
+    for record in records:
+        labels = tuple((label, record[label]) for label in METRICS_LABELS
+                       if record.get(label) is not None)
+        summary = summaries.setdefault(labels, dict([('count', 0), ('wall_seconds', 0), ('cpu_seconds', 0)] +
+                                                    [(counter, 0) for counter in METRICS_COUNTERS]))
+        summary['count'] += 1
+        for value_name in ['wall_seconds', 'cpu_seconds'] + list(METRICS_COUNTERS):
+            summary[value_name] += record.get(value_name, 0)
+    for summary in summaries.itervalues():
+        if summary['wall_seconds'] > 0:
+            summary['files_per_second'] = summary['num_files']/summary['wall_seconds']
+            summary['reach_time_steps_per_second'] = summary['reach_time_steps']/summary['wall_seconds']
+
+    metrics = [('count', 'counter', "Number of times the stage ran"),
+               ('wall_seconds', 'counter', "Wall time of the stage"),
+               ('cpu_seconds', 'counter', "CPU time of the stage process"),
+               ('num_files', 'counter', "Runoff files converted"),
+               ('bytes_read', 'counter', "Bytes read from the input files"),
+               ('bytes_written', 'counter', "Bytes written to the output files"),
+               ('reach_time_steps', 'counter', "Reach time steps processed"),
+               ('prefetch_wait_seconds', 'counter', "Time waited for the prefetched runoff files"),
+               ('files_per_second', 'gauge', "Runoff files converted per second"),
+               ('reach_time_steps_per_second', 'gauge', "Reach time steps processed per second")]
+    lines = []
+    for value_name, metric_type, metric_help in metrics:
+        metric_name = "{0}_{1}".format(metric_prefix, value_name)
+        if metric_type == 'counter':
+            metric_name += "_total"
+        lines.append("# HELP {0} {1}".format(metric_name, metric_help))
+        lines.append("# TYPE {0} {1}".format(metric_name, metric_type))
+        for labels, summary in summaries.iteritems():
+            if value_name not in summary:
+                continue
+            label_text = ",".join(u"{0}=\"{1}\"".format(label, _escape_label_value(value))
+                                  for label, value in labels)
+            lines.append(u"{0}{{{1}}} {2}".format(metric_name, label_text, repr(float(summary[value_name]))))
+
+    with open(prometheus_file + "_tmp", 'w') as prometheus_textfile:
+        prometheus_textfile.write((u"\n".join(lines) + u"\n").encode("utf-8"))
+    if os.path.exists(prometheus_file):
+        os.remove(prometheus_file)
+    os.rename(prometheus_file + "_tmp", prometheus_file)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+##
+##  runoff_deaccumulation.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import numpy as NUM
+
+def deaccumulate_runoff(runoff_cells, reset_interval=None, previous_runoff=None):
+    """
+    Convert the cumulative runoff of the weighted cells (..., time, cells)
+    to the runoff of each time step in place, one time step at a time
+    for all of the cells, so no temporary arrays are made.
+
+    With reset_interval, the accumulation restarts from zero every
+    reset_interval time steps (e.g. every 4 steps of 3 hours for
+    ERA Interim T255), so the first step of each period is kept.
+    Otherwise, previous_runoff is the cumulative runoff before the first
+    time step (e.g. the last time step of the previous file), which is
+    subtracted from it (masked values count as zero).
+    """
+    runoff_values = NUM.ma.getdata(runoff_cells)
+    runoff_mask = NUM.ma.getmask(runoff_cells)
+    size_time = runoff_values.shape[-2]
+    #backwards, so each time step is used before it is changed
+    for time_index in xrange(size_time - 1, 0, -1):
+        if reset_interval and time_index % reset_interval == 0:
+            continue
+        NUM.subtract(runoff_values[..., time_index, :],
+                     runoff_values[..., time_index - 1, :],
+                     out=runoff_values[..., time_index, :])
+        if runoff_mask is not NUM.ma.nomask:
+            NUM.logical_or(runoff_mask[..., time_index, :],
+                           runoff_mask[..., time_index - 1, :],
+                           out=runoff_mask[..., time_index, :])
+    if previous_runoff is not None and not reset_interval:
+        NUM.subtract(runoff_values[..., 0, :],
+                     NUM.ma.filled(previous_runoff, 0),
+                     out=runoff_values[..., 0, :])
+    return runoff_cells
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+##
+##  runoff_prefetcher.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import threading
+from time import time
+
+from run_metrics import METRICS
+
+#number of runoff files read ahead of the one being converted
+DEFAULT_PREFETCH_DEPTH = 2
+#the netCDF library is not thread safe, so only one thread reads at a time
+NETCDF_READ_LOCK = threading.Lock()
+
+class RunoffFilePrefetcher(object):
+    """
+    Reads the next runoff files in background threads while the
+    current one is converted, so the file system latency and the
+    computation overlap.
+
+    At most prefetch_depth files are read ahead, which bounds the
+    memory used. The read function must hold NETCDF_READ_LOCK when it
+    uses the netCDF library. The time spent waiting for each file is
+    kept in wait_seconds and added to the prefetch_wait_seconds of the
+    running stages (see METRICS).
+    """
+    def __init__(self, read_function, file_list,
+                 prefetch_depth=DEFAULT_PREFETCH_DEPTH, num_threads=1):
+        self.read_function = read_function
+        self.file_list = file_list
+        self.prefetch_depth = max(0, prefetch_depth)
+        self.num_threads = max(1, num_threads)
+        self.wait_seconds = []
+
+    def _get_file(self, read_result):
+        """
+        Wait for the read of a file and record the time waited
+        """
+        time_start = time()
+        data = read_result()
+        self.wait_seconds.append(time() - time_start)
+        METRICS.add(prefetch_wait_seconds=self.wait_seconds[-1])
+        return data
+
+    def __iter__(self):
+        """
+        Yields (runoff_file, data read) in order
+        """
+        if self.prefetch_depth == 0:
+            for runoff_file in self.file_list:
+                yield runoff_file, self._get_file(lambda: self.read_function(runoff_file))
+            print "Total time reading runoff files: {0:.2f} s".format(sum(self.wait_seconds))
+            return
+
+        pool = ThreadPool(self.num_threads)
+        read_queue = deque()
+        try:
+            file_iter = iter(self.file_list)
+            for runoff_file in file_iter:
+                read_queue.append((runoff_file, pool.apply_async(self.read_function, (runoff_file,))))
+                if len(read_queue) > self.prefetch_depth:
+                    break
+            while read_queue:
+                runoff_file, read_result = read_queue.popleft()
+                data = self._get_file(read_result.get)
+                #start the next read before the current file is converted
+                for next_runoff_file in file_iter:
+                    read_queue.append((next_runoff_file, pool.apply_async(self.read_function, (next_runoff_file,))))
+                    break
+                yield runoff_file, data
+        finally:
+            pool.terminate()
+            pool.join()
+        print "Total time waiting for runoff files: {0:.2f} s".format(sum(self.wait_seconds))
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+##
+##  runoff_weight_matrix.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import OrderedDict
+import csv
+import json
+import numpy as NUM
+import os
+from scipy.sparse import coo_matrix, csr_matrix
+
+#arrays stored in the compiled weight table cache
+WEIGHT_TABLE_ARRAYS = ['stream_id', 'area_sqm', 'lon_index', 'lat_index', 'npoints',
+                       'subset_index', 'row_cell_index', 'reach_offsets', 'bounds']
+WEIGHT_TABLE_CACHE_DIRECTORY = ".weight_table_cache"
+WEIGHT_TABLE_CACHE_VERSION = 1
+#number of weight matrices kept loaded in each process
+WEIGHT_MATRIX_MEMORY_CACHE_SIZE = 16
+#cost of one extra hyperslab read, in number of grid cells read
+READ_TILE_OVERHEAD_CELLS = 4096
+#maximum number of hyperslabs read from each runoff variable
+MAX_READ_TILES = 32
+
+errorMessages = ["Incorrect number of columns in the weight table",
+                 "No or incorrect header in the weight table",
+                 "Incorrect sequence of rows in the weight table"]
+
+#----------------------------------------------------------------------------------------
+# WEIGHT TABLE FUNCTIONS
+#----------------------------------------------------------------------------------------
+def parse_weight_table_csv(in_weight_table, header_wt):
+    """
+    Read in the columns of the CSV weight table as arrays
+    """
+    num_columns = len(header_wt)
+    with open(in_weight_table, "rb") as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, None)
+        #check number of columns in the weight table
+        if header is None or len(header) < num_columns:
+            raise Exception(errorMessages[0])
+        #check header
+        if header[1:num_columns] != header_wt[1:]:
+            raise Exception(errorMessages[1])
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            #a short row would shift the columns of the table
+            if len(row) != len(header):
+                raise Exception("ERROR: Line {0} of {1} has {2} fields instead of {3} ...".format(reader.line_num,
+                                                                                                 in_weight_table,
+                                                                                                 len(row),
+                                                                                                 len(header)))
+            rows.append(row[:num_columns])
+        columns = zip(*rows)
+
+    if not columns:
+        raise Exception(errorMessages[2])
+
+    return [NUM.array(column, dtype=NUM.float64) for column in columns]
+
+def compile_weight_table(stream_id, area_sqm, lon_index, lat_index, npoints):
+    """
+    Compile the weight table columns into typed arrays with the
+    reach offsets and the flattened indices of the weighted cells
+    """
+    stream_id = NUM.asarray(stream_id, dtype=NUM.int64)
+    area_sqm = NUM.asarray(area_sqm, dtype=NUM.float64)
+    lon_index = NUM.asarray(lon_index, dtype=NUM.int64)
+    lat_index = NUM.asarray(lat_index, dtype=NUM.int64)
+    npoints = NUM.asarray(npoints, dtype=NUM.int64)
+    num_rows = len(stream_id)
+    if num_rows == 0:
+        raise Exception(errorMessages[2])
+
+    #each reach is a contiguous run of npoints rows with the same StreamID
+    reach_offsets = NUM.concatenate([[0], NUM.flatnonzero(stream_id[1:] != stream_id[:-1]) + 1])
+    reach_npoints = NUM.diff(NUM.append(reach_offsets, num_rows))
+    if (npoints[reach_offsets] != reach_npoints).any() \
+        or len(NUM.unique(stream_id)) != len(reach_offsets):
+        bad_reach = NUM.flatnonzero(npoints[reach_offsets] != reach_npoints)
+        if len(bad_reach) > 0:
+            print "ROW INDEX", reach_offsets[bad_reach[0]]
+            print "COMID", stream_id[reach_offsets[bad_reach[0]]]
+        raise Exception(errorMessages[2])
+
+    #bounding box of the runoff grid needed for this weight table
+    bounds = NUM.array([lat_index.min(), lat_index.max(),
+                        lon_index.min(), lon_index.max()], dtype=NUM.int64)
+    len_lon_subset_all = bounds[3] - bounds[2] + 1
+
+    #unique cells as flattened indices into the bounding box subset
+    row_subset_index = (lat_index - bounds[0]) * len_lon_subset_all + (lon_index - bounds[2])
+    subset_index, row_cell_index = NUM.unique(row_subset_index, return_inverse=True)
+
+    return {'stream_id': stream_id,
+            'area_sqm': area_sqm,
+            'lon_index': lon_index,
+            'lat_index': lat_index,
+            'npoints': npoints,
+            'subset_index': subset_index.astype(NUM.int64),
+            'row_cell_index': row_cell_index.astype(NUM.int64),
+            'reach_offsets': reach_offsets.astype(NUM.int64),
+            'bounds': bounds}
+
+def get_weight_table_cache_directory(in_weight_table):
+    """
+    Location of the compiled cache of the weight table.
+    It is kept in a hidden folder so that the file searches
+    in the watershed input directory do not pick it up.
+    """
+    in_weight_table = os.path.abspath(in_weight_table)
+    return os.path.join(os.path.dirname(in_weight_table),
+                        WEIGHT_TABLE_CACHE_DIRECTORY,
+                        os.path.splitext(os.path.basename(in_weight_table))[0])
+
+def get_weight_table_signature(in_weight_table, header_wt):
+    """
+    Signature used to invalidate the compiled cache when the CSV changes
+    """
+    weight_table_stat = os.stat(in_weight_table)
+    return {'path': os.path.abspath(in_weight_table),
+            'mtime': weight_table_stat.st_mtime,
+            'size': weight_table_stat.st_size,
+            'header': list(header_wt),
+            'version': WEIGHT_TABLE_CACHE_VERSION}
+
+def _write_weight_table_cache(cache_directory, signature, compiled_table):
+    """
+    Write the compiled weight table arrays to the cache directory.
+    The signature is written last, so a partially written cache is never valid.
+    """
+    try:
+        os.makedirs(cache_directory)
+    except OSError:
+        pass
+
+    signature_file = os.path.join(cache_directory, "signature.json")
+    try:
+        os.remove(signature_file)
+    except OSError:
+        pass
+
+    temp_suffix = ".{0}.tmp".format(os.getpid())
+    for array_name in WEIGHT_TABLE_ARRAYS:
+        array_file = os.path.join(cache_directory, "{0}.npy".format(array_name))
+        with open(array_file + temp_suffix, "wb") as temp_file:
+            NUM.save(temp_file, NUM.ascontiguousarray(compiled_table[array_name]))
+        os.rename(array_file + temp_suffix, array_file)
+
+    with open(signature_file + temp_suffix, "w") as temp_file:
+        json.dump(signature, temp_file)
+    os.rename(signature_file + temp_suffix, signature_file)
+
+def _read_weight_table_cache(cache_directory, signature):
+    """
+    Memory-map the compiled weight table arrays if the cache is valid
+    """
+    try:
+        with open(os.path.join(cache_directory, "signature.json")) as signature_file:
+            if json.load(signature_file) != signature:
+                return None
+        return dict((array_name,
+                     NUM.load(os.path.join(cache_directory, "{0}.npy".format(array_name)),
+                              mmap_mode='r'))
+                    for array_name in WEIGHT_TABLE_ARRAYS)
+    except (IOError, OSError, ValueError):
+        return None
+
+def read_weight_table(in_weight_table, header_wt):
+    """
+    Read in the compiled weight table, parsing the CSV
+    only if the compiled cache is missing or out of date
+    """
+    signature = get_weight_table_signature(in_weight_table, header_wt)
+    cache_directory = get_weight_table_cache_directory(in_weight_table)
+    compiled_table = _read_weight_table_cache(cache_directory, signature)
+    if compiled_table is None:
+        print "Compiling the weight table", in_weight_table, "..."
+        compiled_table = compile_weight_table(*parse_weight_table_csv(in_weight_table, header_wt))
+        try:
+            _write_weight_table_cache(cache_directory, signature, compiled_table)
+        except (IOError, OSError) as ex:
+            print "WARNING: Unable to write weight table cache:", ex
+    return compiled_table
+
+#----------------------------------------------------------------------------------------
+# READ PLANNER
+#----------------------------------------------------------------------------------------
+def _get_tile_cost(cell_lat_index, cell_lon_index, read_overhead_cells):
+    """
+    Cost of reading the bounding box of the cells in one hyperslab
+    """
+    return read_overhead_cells + \
+           (cell_lat_index.max() - cell_lat_index.min() + 1) * \
+           (cell_lon_index.max() - cell_lon_index.min() + 1)
+
+def _get_best_tile_split(cell_lat_index, cell_lon_index, cell_positions, read_overhead_cells):
+    """
+    Find the split of a tile that saves the most read cost.
+    The candidates are the largest gap (e.g. across the dateline) and
+    the median along each axis (e.g. long, thin or diagonal basins).
+    Returns (saving, cell positions of each half).
+    """
+    tile_lat_index = cell_lat_index[cell_positions]
+    tile_lon_index = cell_lon_index[cell_positions]
+    tile_cost = _get_tile_cost(tile_lat_index, tile_lon_index, read_overhead_cells)
+    best_split = (0, None, None)
+    for axis_index in (tile_lat_index, tile_lon_index):
+        unique_index = NUM.unique(axis_index)
+        if len(unique_index) < 2:
+            continue
+        for split_value in (unique_index[NUM.argmax(NUM.diff(unique_index))],
+                            unique_index[len(unique_index)//2 - 1]):
+            first_half = axis_index <= split_value
+            split_cost = _get_tile_cost(tile_lat_index[first_half], tile_lon_index[first_half],
+                                        read_overhead_cells) + \
+                         _get_tile_cost(tile_lat_index[~first_half], tile_lon_index[~first_half],
+                                        read_overhead_cells)
+            if tile_cost - split_cost > best_split[0]:
+                best_split = (tile_cost - split_cost,
+                              cell_positions[first_half],
+                              cell_positions[~first_half])
+    return best_split
+
+def plan_read_tiles(cell_lat_index, cell_lon_index,
+                    read_overhead_cells=READ_TILE_OVERHEAD_CELLS,
+                    max_tiles=MAX_READ_TILES):
+    """
+    Cluster the weighted cells into compact tiles to read instead of
+    the whole bounding box. A tile is split while the cells saved are
+    worth more than the overhead of one more read.
+    Returns a list of (lat_slice, lon_slice, cell_positions) where
+    cell_positions are the indices of the cells of the tile.
+    """
+    tiles = [NUM.arange(len(cell_lat_index))]
+    tile_splits = [_get_best_tile_split(cell_lat_index, cell_lon_index,
+                                        tiles[0], read_overhead_cells)]
+    while len(tiles) < max_tiles:
+        tile_index = max(xrange(len(tiles)), key=lambda index: tile_splits[index][0])
+        saving, first_half, second_half = tile_splits[tile_index]
+        if saving <= 0:
+            break
+        tiles[tile_index:tile_index+1] = [first_half, second_half]
+        tile_splits[tile_index:tile_index+1] = [_get_best_tile_split(cell_lat_index, cell_lon_index,
+                                                                     cell_positions, read_overhead_cells)
+                                                for cell_positions in (first_half, second_half)]
+
+    return [(slice(cell_lat_index[cell_positions].min(), cell_lat_index[cell_positions].max()+1),
+             slice(cell_lon_index[cell_positions].min(), cell_lon_index[cell_positions].max()+1),
+             cell_positions)
+            for cell_positions in tiles]
+
+#----------------------------------------------------------------------------------------
+# WEIGHT MATRIX
+#----------------------------------------------------------------------------------------
+#weight matrices loaded in this process, most recently used last
+_WEIGHT_MATRIX_MEMORY_CACHE = OrderedDict()
+
+class RunoffWeightMatrix(object):
+    """
+    Sparse area weight matrix (cells x reaches) compiled from a RAPID weight table.
+
+    Each unique grid cell referenced by the weight table becomes one row
+    and each river reach one column, so a whole runoff time slab
+    (time x cells) is converted to inflow volumes (time x reaches)
+    with a single sparse matrix product.
+    """
+    def __init__(self, compiled_table):
+        reach_offsets = NUM.asarray(compiled_table['reach_offsets'])
+        num_rows = len(compiled_table['stream_id'])
+        size_streamID = len(reach_offsets)
+        bounds = [int(bound) for bound in compiled_table['bounds']]
+        subset_index = NUM.asarray(compiled_table['subset_index'])
+
+        reach_npoints = NUM.diff(NUM.append(reach_offsets, num_rows))
+        row_reach_index = NUM.repeat(NUM.arange(size_streamID), reach_npoints)
+        #duplicate (cell, reach) pairs are summed by the sparse constructor
+        matrix = csr_matrix((NUM.asarray(compiled_table['area_sqm']),
+                             (NUM.asarray(compiled_table['row_cell_index']), row_reach_index)),
+                            shape=(len(subset_index), size_streamID))
+
+        self._setup(bounds, subset_index, matrix,
+                    NUM.asarray(compiled_table['stream_id'])[reach_offsets])
+
+    def _setup(self, bounds, subset_index, matrix, stream_id, reach_splits=None):
+        """
+        Set the bounding box, the weighted cells and the sparse matrix
+        """
+        self.stream_id = stream_id
+        self.size_streamID = len(stream_id)
+        #index of the first reach of each combined weight table
+        self.reach_splits = NUM.array([0, self.size_streamID]) if reach_splits is None else reach_splits
+
+        #bounding box of the runoff grid needed for this weight table
+        self.min_lat_ind_all, self.max_lat_ind_all, \
+            self.min_lon_ind_all, self.max_lon_ind_all = bounds
+        self.lat_slice = slice(self.min_lat_ind_all, self.max_lat_ind_all+1)
+        self.lon_slice = slice(self.min_lon_ind_all, self.max_lon_ind_all+1)
+        self.len_lon_subset_all = self.max_lon_ind_all - self.min_lon_ind_all + 1
+
+        #unique cells as flattened indices into the bounding box subset
+        self.subset_index = subset_index
+        self.cell_lat_index = self.subset_index // self.len_lon_subset_all + self.min_lat_ind_all
+        self.cell_lon_index = self.subset_index % self.len_lon_subset_all + self.min_lon_ind_all
+        self.size_cells = len(self.subset_index)
+
+        self.matrix = matrix
+        #reach-major copy so that the product streams through contiguous rows
+        self._matrix_transpose = self.matrix.T.tocsr()
+
+        #hyperslabs to read from the runoff files, planned when first needed
+        self._read_tiles = None
+        self.gathered_bytes = 0
+
+    @classmethod
+    def combine(cls, weight_matrices):
+        """
+        Combine the weight matrices of several weight tables on the same grid,
+        so the runoff is read once and the inflow of all of them is calculated
+        in one pass. The reaches are ordered by weight table (see split).
+        """
+        if len(weight_matrices) == 1:
+            return weight_matrices[0]
+        bounds = [min(wm.min_lat_ind_all for wm in weight_matrices),
+                  max(wm.max_lat_ind_all for wm in weight_matrices),
+                  min(wm.min_lon_ind_all for wm in weight_matrices),
+                  max(wm.max_lon_ind_all for wm in weight_matrices)]
+        len_lon_subset_all = bounds[3] - bounds[2] + 1
+
+        #cells of each weight table in the combined bounding box
+        cell_subset_index_list = [(wm.cell_lat_index - bounds[0]) * len_lon_subset_all \
+                                  + (wm.cell_lon_index - bounds[2]) for wm in weight_matrices]
+        subset_index, cell_index = NUM.unique(NUM.concatenate(cell_subset_index_list),
+                                              return_inverse=True)
+
+        rows = []
+        columns = []
+        area_sqm = []
+        cell_offset = 0
+        reach_splits = [0]
+        for wm in weight_matrices:
+            wm_matrix = wm.matrix.tocoo()
+            rows.append(cell_index[cell_offset:cell_offset+wm.size_cells][wm_matrix.row])
+            columns.append(wm_matrix.col + reach_splits[-1])
+            area_sqm.append(wm_matrix.data)
+            cell_offset += wm.size_cells
+            reach_splits.append(reach_splits[-1] + wm.size_streamID)
+
+        matrix = coo_matrix((NUM.concatenate(area_sqm),
+                             (NUM.concatenate(rows), NUM.concatenate(columns))),
+                            shape=(len(subset_index), reach_splits[-1])).tocsr()
+
+        combined_matrix = cls.__new__(cls)
+        combined_matrix._setup(bounds, subset_index, matrix,
+                               NUM.concatenate([wm.stream_id for wm in weight_matrices]),
+                               NUM.array(reach_splits))
+        return combined_matrix
+
+    def split(self, m3_riv_block):
+        """
+        Split the inflow (time x reaches) of combined weight matrices
+        into the inflow of each weight table
+        """
+        return [m3_riv_block[..., self.reach_splits[i]:self.reach_splits[i+1]]
+                for i in xrange(len(self.reach_splits)-1)]
+
+    @classmethod
+    def from_weight_table(cls, in_weight_table, header_wt):
+        """
+        Read in weight table with the columns in header_wt.
+        If a list of weight tables is given, they are combined.
+        """
+        weight_table_list = in_weight_table if isinstance(in_weight_table, (list, tuple)) \
+                            else [in_weight_table]
+        #reuse the matrix if it was already loaded in this process (e.g. pool workers)
+        cache_key = (tuple(os.path.abspath(weight_table) for weight_table in weight_table_list),
+                     tuple(header_wt))
+        signature_list = [get_weight_table_signature(weight_table, header_wt)
+                          for weight_table in weight_table_list]
+        cached_matrix = _WEIGHT_MATRIX_MEMORY_CACHE.pop(cache_key, None)
+        if cached_matrix is None or cached_matrix[0] != signature_list:
+            if len(weight_table_list) > 1:
+                weight_matrix = cls.combine([cls.from_weight_table(weight_table, header_wt)
+                                             for weight_table in weight_table_list])
+            else:
+                weight_matrix = cls(read_weight_table(weight_table_list[0], header_wt))
+            cached_matrix = (signature_list, weight_matrix)
+        _WEIGHT_MATRIX_MEMORY_CACHE[cache_key] = cached_matrix
+        while len(_WEIGHT_MATRIX_MEMORY_CACHE) > WEIGHT_MATRIX_MEMORY_CACHE_SIZE:
+            _WEIGHT_MATRIX_MEMORY_CACHE.popitem(last=False)
+        return cached_matrix[1]
+
+    def subset(self, data_subset_all):
+        """
+        Extract the weighted cells from the bounding box subset of runoff
+        data with shape (..., lat, lon)
+        """
+        data_subset_all = data_subset_all.reshape(data_subset_all.shape[:-2] + (-1,))
+        return data_subset_all[..., self.subset_index]
+
+    def get_read_tiles(self):
+        """
+        Get the tiles read from the runoff files as a list of
+        (lat_slice, lon_slice, flat index of the cells in the tile,
+        cell positions)
+        """
+        if self._read_tiles is None:
+            self._read_tiles = []
+            for lat_slice, lon_slice, cell_positions in plan_read_tiles(self.cell_lat_index,
+                                                                        self.cell_lon_index):
+                tile_flat_index = (self.cell_lat_index[cell_positions] - lat_slice.start) \
+                                  * (lon_slice.stop - lon_slice.start) \
+                                  + self.cell_lon_index[cell_positions] - lon_slice.start
+                self._read_tiles.append((lat_slice, lon_slice, tile_flat_index, cell_positions))
+            if len(self._read_tiles) > 1:
+                box_size = (self.max_lat_ind_all - self.min_lat_ind_all + 1) * self.len_lon_subset_all
+                tile_size = sum((lat_slice.stop - lat_slice.start) * (lon_slice.stop - lon_slice.start)
+                                for lat_slice, lon_slice, tile_flat_index, cell_positions in self._read_tiles)
+                print "Reading {0} tiles with {1} cells instead of {2} cells in the bounding box ...".format(len(self._read_tiles),
+                                                                                                              tile_size,
+                                                                                                              box_size)
+        return self._read_tiles
+
+    def read_subset(self, runoff_var, leading_index=None):
+        """
+        Read the weighted cells from a runoff variable with shape (..., lat, lon).
+        Only the tiles of the read plan are read. leading_index selects
+        part of the leading dimensions (e.g. the last time step).
+        """
+        read_tiles = self.get_read_tiles()
+        if leading_index is None:
+            leading_index = (slice(None),) * (len(runoff_var.shape) - 2)
+        if len(read_tiles) == 1:
+            data_subset_all = runoff_var[leading_index + (self.lat_slice, self.lon_slice)]
+            self.gathered_bytes += data_subset_all.size * data_subset_all.dtype.itemsize
+            return self.subset(data_subset_all)
+
+        data_subset_new = None
+        for lat_slice, lon_slice, tile_flat_index, cell_positions in read_tiles:
+            data_tile = runoff_var[leading_index + (lat_slice, lon_slice)]
+            self.gathered_bytes += data_tile.size * data_tile.dtype.itemsize
+            data_tile = NUM.ma.asarray(data_tile)
+            data_tile = data_tile.reshape(data_tile.shape[:-2] + (-1,))[..., tile_flat_index]
+            if data_subset_new is None:
+                data_subset_new = NUM.ma.masked_all(data_tile.shape[:-1] + (self.size_cells,),
+                                                    dtype=data_tile.dtype)
+            data_subset_new[..., cell_positions] = data_tile
+        return data_subset_new
+
+    def pop_gathered_bytes(self):
+        """
+        Get the number of bytes read from the runoff files since the last call
+        """
+        gathered_bytes = self.gathered_bytes
+        self.gathered_bytes = 0
+        return gathered_bytes
+
+    def apply(self, runoff_cells, ignore_nan=False):
+        """
+        Convert runoff depth of the weighted cells (time x cells) to
+        inflow volume of each reach (time x reaches).
+        A stack (e.g. ensemble x time x cells) is converted in one product.
+        Masked values do not contribute to the inflow. NaN values make
+        the inflow of their reaches NaN, unless ignore_nan is True.
+        """
+        runoff_cells = NUM.ma.filled(runoff_cells, fill_value=0)
+        if runoff_cells.ndim == 1:
+            runoff_cells = runoff_cells.reshape(1, -1)
+        leading_shape = runoff_cells.shape[:-1]
+        runoff_cells = runoff_cells.reshape(-1, runoff_cells.shape[-1])
+        if ignore_nan and NUM.issubdtype(runoff_cells.dtype, NUM.floating):
+            nan_cells = NUM.isnan(runoff_cells)
+            if nan_cells.any():
+                runoff_cells = NUM.where(nan_cells, 0, runoff_cells)
+        m3_riv_block = NUM.ascontiguousarray(self._matrix_transpose.dot(runoff_cells.T).T)
+        return m3_riv_block.reshape(leading_shape + (self.size_streamID,))
@@ -7,27 +7,60 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License: BSD-3 Clause
 
+from collections import OrderedDict
+import copy
 from datetime import datetime
 import multiprocessing
 from netCDF4 import Dataset
 import os
+import Queue
 from RAPIDpy.rapid import RAPID
 import re
+from time import time
 
 #local imports
-from imports.CreateInflowFileFromERAInterimRunoff import CreateInflowFileFromERAInterimRunoff
-from imports.CreateInflowFileFromLDASRunoff import CreateInflowFileFromLDASRunoff
-from imports.CreateInflowFileFromWRFHydroRunoff import CreateInflowFileFromWRFHydroRunoff
-from imports.generate_return_periods import generate_return_periods
+from imports.generate_return_periods import DEFAULT_MAX_MEMORY_MB, generate_return_periods
+from imports.inflow_writer import DEFAULT_MEMORY_BUDGET_MB, M3RivWriter
 from imports.helper_functions import (case_insensitive_file_search,
                                       get_valid_watershed_list,
-                                      get_watershed_subbasin_from_folder,
-                                      partition)
+                                      get_watershed_subbasin_from_folder)
+from imports.incremental_update import append_along_time, find_previous_output
+from imports.inflow_scheduler import InflowJobScheduler
+from imports.lsm_file_catalog import LSMFileCatalog
+from imports.lsm_grid_detector import LSMGridDetector
+from imports.rivid_major_qout import write_rivid_major_qout
+from imports.runoff_prefetcher import DEFAULT_PREFETCH_DEPTH
+from imports.run_metrics import (configure_metrics, get_cpu_seconds,
+                                 get_metrics_records_file, METRICS,
+                                 read_metrics_records, write_prometheus_textfile)
+from imports.rapid_run_scheduler import NonDaemonicPool, RapidRunScheduler, rapid_work_directory
 
 
 #------------------------------------------------------------------------------
 #MULTIPROCESSING FUNCTION
 #------------------------------------------------------------------------------
+#queue the workers send the inflow blocks to the single writer with
+INFLOW_QUEUE = None
+
+def init_inflow_worker(inflow_queue, metrics_records_file=None, metrics_run_id=None):
+    """
+    Set the queue for the inflow blocks and the metrics in the worker process
+    """
+    global INFLOW_QUEUE
+    INFLOW_QUEUE = inflow_queue
+    configure_metrics(metrics_records_file, metrics_run_id)
+
+#queue the RAPID workers report the finished simulations with
+RAPID_STAGE_QUEUE = None
+
+def init_rapid_worker(stage_queue, metrics_records_file=None, metrics_run_id=None):
+    """
+    Set the queue for the RAPID stages and the metrics in the worker process
+    """
+    global RAPID_STAGE_QUEUE
+    RAPID_STAGE_QUEUE = stage_queue
+    configure_metrics(metrics_records_file, metrics_run_id)
+
 def generate_inflows_from_runoff(args):
     """
     prepare runoff inflow file for rapid
@@ -40,6 +73,15 @@ def generate_inflows_from_runoff(args):
     grid_type = args[5]
     rapid_inflow_file = args[6]
     RAPID_Inflow_Tool = args[7]
+    runoff_prefetch_depth = args[8]
+    #each runoff file is a list of the ensemble member files and each
+    #inflow file a list of the member inflow files
+    batch_ensembles = args[9]
+    #the runoff file before the first one, for the runoff that
+    #accumulates from one file to the next
+    inflow_tool_options = {}
+    if len(args) > 10 and args[10] is not None:
+        inflow_tool_options['previous_nc_file'] = args[10]
 
     time_start_all = datetime.utcnow()
 
@@ -52,17 +94,290 @@ def generate_inflows_from_runoff(args):
         runoff_file_list = [runoff_file_list]
     else:
         runoff_file_list = runoff_file_list
+
+    #a list of weight tables and inflow files means the watersheds share the runoff
+    if not isinstance(weight_table_file, list):
+        weight_table_file = [weight_table_file]
+        rapid_inflow_file = [rapid_inflow_file]
        
     print "Converting inflow"
-    RAPID_Inflow_Tool.execute(nc_file_list=runoff_file_list,
-                              index_list=file_index_list,
-                              in_weight_table=weight_table_file,
-                              out_nc=rapid_inflow_file,
-                              grid_type=grid_type,
-                              )
+    num_files = sum(len(runoff_file) if isinstance(runoff_file, list) else 1
+                    for runoff_file in runoff_file_list)
+    with METRICS.stage('inflow_conversion', watershed=watershed, subbasin=subbasin) as stage_metrics:
+        stage_metrics.add(num_files=num_files)
+        if batch_ensembles:
+            #all members are converted together and each block is split by watershed, then member
+            inflow_writers = {}
+            for time_index, m3_riv_block in RAPID_Inflow_Tool.generateEnsembleInflowBlocks(nc_file_list=runoff_file_list,
+                                                                                           index_list=file_index_list,
+                                                                                           in_weight_table=weight_table_file,
+                                                                                           grid_type=grid_type,
+                                                                                           prefetch_depth=runoff_prefetch_depth):
+                m3_riv_block = m3_riv_block.astype('f4')
+                stage_metrics.add(reach_time_steps=m3_riv_block.size)
+                for watershed_rapid_inflow_files, watershed_m3_riv_block in zip(rapid_inflow_file,
+                                                                                RAPID_Inflow_Tool.weight_matrix.split(m3_riv_block)):
+                    for member_rapid_inflow_file, member_m3_riv_block in zip(watershed_rapid_inflow_files,
+                                                                             watershed_m3_riv_block):
+                        if INFLOW_QUEUE is None:
+                            #not in the pool (e.g. debugging), so write directly
+                            if member_rapid_inflow_file not in inflow_writers:
+                                inflow_writers[member_rapid_inflow_file] = M3RivWriter(member_rapid_inflow_file)
+                            inflow_writers[member_rapid_inflow_file].write(time_index, member_m3_riv_block)
+                        else:
+                            INFLOW_QUEUE.put((member_rapid_inflow_file, time_index, member_m3_riv_block))
+            for inflow_writer in inflow_writers.itervalues():
+                inflow_writer.close()
+        elif INFLOW_QUEUE is None:
+            #not in the pool (e.g. debugging), so write directly
+            for watershed_weight_table_file, watershed_rapid_inflow_file in zip(weight_table_file, rapid_inflow_file):
+                RAPID_Inflow_Tool.execute(nc_file_list=runoff_file_list,
+                                          index_list=file_index_list,
+                                          in_weight_table=watershed_weight_table_file,
+                                          out_nc=watershed_rapid_inflow_file,
+                                          grid_type=grid_type,
+                                          **inflow_tool_options
+                                          )
+        else:
+            #the blocks are written by the single writer in the main process
+            for time_index, m3_riv_block in RAPID_Inflow_Tool.generateInflowBlocks(nc_file_list=runoff_file_list,
+                                                                                   index_list=file_index_list,
+                                                                                   in_weight_table=weight_table_file,
+                                                                                   grid_type=grid_type,
+                                                                                   prefetch_depth=runoff_prefetch_depth,
+                                                                                   **inflow_tool_options):
+                m3_riv_block = m3_riv_block.astype('f4')
+                stage_metrics.add(reach_time_steps=m3_riv_block.size)
+                for watershed_rapid_inflow_file, watershed_m3_riv_block in zip(rapid_inflow_file,
+                                                                               RAPID_Inflow_Tool.weight_matrix.split(m3_riv_block)):
+                    INFLOW_QUEUE.put((watershed_rapid_inflow_file, time_index, watershed_m3_riv_block))
 
     time_finish_ecmwf = datetime.utcnow()
     print "Time to convert inflows: %s" % (time_finish_ecmwf-time_start_all)
+    #the scheduler uses the time per file to size the next jobs
+    return len(runoff_file_list), (time_finish_ecmwf-time_start_all).total_seconds()
+
+def write_inflows_from_queue(inflow_queue, job_scheduler, inflow_file_num_blocks,
+                             memory_budget_mb, num_streams,
+                             rapid_scheduler=None, rapid_jobs=None):
+    """
+    Write the inflow blocks sent by the workers until all have arrived,
+    while the scheduler hands out the remaining jobs.
+    Each inflow file is opened when its first block arrives and
+    closed as soon as all of its blocks are written. Then its RAPID
+    job in rapid_jobs is given to the RAPID scheduler.
+    """
+    inflow_writers = {}
+    num_blocks_remaining = dict(inflow_file_num_blocks)
+    num_blocks = sum(num_blocks_remaining.values())
+    num_blocks_written = 0
+    #wall time, CPU time and counters of each inflow file for the metrics
+    inflow_write_metrics = {}
+    try:
+        while num_blocks_written < num_blocks:
+            #raises the exception from the worker if a job failed
+            job_scheduler.update()
+            if rapid_scheduler is not None:
+                rapid_scheduler.update()
+            try:
+                rapid_inflow_file, time_index, m3_riv_block = inflow_queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            wall_start, cpu_start = time(), get_cpu_seconds()
+            if rapid_inflow_file not in inflow_writers:
+                inflow_writers[rapid_inflow_file] = M3RivWriter(rapid_inflow_file,
+                                                                memory_budget_mb=memory_budget_mb,
+                                                                num_streams=num_streams)
+                inflow_write_metrics[rapid_inflow_file] = [0, 0, {'bytes_written': 0, 'reach_time_steps': 0}]
+            inflow_writers[rapid_inflow_file].write(time_index, m3_riv_block)
+            num_blocks_written += 1
+            num_blocks_remaining[rapid_inflow_file] -= 1
+            if num_blocks_remaining[rapid_inflow_file] <= 0:
+                inflow_writers.pop(rapid_inflow_file).close()
+            inflow_file_metrics = inflow_write_metrics[rapid_inflow_file]
+            inflow_file_metrics[0] += time() - wall_start
+            inflow_file_metrics[1] += get_cpu_seconds() - cpu_start
+            inflow_file_metrics[2]['bytes_written'] += m3_riv_block.nbytes
+            inflow_file_metrics[2]['reach_time_steps'] += m3_riv_block.size
+            if num_blocks_remaining[rapid_inflow_file] <= 0:
+                metrics_labels = {'inflow_file': os.path.basename(rapid_inflow_file)}
+                if rapid_jobs is not None and rapid_inflow_file in rapid_jobs:
+                    watershed_job = rapid_jobs[rapid_inflow_file][0][0]
+                    metrics_labels.update(watershed=watershed_job['watershed'],
+                                          subbasin=watershed_job['subbasin'])
+                METRICS.record_stage('inflow_write', *inflow_write_metrics.pop(rapid_inflow_file),
+                                     **metrics_labels)
+                if rapid_scheduler is not None:
+                    rapid_scheduler.add_job(rapid_inflow_file, *rapid_jobs[rapid_inflow_file])
+    finally:
+        for inflow_writer in inflow_writers.values():
+            inflow_writer.close()
+    #make sure all jobs finished properly
+    job_scheduler.wait()
+
+def run_rapid_for_watershed(watershed_job,
+                            rapid_manager,
+                            generate_rapid_namelist_file=True,
+                            run_rapid_simulation=True,
+                            generate_return_periods_file=False,
+                            generate_seasonal_initialization_file=False,
+                            generate_initialization_file=False,
+                            num_return_period_processes=1,
+                            return_period_max_memory_mb=DEFAULT_MAX_MEMORY_MB,
+                            generate_rivid_major_qout=False,
+                            release_processors_callback=None):
+    """
+    Run RAPID with the inflow of the watershed and generate the
+    files derived from the simulation.
+    release_processors_callback is called when the stages that use
+    several processors (simulation, return periods) are done.
+
+    With generate_rivid_major_qout, a rivid-major copy of Qout is
+    written once and the return periods and seasonal initialization
+    read the time series of the reaches from it.
+
+    If the job has a previous Qout file, RAPID starts from its last
+    time step and the new inflow and Qout are appended to the
+    previous ones.
+    """
+    master_watershed_input_directory = watershed_job['input_directory']
+    master_watershed_output_directory = watershed_job['output_directory']
+    master_rapid_runoff_file = watershed_job['rapid_runoff_file']
+    out_file_ending = watershed_job['out_file_ending']
+    previous_qout_file = watershed_job.get('previous_qout_file')
+
+    #run RAPID for the watershed
+    lsm_rapid_output_file = os.path.join(master_watershed_output_directory,
+                                         'Qout_{0}'.format(out_file_ending))
+    rapid_qout_file = lsm_rapid_output_file
+    if previous_qout_file:
+        #only the new time steps are simulated
+        rapid_qout_file = os.path.join(master_watershed_output_directory,
+                                       'Qout_increment_{0}'.format(out_file_ending))
+    rapid_manager.update_parameters(rapid_connect_file=case_insensitive_file_search(master_watershed_input_directory,
+                                                                                    r'rapid_connect\.csv'),
+                                    Vlat_file=master_rapid_runoff_file,
+                                    riv_bas_id_file=case_insensitive_file_search(master_watershed_input_directory,
+                                                                                 r'riv_bas_id\.csv'),
+                                    k_file=case_insensitive_file_search(master_watershed_input_directory,
+                                                                        r'k\.csv'),
+                                    x_file=case_insensitive_file_search(master_watershed_input_directory,
+                                                                        r'x\.csv'),
+                                    Qout_file=rapid_qout_file
+                                    )
+                            
+    rapid_manager.update_reach_number_data()
+
+    if previous_qout_file and run_rapid_simulation:
+        #start from the flow at the end of the previous simulation
+        restart_qinit_file = os.path.join(master_watershed_output_directory,
+                                          'qinit_restart_{0}.csv'.format(out_file_ending[:-3]))
+        rapid_manager.update_parameters(Qout_file=previous_qout_file)
+        rapid_manager.generate_qinit_from_past_qout(restart_qinit_file)
+        rapid_manager.update_parameters(Qout_file=rapid_qout_file,
+                                        Qinit_file=restart_qinit_file,
+                                        BS_opt_Qinit=True)
+
+    if generate_rapid_namelist_file:
+        rapid_manager.generate_namelist_file(os.path.join(master_watershed_input_directory,
+                                                          "rapid_namelist_{}".format(out_file_ending[:-3])))
+    if run_rapid_simulation:
+        with METRICS.stage('rapid_simulation') as stage_metrics:
+            rapid_manager.run()
+            with Dataset(rapid_qout_file) as rapid_qout_nc:
+                stage_metrics.add(reach_time_steps=rapid_qout_nc.variables['Qout'].size,
+                                  bytes_read=os.path.getsize(master_rapid_runoff_file),
+                                  bytes_written=os.path.getsize(rapid_qout_file))
+
+    if run_rapid_simulation:
+        with METRICS.stage('rapid_output_cf_compliant'):
+            try:
+                comid_lat_lon_z_file = case_insensitive_file_search(master_watershed_input_directory,
+                                                                    r'comid_lat_lon_z\.csv')
+            except Exception:
+                comid_lat_lon_z_file = ""
+                print "WARNING: comid_lat_lon_z file not found. These will not be added in conversion ..."
+                pass
+            rapid_manager.make_output_CF_compliant(simulation_start_datetime=watershed_job['simulation_start_datetime'],
+                                                   comid_lat_lon_z_file=comid_lat_lon_z_file,
+                                                   project_name="{0} Based Historical flows by US Army ERDC".format(watershed_job['description']))
+
+        if previous_qout_file:
+            #extend the previous outputs with the new time steps
+            with METRICS.stage('append_output'):
+                append_along_time(previous_qout_file,
+                                  rapid_qout_file,
+                                  lsm_rapid_output_file)
+                append_along_time(watershed_job['previous_rapid_runoff_file'],
+                                  master_rapid_runoff_file,
+                                  os.path.join(master_watershed_output_directory,
+                                               'm3_riv_bas_{0}'.format(out_file_ending)))
+            os.remove(rapid_qout_file)
+            os.remove(master_rapid_runoff_file)
+            #the rest of the stages use the full simulation
+            rapid_manager.update_parameters(Qout_file=lsm_rapid_output_file)
+
+    #the statistics read whole time series of the reaches
+    statistics_qout_file = lsm_rapid_output_file
+    if generate_rivid_major_qout and os.path.exists(lsm_rapid_output_file) \
+            and (generate_return_periods_file or generate_seasonal_initialization_file):
+        statistics_qout_file = os.path.join(master_watershed_output_directory,
+                                            'Qout_rivid_major_{0}'.format(out_file_ending))
+        with METRICS.stage('rivid_major_qout'):
+            write_rivid_major_qout(lsm_rapid_output_file, statistics_qout_file)
+
+    #generate return periods
+    if generate_return_periods_file and os.path.exists(lsm_rapid_output_file) and lsm_rapid_output_file:
+        return_periods_file = os.path.join(master_watershed_output_directory,
+                                           'return_periods_{0}'.format(out_file_ending))
+        #assume storm has 3 day length
+        storm_length_days = 3
+        generate_return_periods(statistics_qout_file,
+                                return_periods_file,
+                                storm_length_days,
+                                num_processes=num_return_period_processes,
+                                max_memory_mb=return_period_max_memory_mb)
+
+    if release_processors_callback is not None:
+        release_processors_callback()
+    
+    if generate_seasonal_initialization_file and os.path.exists(lsm_rapid_output_file) and lsm_rapid_output_file:
+        seasonal_qinit_file = os.path.join(master_watershed_input_directory,
+                                           'seasonal_qinit_{0}.csv'.format(out_file_ending[:-3]))
+        rapid_manager.update_parameters(Qout_file=statistics_qout_file)
+        with METRICS.stage('seasonal_initialization'):
+            rapid_manager.generate_seasonal_intitialization(seasonal_qinit_file)
+        #the qinit only needs the last time step, which is contiguous in Qout
+        rapid_manager.update_parameters(Qout_file=lsm_rapid_output_file)
+
+    if generate_initialization_file and os.path.exists(lsm_rapid_output_file) and lsm_rapid_output_file:
+        qinit_file = os.path.join(master_watershed_input_directory,
+                                  'qinit_{0}.csv'.format(out_file_ending[:-3]))
+        with METRICS.stage('initialization'):
+            rapid_manager.generate_qinit_from_past_qout(qinit_file)
+
+def run_rapid_stages(args):
+    """
+    Run RAPID and the downstream stages for a watershed in a worker
+    """
+    watershed_job = args[0]
+    rapid_stage_options = args[1]
+
+    def release_processors():
+        #the scheduler gives the cores of the job back to the inflow workers
+        RAPID_STAGE_QUEUE.put(('release_processors', watershed_job['rapid_runoff_file']))
+
+    #RAPID reads the namelist from the working directory,
+    #so each simulation runs in its own directory
+    with rapid_work_directory(watershed_job['output_directory'],
+                              watershed_job['out_file_ending']), \
+         METRICS.stage('rapid_stages',
+                       watershed=watershed_job['watershed'],
+                       subbasin=watershed_job['subbasin']):
+        run_rapid_for_watershed(watershed_job,
+                                watershed_job['rapid_manager'],
+                                release_processors_callback=release_processors,
+                                **rapid_stage_options)
 
 #------------------------------------------------------------------------------
 #MAIN PROCESS
@@ -85,12 +400,84 @@ def run_lsm_rapid_process(rapid_executable_location,
                           ftp_login="",
                           ftp_passwd="",
                           ftp_directory="",
-                          cygwin_bin_location=""
+                          cygwin_bin_location="",
+                          inflow_memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                          share_runoff_between_watersheds=False,
+                          num_rapid_processors=None,
+                          append_to_existing_output=False,
+                          lsm_file_catalog_file=None,
+                          return_period_max_memory_mb=DEFAULT_MAX_MEMORY_MB,
+                          generate_rivid_major_qout=False,
+                          inflow_file_format="NETCDF3_CLASSIC",
+                          runoff_prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+                          batch_ensembles=False,
+                          metrics_file=None,
+                          metrics_format="jsonl"
                           ):
     """
     This is the main process to generate inflow for RAPID and to run RAPID
+
+    inflow_memory_budget_mb is the memory used to buffer the inflow time
+    steps before they are written to the m3_riv file.
+
+    If share_runoff_between_watersheds is True, each runoff file is read
+    once and the weight matrices of all watersheds are applied to it in
+    one pass instead of reading the runoff files again for each watershed.
+
+    The RAPID simulation of a watershed starts as soon as its inflow is
+    written, while the inflow of the other watersheds is generated.
+    num_rapid_processors is the number of processors of each RAPID run
+    (default: half of the processors). The processors are shared between
+    the RAPID runs and the inflow workers.
+
+    If append_to_existing_output is True and a watershed has the outputs
+    of an earlier run with the same start date, only the new runoff files
+    are converted. RAPID restarts from the last time step of the previous
+    Qout file and the new time steps are appended to the previous inflow
+    and Qout files.
+
+    The LSM files are found with a catalog of lsm_data_location stored in
+    lsm_file_catalog_file (default: .lsm_file_catalog.sqlite in
+    rapid_io_files_location). Only the directories and files that changed
+    since the last run are read again. The grid of the LSM files is
+    detected once per file signature and stored in the catalog too
+    (new LSMs are added with register_lsm_grid in lsm_grid_detector).
+
+    The return periods of a watershed are generated by num_rapid_processors
+    workers using at most return_period_max_memory_mb for the Qout blocks.
+
+    If generate_rivid_major_qout is True, a rivid-major (transposed,
+    chunked and compressed) copy of each Qout file is written once after
+    the simulation and the return periods and seasonal initialization
+    read from it.
+
+    inflow_file_format is the format of the m3_riv inflow files:
+    NETCDF3_CLASSIC or NETCDF4 (chunked and compressed, which needs
+    RAPID built with NetCDF4/HDF5 support).
+
+    Each inflow worker reads the next runoff_prefetch_depth runoff files
+    in a background thread while it converts the current one
+    (0 reads them one after the other).
+
+    If batch_ensembles is True, the ensemble members on the same grid
+    (e.g. the 10 ERA 20CM members) are converted together: the member
+    files of a time are read in one job and the weight matrix is applied
+    to all of them at once. One inflow file is still written per member
+    and the RAPID runs of the members share the processors.
+
+    If metrics_file is set, the wall time, CPU time and throughput of each
+    stage (discovery, detection, inflow conversion and writing, RAPID and
+    the statistics) are recorded per watershed and worker. metrics_format
+    is jsonl (one JSON line per stage, appended on every run) or
+    prometheus (a textfile for the node exporter, summarized from the
+    JSON lines kept next to it).
     """
     time_begin_all = datetime.utcnow()
+    cpu_begin_all = get_cpu_seconds()
+
+    if metrics_file:
+        metrics_records_file = get_metrics_records_file(metrics_file, metrics_format)
+        configure_metrics(metrics_records_file, run_id=time_begin_all.isoformat())
 
     #use all processors makes precedent over num_processors arg
     if use_all_processors == True:
@@ -101,30 +488,71 @@ def run_lsm_rapid_process(rapid_executable_location,
     else:
         NUM_CPUS = num_processors
 
+    if num_rapid_processors is None:
+        num_rapid_processors = max(1, NUM_CPUS/2)
+    num_rapid_processors = min(num_rapid_processors, NUM_CPUS)
+
     #get list of correclty formatted rapid input directories in rapid directory
     rapid_input_directories = get_valid_watershed_list(os.path.join(rapid_io_files_location, 'input'))
 
+    #one pool for all ensembles and watersheds, so the workers keep
+    #the weight matrices loaded between jobs
+    #workers send the inflow to the main process, which is the only writer
+    inflow_queue = multiprocessing.Queue(2*NUM_CPUS)
+    pool = multiprocessing.Pool(NUM_CPUS,
+                                initializer=init_inflow_worker,
+                                initargs=(inflow_queue, METRICS.records_file, METRICS.run_id))
+    #the files are handed out to the workers in small batches as they become free
+    job_scheduler = InflowJobScheduler(pool,
+                                       generate_inflows_from_runoff,
+                                       NUM_CPUS)
+    #RAPID runs in its own pool, sharing the processors with the inflow workers
+    rapid_stage_queue = multiprocessing.Queue()
+    #the workers can start a pool for the return periods
+    rapid_pool = NonDaemonicPool(NUM_CPUS,
+                                 initializer=init_rapid_worker,
+                                 initargs=(rapid_stage_queue, METRICS.records_file, METRICS.run_id))
+    rapid_scheduler = RapidRunScheduler(rapid_pool,
+                                        run_rapid_stages,
+                                        rapid_stage_queue,
+                                        NUM_CPUS,
+                                        inflow_scheduler=job_scheduler)
+    rapid_stage_options = {'generate_rapid_namelist_file': generate_rapid_namelist_file,
+                           'run_rapid_simulation': run_rapid_simulation,
+                           'generate_return_periods_file': generate_return_periods_file,
+                           'generate_seasonal_initialization_file': generate_seasonal_initialization_file,
+                           'generate_initialization_file': generate_initialization_file,
+                           #the return periods use the processors of the RAPID run
+                           'num_return_period_processes': num_rapid_processors,
+                           'return_period_max_memory_mb': return_period_max_memory_mb,
+                           'generate_rivid_major_qout': generate_rivid_major_qout}
+    rapid_jobs = {}
+    inflow_file_num_blocks = {}
+    #inflow jobs of the ensemble members converted together
+    ensemble_job_batches = OrderedDict()
+    max_watershed_job_group_size = 1
+
+    #index of the LSM files, so they are not searched for on every run
+    if lsm_file_catalog_file is None:
+        lsm_file_catalog_file = os.path.join(rapid_io_files_location, '.lsm_file_catalog.sqlite')
+    lsm_file_catalog = LSMFileCatalog(lsm_file_catalog_file)
+    print "Updating LSM file catalog {0} ...".format(lsm_file_catalog_file)
+    with METRICS.stage('discovery'):
+        lsm_file_catalog.refresh(lsm_data_location)
+    lsm_grid_detector = LSMGridDetector(lsm_file_catalog)
+
     for ensemble in ensemble_list:
         ensemble_file_ending = ".nc"
         if ensemble != None:
             ensemble_file_ending = "_{0}.nc".format(ensemble)
         #get list of files
-        lsm_file_list = []
-        for subdir, dirs, files in os.walk(lsm_data_location):
-            for erai_file in files:
-                if erai_file.endswith(ensemble_file_ending):
-                    lsm_file_list.append(os.path.join(subdir, erai_file))
-        
-        lsm_file_list_subset = []
-        
-        for erai_file in sorted(lsm_file_list):
-            match = re.search(r'\d{8}', erai_file)
-            file_date = datetime.strptime(match.group(0), "%Y%m%d")
-            if file_date > simulation_end_datetime:
-                break
-                print file_date
-            if file_date >= simulation_start_datetime:
-                lsm_file_list_subset.append(os.path.join(subdir, erai_file))
+        lsm_file_list_subset = lsm_file_catalog.get_files(lsm_data_location,
+                                                          ensemble=ensemble,
+                                                          start_datetime=simulation_start_datetime,
+                                                          end_datetime=simulation_end_datetime)
+        if not lsm_file_list_subset:
+            raise Exception("ERROR: No LSM files found in {0} for ensemble {1} ...".format(lsm_data_location,
+                                                                                        ensemble))
         print lsm_file_list_subset[0]
         actual_simulation_start_datetime = datetime.strptime(re.search(r'\d{8}', lsm_file_list_subset[0]).group(0), "%Y%m%d")
         print lsm_file_list_subset[-1]
@@ -133,338 +561,43 @@ def run_lsm_rapid_process(rapid_executable_location,
         lsm_file_list = sorted(lsm_file_list_subset)
         
         #check to see what kind of file we are dealing with
-        lsm_example_file = Dataset(lsm_file_list[0])
-
-        
-        #INDENTIFY LAT/LON DIMENSIONS
-        dim_list = lsm_example_file.dimensions.keys()
-
-        latitude_dim = "lat"
-        if 'latitude' in dim_list:
-            latitude_dim = 'latitude'
-        elif 'g0_lat_0' in dim_list:
-            #GLDAS/NLDAS MOSAIC
-            latitude_dim = 'g0_lat_0'
-        elif 'lat_110' in dim_list:
-            #NLDAS NOAH/VIC
-            latitude_dim = 'lat_110'
-        elif 'north_south' in dim_list:
-            #LIS/Joules
-            latitude_dim = 'north_south'
-        elif 'south_north' in dim_list:
-            #WRF Hydro
-            latitude_dim = 'south_north'
-        
-        longitude_dim = "lon"
-        if 'longitude' in dim_list:
-            longitude_dim = 'longitude'
-        elif 'g0_lon_1' in dim_list:
-            #GLDAS/NLDAS MOSAIC
-            longitude_dim = 'g0_lon_1'
-        elif 'lon_110' in dim_list:
-            #NLDAS NOAH/VIC
-            longitude_dim = 'lon_110'
-        elif 'east_west' in dim_list:
-            #LIS/Joules
-            longitude_dim = 'east_west'
-        elif 'west_east' in dim_list:
-            #WRF Hydro
-            longitude_dim = 'west_east'
-
-        lat_dim_size = len(lsm_example_file.dimensions[latitude_dim])
-        lon_dim_size = len(lsm_example_file.dimensions[longitude_dim])
-
-        #IDENTIFY VARIABLES
-        var_list = lsm_example_file.variables.keys()
-
-        latitude_var="lat"
-        if 'latitude' in var_list:
-            latitude_var = 'latitude'
-        elif 'g0_lat_0' in var_list:
-            latitude_var = 'g0_lat_0'
-        elif 'lat_110' in var_list:
-            latitude_var = 'lat_110'
-        elif 'north_south' in var_list:
-            latitude_var = 'north_south'
-        elif 'XLAT' in var_list:
-            latitude_var = 'XLAT'
-    
-        longitude_var="lon"
-        if 'longitude' in var_list:
-            longitude_var = 'longitude'
-        elif 'g0_lon_1' in var_list:
-            longitude_var = 'g0_lon_1'
-        elif 'lon_110' in var_list:
-            longitude_var = 'lon_110'
-        elif 'east_west' in var_list:
-            longitude_var = 'east_west'
-        elif 'XLONG' in var_list:
-            longitude_var = 'XLONG'
-
-        surface_runoff_var=""
-        subsurface_runoff_var=""
-        for var in var_list:
-            if var.startswith("SSRUN"):
-                #NLDAS/GLDAS
-                surface_runoff_var = var
-            elif var.startswith("BGRUN"):
-                #NLDAS/GLDAS
-                subsurface_runoff_var = var
-            elif var == "Qs_inst":
-                #LIS
-                surface_runoff_var = var
-            elif var == "Qsb_inst":
-                #LIS
-                subsurface_runoff_var = var
-            elif var == "SFROFF":
-                #WRF Hydro
-                surface_runoff_var = var
-            elif var == "UDROFF":
-                #WRF Hydro
-                subsurface_runoff_var = var
-            elif var.lower() == "ro":
-                #ERA Interim
-                surface_runoff_var = var
-            
-
-
-        #IDENTIFY GRID TYPE & TIME STEP
-
-        try:
-            time_dim = "time"
-            if "Time" in lsm_example_file.dimensions:
-                time_dim = "Time"
-            file_size_time = len(lsm_example_file.dimensions[time_dim])
-        except Exception as ex:
-            print "ERROR:", ex
-            print "Assuming time dimension is 1"
-            file_size_time = 1
-
-        out_file_ending = "{0}to{1}{2}".format(actual_simulation_start_datetime.strftime("%Y%m%d"), 
-                                               actual_simulation_end_datetime.strftime("%Y%m%d"), 
-                                               ensemble_file_ending)
-            
-        weight_file_name = ''
-        grid_type = ''
-        model_name = ''
-        time_step = 0
-        description = ""
-        RAPID_Inflow_Tool = None
-        total_num_time_steps = 0
-        institution = ""
-        try:
-            institution = lsm_example_file.getncattr("institution")
-        except AttributeError:
-            pass
-        
-        if institution == "European Centre for Medium-Range Weather Forecasts" \
-            or surface_runoff_var.lower() == "ro":
-            #these are the ECMWF models
-            if lat_dim_size == 361 and lon_dim_size == 720:
-                print "Runoff file identified as ERA Interim Low Res (T255) GRID"
-                #A) ERA Interim Low Res (T255)
-                #Downloaded as 0.5 degree grid
-                # dimensions:
-                #	 longitude = 720 ;
-                #	 latitude = 361 ;
-                description = "ERA Interim (T255 Grid)"
-                model_name = "erai"
-                weight_file_name = r'weight_era_t255\.csv'
-                grid_type = 't255'
-
-            elif lat_dim_size == 512 and lon_dim_size == 1024:
-                print "Runoff file identified as ERA Interim High Res (T511) GRID"
-                #B) ERA Interim High Res (T511)
-                # dimensions:
-                #  lon = 1024 ;
-                #  lat = 512 ;
-                description = "ERA Interim (T511 Grid)"
-                weight_file_name = r'weight_era_t511\.csv'
-                model_name = "erai"
-                grid_type = 't511'
-            elif lat_dim_size == 161 and lon_dim_size == 320:
-                print "Runoff file identified as ERA 20CM (T159) GRID"
-                #C) ERA 20CM (T159) - 3hr - 10 ensembles
-                #Downloaded as 1.125 degree grid
-                # dimensions:
-                #  longitude = 320 ;
-                #  latitude = 161 ;    
-                description = "ERA 20CM (T159 Grid)"
-                weight_file_name = r'weight_era_t159\.csv'
-                model_name = "era_20cm"
-                grid_type = 't159'
-            else:
-                lsm_example_file.close()
-                raise Exception("Unsupported grid size.")
-
-            #time units are in hours
-            if file_size_time == 1:
-                time_step = 24*3600 #daily
-                description += " Daily Runoff"
-            elif file_size_time == 8:
-                time_step = 3*3600 #3 hourly
-                description += " 3 Hourly Runoff"
-            else:
-                lsm_example_file.close()
-                raise Exception("Unsupported ECMWF time step.")
-
-            total_num_time_steps=file_size_time*len(lsm_file_list)
-            RAPID_Inflow_Tool = CreateInflowFileFromERAInterimRunoff()                 
-        elif institution == "NASA GSFC":
-            print "Runoff file identified as LIS GRID"
-            #this is the LIS model
-            weight_file_name = r'weight_lis\.csv'
-            grid_type = 'lis'
-            description = "NASA GFC LIS Hourly Runoff"
-            model_name = "nasa"
-            #time units are in minutes
-            if file_size_time == 1:
-                #time_step = 1*3600 #hourly
-                time_step = 3*3600 #3-hourly
-            else:
-                lsm_example_file.close()
-                raise Exception("Unsupported LIS time step.")
-        
-            total_num_time_steps=file_size_time*len(lsm_file_list)
-            
-            RAPID_Inflow_Tool = CreateInflowFileFromLDASRunoff(latitude_dim,
-                                                               longitude_dim,
-                                                               latitude_var,
-                                                               longitude_var,
-                                                               surface_runoff_var,
-                                                               subsurface_runoff_var,
-                                                               time_step)
-
-        elif institution == "Met Office, UK":
-            print "Runoff file identified as Joules GRID"
-            #this is the LIS model
-            weight_file_name = r'weight_joules\.csv'
-            grid_type = 'joules'
-            description = "Met Office Joules Hourly Runoff"
-            model_name = "met_office"
-            #time units are in minutes
-            if file_size_time == 1:
-                #time_step = 1*3600 #hourly
-                time_step = 3*3600 #3-hourly
-            else:
-                lsm_example_file.close()
-                raise Exception("Unsupported LIS time step.")
-        
-            total_num_time_steps=file_size_time*len(lsm_file_list)
-
-            RAPID_Inflow_Tool = CreateInflowFileFromLDASRunoff(latitude_dim,
-                                                               longitude_dim,
-                                                               latitude_var,
-                                                               longitude_var,
-                                                               surface_runoff_var,
-                                                               subsurface_runoff_var,
-                                                               time_step)
-        elif surface_runoff_var.startswith("SSRUN") \
-            and subsurface_runoff_var.startswith("BGRUN"):
-
-            model_name = "nasa"
-            if lat_dim_size == 600 and lon_dim_size == 1440:
-                print "Runoff file identified as GLDAS GRID"
-                #GLDAS NC FILE
-                #dimensions:
-                #    g0_lat_0 = 600 ;
-                #    g0_lon_1 = 1440 ;
-                #variables
-                #SSRUN_GDS0_SFC_ave1h (surface), BGRUN_GDS0_SFC_ave1h (subsurface)
-                # or
-                #SSRUNsfc_GDS0_SFC_ave1h (surface), BGRUNsfc_GDS0_SFC_ave1h (subsurface)
-                description = "GLDAS 3 Hourly Runoff"
-                weight_file_name = r'weight_gldas\.csv'
-                grid_type = 'gldas'
- 
-                if file_size_time == 1:
-                    time_step = 3*3600 #3 hourly
-                else:
-                    lsm_example_file.close()
-                    raise Exception("Unsupported GLDAS time step.")
-                
-                total_num_time_steps=file_size_time*len(lsm_file_list)
-
-            elif lat_dim_size <= 224 and lon_dim_size <= 464:
-                print "Runoff file identified as NLDAS GRID"
-                #NLDAS MOSAIC FILE
-                #dimensions:
-                #    g0_lat_0 = 224 ;
-                #    g0_lon_1 = 464 ;
-                #NLDAS NOAH/VIC FILE
-                #dimensions:
-                #    lat_110 = 224 ;
-                #    lon_110 = 464 ;
-
-                description = "NLDAS Hourly Runoff"
-                weight_file_name = r'weight_nldas\.csv'
-                grid_type = 'nldas'
-
-                if file_size_time == 1:
-                    #time_step = 1*3600 #hourly
-                    time_step = 3*3600 #3 hourly
-                else:
-                    lsm_example_file.close()
-                    raise Exception("Unsupported NLDAS time step.")
-                
-            else:
-                lsm_example_file.close()
-                raise Exception("Unsupported runoff grid.")
-
-            RAPID_Inflow_Tool = CreateInflowFileFromLDASRunoff(latitude_dim,
-                                                               longitude_dim,
-                                                               latitude_var,
-                                                               longitude_var,
-                                                               surface_runoff_var,
-                                                               subsurface_runoff_var,
-                                                               time_step)
-        else:
-            title = ""
-            try:
-                title = lsm_example_file.getncattr("TITLE")
-            except AttributeError:
-                pass
-
-            if "WRF" in title:
-                description = "WRF-Hydro Hourly Runoff"
-                weight_file_name = r'weight_wrf\.csv'
-                grid_type = 'wrf_hydro'
-                time_step = 1*3600 #1 hourly
-                total_num_time_steps=file_size_time*len(lsm_file_list)
-
-                RAPID_Inflow_Tool = CreateInflowFileFromWRFHydroRunoff(latitude_dim,
-                                                                       longitude_dim,
-                                                                       latitude_var,
-                                                                       longitude_var,
-                                                                       surface_runoff_var,
-                                                                       subsurface_runoff_var,
-                                                                       time_step)
-            else:
-                lsm_example_file.close()
-                raise Exception("Unsupported runoff grid.")
-        
-        lsm_example_file.close()
-
-    	#VALIDATING INPUT IF DIVIDING BY 3
-        if grid_type == 'nldas' or grid_type == 'lis' or grid_type == 'joules':
-	    num_extra_files = file_size_time*len(lsm_file_list) % 3
-            if num_extra_files != 0:
-                print "WARNING: Number of files needs to be divisible by 3. Remainder is" , num_extra_files
-		print "This means your simulation will be truncated"
-            total_num_time_steps=int(file_size_time*len(lsm_file_list)/3)
-
-        out_file_ending = "{0}_{1}_{2}hr_{3}".format(model_name, grid_type, time_step/3600, out_file_ending)
+        #(the grid is probed once per file signature)
+        with METRICS.stage('detection', ensemble=ensemble) as stage_metrics:
+            grid = lsm_grid_detector.detect(lsm_file_catalog.get_header(lsm_file_list[0]))
+            lsm_file_catalog.set_grid_type(lsm_file_list, grid.grid_type)
+            stage_metrics.add(num_files=len(lsm_file_list))
+
+        grid_type = grid.grid_type
+        file_size_time = grid.file_size_time
+        time_step = grid.time_step
+        weight_file_name = grid.weight_file_name
+        description = grid.description
+        RAPID_Inflow_Tool = grid.get_inflow_tool()
+        total_num_time_steps = grid.get_total_num_time_steps(len(lsm_file_list))
+
+        out_file_ending = "{0}_{1}_{2}hr_{3}to{4}{5}".format(grid.model_name, grid_type, time_step/3600,
+                                                             actual_simulation_start_datetime.strftime("%Y%m%d"), 
+                                                             actual_simulation_end_datetime.strftime("%Y%m%d"), 
+                                                             ensemble_file_ending)
         #set up RAPID manager
         rapid_manager = RAPID(rapid_executable_location=rapid_executable_location,
                               cygwin_bin_location=cygwin_bin_location,
-                              num_processors=NUM_CPUS,
+                              num_processors=num_rapid_processors,
                               ZS_TauR=time_step, #duration of routing procedure (time step of runoff data)
                               ZS_dtR=15*60, #internal routing time step
                               ZS_TauM=total_num_time_steps*time_step, #total simulation time
                               ZS_dtM=time_step #RAPID recommended internal time step (1 day)
                              )
     
-        #run ERA Interim processes
+        #group the NLDAS/LIS/Joules files in threes once for all watersheds
+        if grid.num_files_combined > 1:
+            print "Grouping {0} in groups of {1}".format(grid_type, grid.num_files_combined)
+            lsm_file_list = [lsm_file_list[file_index:file_index+grid.num_files_combined]
+                             for file_index in range(0, len(lsm_file_list), grid.num_files_combined)\
+                             if len(lsm_file_list[file_index:file_index+grid.num_files_combined])==grid.num_files_combined]
+
+        #prepare the inflow file of each watershed
+        watershed_job_list = []
         for rapid_input_directory in rapid_input_directories:
             watershed, subbasin = get_watershed_subbasin_from_folder(rapid_input_directory)
 
@@ -486,100 +619,194 @@ def run_lsm_rapid_process(rapid_executable_location,
             weight_table_file = case_insensitive_file_search(master_watershed_input_directory,
                                                              weight_file_name)
 
+            #look for the outputs of an earlier run to append to
+            first_file_index = 0
+            previous_qout_file, previous_rapid_runoff_file = None, None
+            if append_to_existing_output:
+                previous_qout_file, previous_rapid_runoff_file = find_previous_output(master_watershed_output_directory,
+                                                                                      out_file_ending)
+            if previous_qout_file:
+                with Dataset(previous_rapid_runoff_file) as previous_rapid_runoff_nc:
+                    previous_size_time = len(previous_rapid_runoff_nc.dimensions['Time'])
+                    previous_size_rivid = len(previous_rapid_runoff_nc.dimensions['rivid'])
+                first_file_index = previous_size_time/file_size_time
+                if previous_size_time % file_size_time != 0 or first_file_index <= 0:
+                    print "WARNING: {0} does not match the runoff files. Running full simulation ...".format(previous_rapid_runoff_file)
+                    previous_qout_file, previous_rapid_runoff_file = None, None
+                    first_file_index = 0
+                elif first_file_index >= len(lsm_file_list):
+                    print "{0} {1} is up to date with {2} ...".format(watershed, subbasin, previous_qout_file)
+                    continue
+                else:
+                    print "Appending to {0} from runoff file {1} ...".format(previous_qout_file, first_file_index)
+                    master_rapid_runoff_file = os.path.join(master_watershed_output_directory,
+                                                            'm3_riv_bas_increment_{0}'.format(out_file_ending))
+
+            #this also compiles the weight table cache that the workers memory-map
             RAPID_Inflow_Tool.generateOutputInflowFile(out_nc=master_rapid_runoff_file,
                                                        in_weight_table=weight_table_file,
-                                                       tot_size_time=total_num_time_steps,
+                                                       tot_size_time=total_num_time_steps-first_file_index*file_size_time,
+                                                       unlimited_time=append_to_existing_output,
+                                                       output_format=inflow_file_format,
                                                        )
-            job_combinations = []
-            if grid_type == 'nldas' or grid_type == 'lis' or grid_type == 'joules':
-                print "Grouping {0} in threes".format(grid_type)
-                lsm_file_list = [lsm_file_list[nldas_index:nldas_index+3] for nldas_index in range(0, len(lsm_file_list), 3)\
-                                 if len(lsm_file_list[nldas_index:nldas_index+3])==3]
-
-            partition_list, partition_index_list = partition(lsm_file_list, NUM_CPUS)
-            for loop_index, cpu_grouped_file_list in enumerate(partition_list):
-                job_combinations.append((watershed.lower(),
-                                         subbasin.lower(),
-                                         cpu_grouped_file_list,
-                                         partition_index_list[loop_index],
-                                         weight_table_file,
-                                         grid_type,
-                                         master_rapid_runoff_file,
-                                         RAPID_Inflow_Tool))
-                #COMMENTED CODE IS FOR DEBUGGING
-##                generate_inflows_from_runoff((watershed.lower(),
-##                                              subbasin.lower(),
-##                                              cpu_grouped_file_list,
-##                                              partition_index_list[loop_index],
-##                                              weight_table_file,
-##                                              grid_type,
-##                                              master_rapid_runoff_file,
-##                                              RAPID_Inflow_Tool))
-            pool = multiprocessing.Pool(NUM_CPUS)
-            #chunksize=1 makes it so there is only one task per cpu
-            pool.imap(generate_inflows_from_runoff,
-                      job_combinations,
-                      chunksize=1)
-            pool.close()
-            pool.join()
-
-            #run RAPID for the watershed
-            lsm_rapid_output_file = os.path.join(master_watershed_output_directory,
-                                                 'Qout_{0}'.format(out_file_ending))
-            rapid_manager.update_parameters(rapid_connect_file=case_insensitive_file_search(master_watershed_input_directory,
-                                                                                            r'rapid_connect\.csv'),
-                                            Vlat_file=master_rapid_runoff_file,
-                                            riv_bas_id_file=case_insensitive_file_search(master_watershed_input_directory,
-                                                                                         r'riv_bas_id\.csv'),
-                                            k_file=case_insensitive_file_search(master_watershed_input_directory,
-                                                                                r'k\.csv'),
-                                            x_file=case_insensitive_file_search(master_watershed_input_directory,
-                                                                                r'x\.csv'),
-                                            Qout_file=lsm_rapid_output_file
-                                            )
-                                            
-            rapid_manager.update_reach_number_data()
-
-            if generate_rapid_namelist_file:
-                rapid_manager.generate_namelist_file(os.path.join(master_watershed_input_directory,
-                                                                  "rapid_namelist_{}".format(out_file_ending[:-3])))
-            if run_rapid_simulation:
-                rapid_manager.run()
-
-                try:
-                    comid_lat_lon_z_file = case_insensitive_file_search(master_watershed_input_directory,
-                                                                        r'comid_lat_lon_z\.csv')
-                except Exception:
-                    comid_lat_lon_z_file = ""
-                    print "WARNING: comid_lat_lon_z file not found. These will not be added in conversion ..."
-                    pass
-                rapid_manager.make_output_CF_compliant(simulation_start_datetime=actual_simulation_start_datetime,
-                                                       comid_lat_lon_z_file=comid_lat_lon_z_file,
-                                                       project_name="{0} Based Historical flows by US Army ERDC".format(description))
-
-            #generate return periods
-            if generate_return_periods_file and os.path.exists(lsm_rapid_output_file) and lsm_rapid_output_file:
-                return_periods_file = os.path.join(master_watershed_output_directory,
-                                                   'return_periods_{0}'.format(out_file_ending))
-                #assume storm has 3 day length
-                storm_length_days = 3
-                generate_return_periods(lsm_rapid_output_file,
-                                        return_periods_file,
-                                        storm_length_days)
-                    
-            if generate_seasonal_initialization_file and os.path.exists(lsm_rapid_output_file) and lsm_rapid_output_file:
-                seasonal_qinit_file = os.path.join(master_watershed_input_directory,
-                                                   'seasonal_qinit_{0}.csv'.format(out_file_ending[:-3]))
-                rapid_manager.generate_seasonal_intitialization(seasonal_qinit_file)
-
-            if generate_initialization_file and os.path.exists(lsm_rapid_output_file) and lsm_rapid_output_file:
-                qinit_file = os.path.join(master_watershed_input_directory,
-                                          'qinit_{0}.csv'.format(out_file_ending[:-3]))
-                rapid_manager.generate_qinit_from_past_qout(qinit_file)
-
+            if previous_qout_file and previous_size_rivid != RAPID_Inflow_Tool.size_streamID:
+                raise Exception("ERROR: Number of reaches in {0} does not match {1} ...".format(previous_rapid_runoff_file,
+                                                                                               weight_table_file))
+
+            watershed_rapid_manager = copy.deepcopy(rapid_manager)
+            watershed_simulation_start_datetime = actual_simulation_start_datetime
+            if previous_qout_file:
+                watershed_rapid_manager.update_parameters(ZS_TauM=(total_num_time_steps-first_file_index*file_size_time)*time_step)
+                first_lsm_file = lsm_file_list[first_file_index]
+                if isinstance(first_lsm_file, list):
+                    first_lsm_file = first_lsm_file[0]
+                watershed_simulation_start_datetime = datetime.strptime(re.search(r'\d{8}', os.path.basename(first_lsm_file)).group(0), "%Y%m%d")
+            watershed_job_list.append({'watershed': watershed.lower(),
+                                       'subbasin': subbasin.lower(),
+                                       'input_directory': master_watershed_input_directory,
+                                       'output_directory': master_watershed_output_directory,
+                                       'weight_table_file': weight_table_file,
+                                       'rapid_runoff_file': master_rapid_runoff_file,
+                                       'out_file_ending': out_file_ending,
+                                       'description': description,
+                                       'simulation_start_datetime': watershed_simulation_start_datetime,
+                                       'first_file_index': first_file_index,
+                                       'previous_qout_file': previous_qout_file,
+                                       'previous_rapid_runoff_file': previous_rapid_runoff_file,
+                                       #each watershed has its own manager to run at the same time
+                                       'rapid_manager': watershed_rapid_manager})
+
+        if share_runoff_between_watersheds:
+            #each runoff file is read once and the inflow of all watersheds is generated together
+            #(watersheds appending to earlier runs start at different files)
+            watershed_job_groups = {}
+            for watershed_job in watershed_job_list:
+                watershed_job_groups.setdefault(watershed_job['first_file_index'], []).append(watershed_job)
+            watershed_job_groups = [watershed_job_groups[first_file_index] for first_file_index in sorted(watershed_job_groups)]
+        else:
+            watershed_job_groups = [[watershed_job] for watershed_job in watershed_job_list]
+
+        #the ensemble members are batched if they are converted one file at a time
+        batch_ensemble = batch_ensembles and len(ensemble_list) > 1 and grid.num_files_combined == 1 \
+                         and hasattr(RAPID_Inflow_Tool, 'generateEnsembleInflowBlocks')
+        if batch_ensembles and not batch_ensemble:
+            print "WARNING: Ensembles of {0} cannot be batched. Converting ensemble {1} alone ...".format(grid_type,
+                                                                                                          ensemble)
+
+        #queue the jobs of all ensembles and watersheds, so the workers
+        #do not wait for each other between watersheds
+        for watershed_job_group in watershed_job_groups:
+            weight_table_file_list = [watershed_job['weight_table_file'] for watershed_job in watershed_job_group]
+            rapid_runoff_file_list = [watershed_job['rapid_runoff_file'] for watershed_job in watershed_job_group]
+            #only the runoff files after the previous run are converted
+            watershed_lsm_file_list = lsm_file_list[watershed_job_group[0]['first_file_index']:]
+            for rapid_runoff_file in rapid_runoff_file_list:
+                inflow_file_num_blocks[rapid_runoff_file] = len(watershed_lsm_file_list)
+
+            if batch_ensemble:
+                #the members with the same watersheds and runoff times are converted together
+                batch_key = (grid_type,
+                             tuple(watershed_job['weight_table_file'] for watershed_job in watershed_job_group),
+                             watershed_job_group[0]['first_file_index'],
+                             actual_simulation_start_datetime,
+                             actual_simulation_end_datetime,
+                             len(watershed_lsm_file_list))
+                ensemble_job_batch = ensemble_job_batches.setdefault(batch_key,
+                                                                     {'watershed_job_group': watershed_job_group,
+                                                                      'weight_table_file_list': weight_table_file_list,
+                                                                      'grid': grid,
+                                                                      'RAPID_Inflow_Tool': RAPID_Inflow_Tool,
+                                                                      'member_lsm_file_lists': [],
+                                                                      'member_rapid_runoff_file_lists': []})
+                ensemble_job_batch['member_lsm_file_lists'].append(watershed_lsm_file_list)
+                ensemble_job_batch['member_rapid_runoff_file_lists'].append(rapid_runoff_file_list)
+                continue
+
+            job_scheduler.add_job_source(watershed_lsm_file_list,
+                                         job_args_before=(",".join([watershed_job['watershed'] for watershed_job in watershed_job_group]),
+                                                          ",".join([watershed_job['subbasin'] for watershed_job in watershed_job_group])),
+                                         job_args_after=(weight_table_file_list,
+                                                         grid_type,
+                                                         rapid_runoff_file_list,
+                                                         RAPID_Inflow_Tool,
+                                                         runoff_prefetch_depth,
+                                                         False),
+                                         cost_key=(grid_type, len(watershed_job_group)),
+                                         values_per_file=grid.lat_dim_size*grid.lon_dim_size*file_size_time*len(watershed_job_group),
+                                         #the runoff of WRF-Hydro accumulates from one file to the next
+                                         pass_previous_file=getattr(RAPID_Inflow_Tool, 'runoff_accumulated_across_files', False),
+                                         previous_file=lsm_file_list[watershed_job_group[0]['first_file_index']-1] \
+                                                       if watershed_job_group[0]['first_file_index'] > 0 else None)
+            #COMMENTED CODE IS FOR DEBUGGING
+##            generate_inflows_from_runoff((watershed_job_group[0]['watershed'],
+##                                          watershed_job_group[0]['subbasin'],
+##                                          watershed_lsm_file_list,
+##                                          range(len(watershed_lsm_file_list)),
+##                                          weight_table_file_list,
+##                                          grid_type,
+##                                          rapid_runoff_file_list,
+##                                          RAPID_Inflow_Tool,
+##                                          runoff_prefetch_depth,
+##                                          False))
+            max_watershed_job_group_size = max(max_watershed_job_group_size, len(watershed_job_group))
+
+        for watershed_job in watershed_job_list:
+            rapid_jobs[watershed_job['rapid_runoff_file']] = ((watershed_job, rapid_stage_options),
+                                                              num_rapid_processors if run_rapid_simulation or generate_return_periods_file else 1)
+
+    #queue the batched ensemble members
+    for ensemble_job_batch in ensemble_job_batches.itervalues():
+        watershed_job_group = ensemble_job_batch['watershed_job_group']
+        grid = ensemble_job_batch['grid']
+        num_members = len(ensemble_job_batch['member_lsm_file_lists'])
+        print "Converting {0} ensemble members of {1} together ...".format(num_members, grid.grid_type)
+        #time x member runoff files and watershed x member inflow files
+        member_lsm_file_list = [list(member_files) for member_files in zip(*ensemble_job_batch['member_lsm_file_lists'])]
+        member_rapid_runoff_file_list = [list(member_files) for member_files in zip(*ensemble_job_batch['member_rapid_runoff_file_lists'])]
+        job_scheduler.add_job_source(member_lsm_file_list,
+                                     job_args_before=(",".join([watershed_job['watershed'] for watershed_job in watershed_job_group]),
+                                                      ",".join([watershed_job['subbasin'] for watershed_job in watershed_job_group])),
+                                     job_args_after=(ensemble_job_batch['weight_table_file_list'],
+                                                     grid.grid_type,
+                                                     member_rapid_runoff_file_list,
+                                                     ensemble_job_batch['RAPID_Inflow_Tool'],
+                                                     runoff_prefetch_depth,
+                                                     True),
+                                     cost_key=(grid.grid_type, len(watershed_job_group), num_members),
+                                     values_per_file=grid.lat_dim_size*grid.lon_dim_size*grid.file_size_time*len(watershed_job_group)*num_members)
+        max_watershed_job_group_size = max(max_watershed_job_group_size, len(watershed_job_group)*num_members)
+
+    #run ERA Interim processes
+    #the files of the next watershed group are started before
+    #the previous ones are finished, so split the budget between two groups
+    write_inflows_from_queue(inflow_queue,
+                             job_scheduler,
+                             inflow_file_num_blocks,
+                             memory_budget_mb=float(inflow_memory_budget_mb)/(2*max_watershed_job_group_size),
+                             num_streams=NUM_CPUS,
+                             rapid_scheduler=rapid_scheduler,
+                             rapid_jobs=rapid_jobs)
+    pool.close()
+    pool.join()
+
+    lsm_file_catalog.close()
+
+    #wait for the last RAPID runs
+    rapid_scheduler.wait()
+    rapid_pool.close()
+    rapid_pool.join()
 
     #print info to user
     time_end = datetime.utcnow()
     print "Time Begin All: " + str(time_begin_all)
     print "Time Finish All: " + str(time_end)
     print "TOTAL TIME: "  + str(time_end-time_begin_all)
+
+    #the CPU time of the workers is recorded in their stages
+    METRICS.record_stage('run',
+                         (time_end-time_begin_all).total_seconds(),
+                         get_cpu_seconds()-cpu_begin_all)
+    if metrics_file and metrics_format == "prometheus":
+        write_prometheus_textfile(read_metrics_records(metrics_records_file, METRICS.run_id),
+                                  metrics_file)
+        print "Metrics written to {0} ...".format(metrics_file)
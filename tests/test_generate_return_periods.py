@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+##
+##  test_generate_return_periods.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import numpy as NUM
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import netCDF4 as NET
+    from RAPIDpy.dataset import RAPIDDataset
+    from imports.generate_return_periods import (generate_return_periods,
+                                                 get_return_period_flows,
+                                                 get_storm_maxima)
+    RAPIDPY_ENABLED = True
+except ImportError:
+    RAPIDPY_ENABLED = False
+
+def get_baseline_storm_maxima(qout_array, steps_per_group):
+    """
+    Storm maxima of one reach, one group at a time
+    (as RAPIDDataset.get_daily_qout_index with mode="max")
+    """
+    return NUM.array([NUM.amax(qout_array[group_start:group_start+steps_per_group])
+                      for group_start in xrange(0, len(qout_array), steps_per_group)])
+
+def get_baseline_return_period_flows(storm_maxima, num_years, rp_index_list):
+    """
+    Return period flows of one reach from the fully sorted storm maxima
+    """
+    sorted_flow_data = NUM.sort(storm_maxima)[:num_years:-1]
+    return sorted_flow_data[0], [sorted_flow_data[rp_index] for rp_index in rp_index_list]
+
+def write_synthetic_qout(qout_file, size_time, size_rivid, random_state):
+    """
+    Synthetic 3-hourly RAPID Qout file (time, rivid) with tied flows
+    """
+    with NET.Dataset(qout_file, 'w', format="NETCDF4") as qout_nc:
+        qout_nc.createDimension('time', size_time)
+        qout_nc.createDimension('rivid', size_rivid)
+        qout_nc.featureType = "timeSeries"
+        qout_nc.Conventions = "CF-1.6"
+        time_var = qout_nc.createVariable('time', 'i4', ('time',))
+        time_var.long_name = 'time'
+        time_var.standard_name = 'time'
+        time_var.units = 'seconds since 1970-01-01 00:00:00+00:00'
+        time_var.axis = 'T'
+        time_var.calendar = 'gregorian'
+        time_var[:] = NUM.arange(size_time)*3*3600
+        rivid_var = qout_nc.createVariable('rivid', 'i4', ('rivid',))
+        rivid_var.cf_role = 'timeseries_id'
+        rivid_var[:] = NUM.arange(size_rivid) + 1000
+        for coord_name in ('lat', 'lon'):
+            coord_var = qout_nc.createVariable(coord_name, 'f8', ('rivid',))
+            coord_var[:] = random_state.uniform(-10, 10, size_rivid)
+        qout_var = qout_nc.createVariable('Qout', 'f4', ('time', 'rivid'))
+        qout_var.units = 'm3 s-1'
+        #rounded, so that many storms have the same maximum
+        qout_var[:] = NUM.round(random_state.gamma(2.0, 50.0, (size_time, size_rivid)), -1)
+
+class TestReturnPeriodFlows(unittest.TestCase):
+    """
+    The return period flows match the flows of the per reach sort
+    """
+    def setUp(self):
+        if not RAPIDPY_ENABLED:
+            self.skipTest("netCDF4 and RAPIDpy are needed")
+        self.random_state = NUM.random.RandomState(42)
+
+    def test_storm_maxima_trailing_group(self):
+        #the last group has 3 of the 8 time steps
+        qout_block = self.random_state.gamma(2.0, 50.0, (8*20 + 3, 7))
+        storm_maxima = get_storm_maxima(qout_block, 8)
+        self.assertEqual(storm_maxima.shape, (21, 7))
+        for reach_index in xrange(qout_block.shape[1]):
+            NUM.testing.assert_array_equal(storm_maxima[:, reach_index],
+                                           get_baseline_storm_maxima(qout_block[:, reach_index], 8))
+
+    def test_partition_matches_sort(self):
+        num_years = 10
+        rp_index_list = [int((num_years + 1)/20.0),
+                         int((num_years + 1)/10.0),
+                         int((num_years + 1)/2.0)]
+        #rounded, so that many storms tie
+        storm_maxima = NUM.round(self.random_state.gamma(2.0, 50.0, (num_years*52 + 1, 25)), -1)
+        max_flow, rp_flows = get_return_period_flows(storm_maxima, num_years, rp_index_list)
+        for reach_index in xrange(storm_maxima.shape[1]):
+            baseline_max_flow, baseline_rp_flows = \
+                get_baseline_return_period_flows(storm_maxima[:, reach_index], num_years, rp_index_list)
+            self.assertEqual(max_flow[reach_index], baseline_max_flow)
+            for rp_flow, baseline_rp_flow in zip(rp_flows, baseline_rp_flows):
+                self.assertEqual(rp_flow[reach_index], baseline_rp_flow)
+
+class TestGenerateReturnPeriods(unittest.TestCase):
+    """
+    The return period file is the same for any number of processes
+    and matches the per reach baseline
+    """
+    def setUp(self):
+        if not RAPIDPY_ENABLED:
+            self.skipTest("netCDF4 and RAPIDpy are needed")
+        self.work_directory = tempfile.mkdtemp()
+        self.qout_file = os.path.join(self.work_directory, 'Qout_synthetic.nc')
+        #a bit more than 12 years, so the last storm is a partial one
+        write_synthetic_qout(self.qout_file, 12*2920 + 20, 23,
+                             NUM.random.RandomState(7))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_directory)
+
+    def test_serial_matches_parallel(self):
+        return_period_files = []
+        for num_processes in (1, 3):
+            return_period_file = os.path.join(self.work_directory,
+                                              'return_periods_{0}.nc'.format(num_processes))
+            #a small memory limit, so the reaches are split in several blocks
+            generate_return_periods(self.qout_file, return_period_file,
+                                    num_processes=num_processes,
+                                    max_memory_mb=1)
+            return_period_files.append(return_period_file)
+
+        with NET.Dataset(return_period_files[0]) as serial_nc, \
+             NET.Dataset(return_period_files[1]) as parallel_nc:
+            for var_name in ('rivid', 'lat', 'lon', 'max_flow',
+                             'return_period_20', 'return_period_10', 'return_period_2'):
+                NUM.testing.assert_array_equal(serial_nc.variables[var_name][:],
+                                               parallel_nc.variables[var_name][:])
+
+            with RAPIDDataset(self.qout_file) as qout_nc_file:
+                num_years = 12
+                rp_index_list = [int((num_years + 1)/20.0),
+                                 int((num_years + 1)/10.0),
+                                 int((num_years + 1)/2.0)]
+                for comid_index in xrange(qout_nc_file.size_river_id):
+                    filtered = qout_nc_file.get_daily_qout_index(comid_index,
+                                                                 steps_per_group=56,
+                                                                 mode="max")
+                    baseline_max_flow, baseline_rp_flows = \
+                        get_baseline_return_period_flows(filtered, num_years, rp_index_list)
+                    self.assertEqual(serial_nc.variables['max_flow'][comid_index],
+                                     baseline_max_flow)
+                    for var_name, baseline_rp_flow in zip(('return_period_20',
+                                                           'return_period_10',
+                                                           'return_period_2'),
+                                                          baseline_rp_flows):
+                        self.assertEqual(serial_nc.variables[var_name][comid_index],
+                                         baseline_rp_flow)
+
+if __name__ == '__main__':
+    unittest.main()
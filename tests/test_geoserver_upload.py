@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+##
+##  test_geoserver_upload.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from time import sleep
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imports.geoserver_upload import GeoServerUploadPipeline
+try:
+    import autorapid_process
+    AUTORAPID_ENABLED = True
+except ImportError:
+    AUTORAPID_ENABLED = False
+
+class FakeFailedRequestError(Exception):
+    pass
+
+class FakeGeoServer(object):
+    """
+    GeoServer shared by the fake managers. The first upload fails.
+    """
+    def __init__(self, num_failures=1, upload_delay=0.05):
+        self.lock = threading.Lock()
+        self.num_failures = num_failures
+        self.upload_delay = upload_delay
+        self.num_managers = 0
+        self.uploads = {}
+        self.layer_groups = []
+
+    def upload_shapefile(self, resource_name, shapefile_list):
+        with self.lock:
+            if self.num_failures > 0:
+                self.num_failures -= 1
+                raise FakeFailedRequestError("Upload of {0} failed".format(resource_name))
+        sleep(self.upload_delay)
+        with self.lock:
+            self.uploads[resource_name] = self.uploads.get(resource_name, 0) + 1
+
+    def create_layer_group(self, layer_group_id, layers, styles, bounds):
+        with self.lock:
+            #the layers uploaded when the layer group is created
+            self.layer_groups.append((layer_group_id, layers, dict(self.uploads)))
+
+class FakeDatasetEngine(object):
+    def __init__(self, geoserver):
+        self.create_layer_group = geoserver.create_layer_group
+
+class FakeGeoServerManager(object):
+    """
+    Stands for GeoServerDatasetManager
+    """
+    def __init__(self, geoserver):
+        self.geoserver = geoserver
+        self.dataset_engine = FakeDatasetEngine(geoserver)
+        with geoserver.lock:
+            geoserver.num_managers += 1
+
+    def upload_shapefile(self, resource_name, shapefile_list):
+        self.geoserver.upload_shapefile(resource_name, shapefile_list)
+
+    def get_layer_name(self, resource_name):
+        return "spt-app:{0}".format(resource_name)
+
+class TestGeoServerUploadPipeline(unittest.TestCase):
+    """
+    The shapefiles are uploaded once each, retried after a failure,
+    before their layer group is created
+    """
+    def setUp(self):
+        self.geoserver = FakeGeoServer()
+        self.resource_names = ["watershed-floodmap-return_period_2-{0}".format(tile_index)
+                               for tile_index in xrange(8)]
+
+    def get_upload_pipeline(self):
+        return GeoServerUploadPipeline(lambda: FakeGeoServerManager(self.geoserver),
+                                       num_threads=3,
+                                       max_retries=2,
+                                       retry_delay=0.01,
+                                       retry_exceptions=(FakeFailedRequestError,))
+
+    def test_upload_retry_once(self):
+        with self.get_upload_pipeline() as upload_pipeline:
+            upload_results = [upload_pipeline.upload_shapefile(resource_name, [])
+                              for resource_name in self.resource_names]
+            layer_names = [upload_result.get() for upload_result in upload_results]
+            upload_pipeline.create_layer_group("watershed-floodmap-return_period_2",
+                                               layer_names, [0, 0, 1, 1])
+
+        self.assertEqual(self.geoserver.num_failures, 0)
+        self.assertEqual(self.geoserver.uploads,
+                         dict((resource_name, 1) for resource_name in self.resource_names))
+        self.assertEqual(layer_names,
+                         ["spt-app:{0}".format(resource_name) for resource_name in self.resource_names])
+        #one manager per thread (and one for the layer group)
+        self.assertLessEqual(self.geoserver.num_managers, 4)
+
+        self.assertEqual(len(self.geoserver.layer_groups), 1)
+        layer_group_id, layers, uploads = self.geoserver.layer_groups[0]
+        self.assertEqual(layer_group_id, "spt-app:watershed-floodmap-return_period_2")
+        self.assertEqual(layers, tuple(layer_names))
+        self.assertEqual(sorted(uploads), sorted(self.resource_names))
+
+    @unittest.skipIf(not AUTORAPID_ENABLED, "AutoRoutePy, RAPIDpy and the dataset manager are needed")
+    def test_layer_group_waits_for_uploads(self):
+        output_directory = tempfile.mkdtemp()
+        get_shapefile_layergroup_bounds = autorapid_process.get_shapefile_layergroup_bounds
+        autorapid_process.get_shapefile_layergroup_bounds = lambda shapefile_list: [0, 0, 1, 1]
+        try:
+            with self.get_upload_pipeline() as upload_pipeline:
+                floodmap_upload = {'layer_group_name': "watershed-floodmap-return_period_2",
+                                   'upload_results': [upload_pipeline.upload_shapefile(resource_name, [])
+                                                      for resource_name in self.resource_names],
+                                   'upload_shapefile_list': [],
+                                   'output_directory': output_directory,
+                                   'num_tiles': len(self.resource_names),
+                                   'update_layer_group': True}
+                #called while the uploads are running
+                autorapid_process.create_floodmap_layer_group(upload_pipeline, floodmap_upload)
+        finally:
+            autorapid_process.get_shapefile_layergroup_bounds = get_shapefile_layergroup_bounds
+            shutil.rmtree(output_directory, ignore_errors=True)
+
+        self.assertEqual(len(self.geoserver.layer_groups), 1)
+        layer_group_id, layers, uploads = self.geoserver.layer_groups[0]
+        self.assertEqual(uploads, dict((resource_name, 1) for resource_name in self.resource_names))
+        self.assertEqual(layers, tuple("spt-app:{0}".format(resource_name)
+                                       for resource_name in self.resource_names))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+##
+##  test_rapid_run_scheduler.py
+##  spt_lsm_autorapid_process
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from time import sleep
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imports.rapid_run_scheduler import NonDaemonicPool, RapidRunScheduler, rapid_work_directory
+
+def run_fake_rapid(watershed_job):
+    """
+    Writes the namelist and the executable link in the working
+    directory like RAPIDpy, then reads the namelist back while
+    the other job runs
+    """
+    with rapid_work_directory(watershed_job['output_directory'],
+                              watershed_job['out_file_ending']):
+        with open("rapid_namelist", 'w') as rapid_namelist:
+            rapid_namelist.write("Vlat_file = '{0}'\n".format(watershed_job['rapid_runoff_file']))
+        os.symlink(sys.executable, "rapid_exe_symlink")
+        sleep(0.5)
+        with open("rapid_namelist") as rapid_namelist:
+            namelist_text = rapid_namelist.read()
+        if watershed_job['rapid_runoff_file'] not in namelist_text:
+            raise Exception("ERROR: Namelist of {0} overwritten ...".format(watershed_job['out_file_ending']))
+
+class TestRapidRunScheduler(unittest.TestCase):
+    """
+    The RAPID jobs of a watershed running at the same time
+    do not share their working directory
+    """
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+
+    def test_same_watershed_jobs(self):
+        stage_queue = multiprocessing.Queue()
+        pool = NonDaemonicPool(2)
+        try:
+            rapid_scheduler = RapidRunScheduler(pool, run_fake_rapid, stage_queue, 2)
+            for ensemble in (1, 2):
+                out_file_ending = "erai_t511_24hr_19800101to19801231_{0}.nc".format(ensemble)
+                rapid_scheduler.add_job(out_file_ending,
+                                        {'output_directory': self.output_directory,
+                                         'out_file_ending': out_file_ending,
+                                         'rapid_runoff_file': os.path.join(self.output_directory,
+                                                                           'm3_riv_bas_{0}'.format(out_file_ending))},
+                                        1)
+            rapid_scheduler.update()
+            #both jobs run at the same time
+            self.assertEqual(len(rapid_scheduler.running_jobs), 2)
+            rapid_scheduler.wait()
+        finally:
+            pool.close()
+            pool.join()
+        #the work directories are removed
+        self.assertEqual(os.listdir(self.output_directory), [])
+
+if __name__ == '__main__':
+    unittest.main()